@@ -0,0 +1,55 @@
+"""Collision-free asset ID allocation.
+
+Asset IDs look like TEN-1-1042: a drug code, the receiving location and a
+number from a per-prefix sequence in the asset_sequences table. Numbers are
+reserved from the table in blocks and handed out from memory, so a bulk
+receipt costs one round-trip per block rather than one per vial.
+
+Reservations must be made on the writer connection inside the write
+transaction. If that transaction rolls back, call reset(): the block it
+reserved was rolled back with it and may be handed out again by the table.
+"""
+
+DEFAULT_BLOCK_SIZE = 50
+
+
+def asset_prefix(drug_name, location_id):
+    return f"{drug_name[:3].upper()}-{location_id}"
+
+
+class AssetIdAllocator:
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self._blocks = {}  # prefix -> [next, end)
+        self.stats = {'issued': 0, 'blocks_reserved': 0, 'resets': 0}
+
+    def _reserve_block(self, cursor, prefix, count):
+        size = max(count, self.block_size)
+        cursor.execute("INSERT OR IGNORE INTO asset_sequences (prefix, next_value) VALUES (?, 1)", (prefix,))
+        start = cursor.execute("SELECT next_value FROM asset_sequences WHERE prefix = ?", (prefix,)).fetchone()[0]
+        cursor.execute("UPDATE asset_sequences SET next_value = ? WHERE prefix = ?", (start + size, prefix))
+        self.stats['blocks_reserved'] += 1
+        block = self._blocks[prefix] = [start, start + size]
+        return block
+
+    def allocate(self, cursor, prefix, count):
+        """Return count new asset IDs under prefix."""
+        ids = []
+        block = self._blocks.get(prefix)
+        while len(ids) < count:
+            if block is None or block[0] >= block[1]:
+                block = self._reserve_block(cursor, prefix, count - len(ids))
+            take = min(count - len(ids), block[1] - block[0])
+            ids.extend(f"{prefix}-{n}" for n in range(block[0], block[0] + take))
+            block[0] += take
+        self.stats['issued'] += count
+        return ids
+
+    def reset(self):
+        """Forget every in-memory block after a rolled-back write."""
+        if self._blocks:
+            self._blocks.clear()
+            self.stats['resets'] += 1
+
+    def snapshot(self):
+        return dict(self.stats, block_size=self.block_size, open_blocks=len(self._blocks))
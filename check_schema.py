@@ -1,15 +1,13 @@
-import sqlite3
+import migrations
 
 def check_schema():
-    conn = sqlite3.connect('sys_data.dat')
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA table_info(users)")
-    columns = [row[1] for row in cursor.fetchall()]
-    print(f"Users table columns: {columns}")
-    if 'is_active' in columns:
-        print("is_active column exists.")
-    else:
-        print("is_active column MISSING!")
+    conn = migrations.connect('sys_data.dat')
+    status = migrations.schema_status(conn)
+    print(f"Schema version: {status['version']} (latest: {status['latest_version']})")
+    for number, description in status['pending']:
+        print(f"Pending migration {number}: {description}")
+    for table, columns in status['tables'].items():
+        print(f"{table} columns: {columns}")
     conn.close()
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { motion } from 'framer-motion'
 import {
   Heart, Pill, AlertTriangle, CheckCircle, Clock, TrendingDown,
@@ -11,6 +11,31 @@ import { useNotification } from '../contexts/NotificationContext'
 import StockCard from './StockCard'
 import QRScanner from './QRScanner'
 
+const NETWORK_ROLES = ['PHARMACIST', 'PHARMACY_TECH']
+
+// Patch one vial from a change event into the dashboard data: AVAILABLE
+// vials in the user's scope are upserted in expiry order, anything else drops out
+function applyVialChange(data, vial, user) {
+  const inScope = NETWORK_ROLES.includes(user.role) || vial.location_id === user.location_id
+  const stock = data.stock.filter(item => item.id !== vial.id)
+  if (vial.status === 'AVAILABLE' && inScope) {
+    const { status, ...item } = vial
+    const at = stock.findIndex(other =>
+      other.expiry_date > item.expiry_date || (other.expiry_date === item.expiry_date && other.id > item.id))
+    stock.splice(at === -1 ? stock.length : at, 0, item)
+  }
+  return {
+    ...data,
+    stock,
+    stats: {
+      total_stock: stock.length,
+      expiring_soon: stock.filter(item => item.status_color === 'red').length,
+      warning_stock: stock.filter(item => item.status_color === 'amber').length,
+      healthy_stock: stock.filter(item => item.status_color === 'green').length
+    }
+  }
+}
+
 export default function Dashboard() {
   const { user } = useAuth()
   const { success, error: showError } = useNotification()
@@ -23,11 +48,25 @@ export default function Dashboard() {
   const [viewMode, setViewMode] = useState('grid')
   const [groupingMode, setGroupingMode] = useState('grouped')
   const [collapsedGroups, setCollapsedGroups] = useState(new Set())
+  // Vial changes that arrive while a fetch is in flight, re-applied to its result
+  const pendingChanges = useRef(null)
 
-  const handleScan = (decodedText) => {
+  const handleScan = async (decodedText) => {
     setSearchTerm(decodedText)
     setGroupingMode('ungrouped') // Switch to list view to show result directly
     setShowScanner(false)
+    // The typeahead index answers from memory, so a used or moved vial is
+    // flagged as soon as it is scanned
+    try {
+      const response = await fetch(`/api/typeahead?q=${encodeURIComponent(decodedText)}&limit=1`)
+      const match = response.ok ? (await response.json()).assets[0] : null
+      if (match && match.asset_id === decodedText && match.status !== 'AVAILABLE') {
+        showError('Not Available', `${decodedText} is ${match.status.replace('_', ' ').toLowerCase()}`)
+        return
+      }
+    } catch (err) {
+      // Filtering the dashboard still works without the lookup
+    }
     success('Item Found', `Filtered dashboard for ${decodedText}`)
   }
 
@@ -61,8 +100,25 @@ export default function Dashboard() {
     return () => window.removeEventListener('keydown', handleKeyDown)
   }, [])
 
+  // Live updates: vial changes are patched in as they happen; the whole
+  // dashboard is only fetched on connect and when the server asks for a resync
   useEffect(() => {
-    fetchDashboardData()
+    let loaded = false
+    const load = () => {
+      loaded = true
+      fetchDashboardData()
+    }
+    const events = new EventSource(`/api/events/${user.id}`)
+    // Fetch once subscribed, so no change can fall between the two
+    events.addEventListener('open', () => { if (!loaded) load() })
+    events.addEventListener('error', () => { if (!loaded) load() })
+    events.addEventListener('resync', load)
+    events.addEventListener('vial', (e) => {
+      const vial = JSON.parse(e.data)
+      pendingChanges.current?.push(vial)
+      setDashboardData(data => data && applyVialChange(data, vial, user))
+    })
+    return () => events.close()
   }, [user])
 
   // Set all groups as collapsed by default in list view when dashboardData is loaded
@@ -74,18 +130,20 @@ export default function Dashboard() {
   }, [dashboardData, groupingMode, viewMode])
 
   const fetchDashboardData = async () => {
+    pendingChanges.current = []
     try {
       const response = await fetch(`/api/dashboard/${user.id}`)
       const data = await response.json()
 
       if (response.ok) {
-        setDashboardData(data)
+        setDashboardData(pendingChanges.current.reduce((current, vial) => applyVialChange(current, vial, user), data))
       } else {
         showError('Failed to load dashboard', data.error)
       }
     } catch (err) {
       showError('Connection Error', 'Failed to connect to server')
     } finally {
+      pendingChanges.current = null
       setLoading(false)
     }
   }
@@ -89,12 +89,32 @@ export default function StockReceive() {
     }
   }
 
+  // Printing happens in the background; only a failed job needs the user's attention
+  const watchPrintJob = async (jobId) => {
+    for (let i = 0; i < 60; i++) {
+      await new Promise(resolve => setTimeout(resolve, 2000))
+      try {
+        const response = await fetch(`/api/print_jobs/${jobId}`)
+        if (!response.ok) return
+        const job = await response.json()
+        if (job.status === 'DONE') return
+        if (job.status === 'FAILED') {
+          showError('Print Error', job.last_error || 'Failed to send labels to printer')
+          return
+        }
+      } catch (err) {
+        return
+      }
+    }
+  }
+
   const printLabels = async () => {
     if (generatedAssets.length === 0) return
 
     const payload = {
       asset_ids: generatedAssets,
-      location_id: user?.location_id
+      location_id: user?.location_id,
+      user_id: user?.id
     }
 
     try {
@@ -105,9 +125,11 @@ export default function StockReceive() {
       })
 
       if (response.ok) {
-        success('Labels Sent', 'Labels sent to Zebra printer')
+        const { job_id } = await response.json()
+        success('Labels Queued', 'Labels are printing on the Zebra printer')
         setShowLabels(false)
         setGeneratedAssets([])
+        watchPrintJob(job_id)
       } else {
         const data = await response.json()
         showError('Print Error', data.error || 'Failed to send labels to printer')
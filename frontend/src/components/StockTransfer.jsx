@@ -11,6 +11,9 @@ import { useNotification } from '../contexts/NotificationContext'
 import NetworkMap from './NetworkMap'
 import { useLocation } from 'react-router-dom'
 
+const HISTORY_PAGE_SIZE = 50
+const ACTIVE_PAGE_SIZE = 200
+
 export default function StockTransfer() {
   const { user, isPharmacist } = useAuth()
   const { success, error: showError } = useNotification()
@@ -23,6 +26,7 @@ export default function StockTransfer() {
   const [fromLocation, setFromLocation] = useState('')
   const [toLocation, setToLocation] = useState('')
   const [transfers, setTransfers] = useState([])
+  const [historyCursor, setHistoryCursor] = useState(null)
   const [loading, setLoading] = useState(false)
   const [searchTerm, setSearchTerm] = useState('')
 
@@ -77,12 +81,51 @@ export default function StockTransfer() {
     }
   }
 
+  // Every pending and in-transit transfer needs action, so follow the cursor to the end
+  const fetchActiveTransfers = async () => {
+    const active = []
+    let cursor = null
+    do {
+      const response = await fetch(
+        `/api/transfers/${user.location_id}?status=PENDING,IN_TRANSIT&limit=${ACTIVE_PAGE_SIZE}` +
+        (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '')
+      )
+      const data = await response.json()
+      if (!response.ok) {
+        return null
+      }
+      active.push(...data.transfers)
+      cursor = data.next_cursor
+    } while (cursor)
+    return active
+  }
+
   const fetchTransfers = async () => {
     try {
-      const response = await fetch(`/api/transfers/${user.location_id}`)
+      // History is loaded a page at a time
+      const [active, historyResponse] = await Promise.all([
+        fetchActiveTransfers(),
+        fetch(`/api/transfers/${user.location_id}?status=COMPLETED,CANCELLED&limit=${HISTORY_PAGE_SIZE}`)
+      ])
+      const history = await historyResponse.json()
+      if (active && historyResponse.ok) {
+        setTransfers([...active, ...history.transfers])
+        setHistoryCursor(history.next_cursor)
+      }
+    } catch (err) {
+      showError('Failed to load transfers')
+    }
+  }
+
+  const loadMoreHistory = async () => {
+    try {
+      const response = await fetch(
+        `/api/transfers/${user.location_id}?status=COMPLETED,CANCELLED&limit=${HISTORY_PAGE_SIZE}&cursor=${encodeURIComponent(historyCursor)}`
+      )
       const data = await response.json()
       if (response.ok) {
-        setTransfers(data)
+        setTransfers(prev => [...prev, ...data.transfers])
+        setHistoryCursor(data.next_cursor)
       }
     } catch (err) {
       showError('Failed to load transfers')
@@ -580,6 +623,15 @@ export default function StockTransfer() {
                 <p className="text-gray-500">No transfer history</p>
               </div>
             )}
+
+            {historyCursor && (
+              <button
+                onClick={loadMoreHistory}
+                className="w-full py-3 text-sm font-medium text-blue-600 bg-white rounded-2xl shadow-sm border border-gray-100 hover:bg-blue-50 transition-colors"
+              >
+                Load older transfers
+              </button>
+            )}
           </motion.div>
         )}
       </AnimatePresence>
@@ -1,29 +1,22 @@
-import sqlite3
 import os
+import migrations
 
 DB_FILE = 'sys_data.dat'
 
 def migrate():
+    # The is_active column is now part of the baseline migration; this script
+    # simply runs every pending migration.
     if not os.path.exists(DB_FILE):
         print("Database not found.")
         return
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if column exists
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [info[1] for info in cursor.fetchall()]
-        
-        if 'is_active' not in columns:
-            print("Adding is_active column...")
-            cursor.execute("ALTER TABLE users ADD COLUMN is_active BOOLEAN DEFAULT 1")
-            conn.commit()
-            print("Migration successful: is_active column added.")
+        conn = migrations.connect(DB_FILE)
+        applied = migrations.migrate(conn)
+        if applied:
+            print(f"Migration successful: applied {applied}")
         else:
-            print("Column is_active already exists.")
-            
+            print(f"Schema already at version {migrations.get_version(conn)}.")
         conn.close()
     except Exception as e:
         print(f"Migration failed: {e}")
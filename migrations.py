@@ -0,0 +1,698 @@
+"""Versioned schema migrations for the medicine tracker database.
+
+The schema version lives in PRAGMA user_version. Each migration runs once,
+all pending migrations run in a single transaction, and a database that is
+already current costs one PRAGMA read.
+"""
+import json
+import sqlite3
+import logging
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _add_column(conn, table, column, definition):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# MIGRATIONS
+def migration_001_baseline(conn):
+    # Databases created before versioning already have some of these tables,
+    # possibly missing columns that were added later - both are handled here.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL CHECK(role IN ('PHARMACIST', 'PHARMACY_TECH', 'NURSE')),
+            location_id INTEGER NOT NULL,
+            can_delegate BOOLEAN DEFAULT 0,
+            is_supervisor BOOLEAN DEFAULT 0,
+            email TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version INTEGER DEFAULT 1,
+            must_change_password BOOLEAN DEFAULT 0,
+            reset_token TEXT,
+            reset_token_expiry TIMESTAMP,
+            mobile_number TEXT,
+            FOREIGN KEY (location_id) REFERENCES locations(id)
+        )
+    ''')
+
+    # Locations table (Hub pharmacies, wards, remote sites)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL CHECK(type IN ('HUB', 'WARD', 'REMOTE')),
+            parent_hub_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version INTEGER DEFAULT 1,
+            FOREIGN KEY (parent_hub_id) REFERENCES locations(id)
+        )
+    ''')
+
+    # Drug catalog
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS drugs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            category TEXT,
+            storage_temp TEXT,
+            unit_price REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version INTEGER DEFAULT 1
+        )
+    ''')
+
+    # Stock levels per location
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_levels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location_id INTEGER NOT NULL,
+            drug_id INTEGER NOT NULL,
+            min_stock INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 1,
+            FOREIGN KEY (location_id) REFERENCES locations(id),
+            FOREIGN KEY (drug_id) REFERENCES drugs(id),
+            UNIQUE(location_id, drug_id)
+        )
+    ''')
+
+    # Individual vial tracking
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vials (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id TEXT UNIQUE NOT NULL,
+            drug_id INTEGER NOT NULL,
+            batch_number TEXT NOT NULL,
+            expiry_date DATE NOT NULL,
+            location_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'AVAILABLE'
+                CHECK(status IN ('AVAILABLE', 'USED_CLINICAL', 'DISCARDED', 'IN_TRANSIT')),
+            discard_reason TEXT,
+            patient_mrn TEXT,
+            clinical_notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_at TIMESTAMP,
+            used_by INTEGER,
+            version INTEGER DEFAULT 1,
+            goods_receipt_number TEXT,
+            disposal_register_number TEXT,
+            FOREIGN KEY (drug_id) REFERENCES drugs(id),
+            FOREIGN KEY (location_id) REFERENCES locations(id),
+            FOREIGN KEY (used_by) REFERENCES users(id)
+        )
+    ''')
+
+    # Stock transfers
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transfers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_location_id INTEGER NOT NULL,
+            to_location_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING'
+                CHECK(status IN ('PENDING', 'IN_TRANSIT', 'COMPLETED', 'CANCELLED')),
+            created_by INTEGER NOT NULL,
+            approved_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            approved_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            version INTEGER DEFAULT 1,
+            completed_by INTEGER REFERENCES users(id),
+            FOREIGN KEY (from_location_id) REFERENCES locations(id),
+            FOREIGN KEY (to_location_id) REFERENCES locations(id),
+            FOREIGN KEY (created_by) REFERENCES users(id),
+            FOREIGN KEY (approved_by) REFERENCES users(id)
+        )
+    ''')
+
+    # Transfer items
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transfer_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transfer_id INTEGER NOT NULL,
+            vial_id INTEGER NOT NULL,
+            FOREIGN KEY (transfer_id) REFERENCES transfers(id),
+            FOREIGN KEY (vial_id) REFERENCES vials(id)
+        )
+    ''')
+
+    # Audit log
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # Printer settings per location
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location_id INTEGER,
+            printer_ip TEXT,
+            printer_port TEXT,
+            label_width INTEGER DEFAULT 50,
+            label_height INTEGER DEFAULT 25,
+            margin_top INTEGER DEFAULT 0,
+            margin_right INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Columns added to pre-versioning databases over time
+    _add_column(conn, 'users', 'is_active', "BOOLEAN DEFAULT 1")
+    _add_column(conn, 'users', 'is_supervisor', "BOOLEAN DEFAULT 0")
+    _add_column(conn, 'users', 'must_change_password', "BOOLEAN DEFAULT 0")
+    _add_column(conn, 'users', 'reset_token', "TEXT")
+    _add_column(conn, 'users', 'reset_token_expiry', "TIMESTAMP")
+    _add_column(conn, 'users', 'mobile_number', "TEXT")
+    _add_column(conn, 'vials', 'patient_mrn', "TEXT")
+    _add_column(conn, 'vials', 'clinical_notes', "TEXT")
+    _add_column(conn, 'vials', 'goods_receipt_number', "TEXT")
+    _add_column(conn, 'vials', 'disposal_register_number', "TEXT")
+    _add_column(conn, 'transfers', 'completed_by', "INTEGER REFERENCES users(id)")
+    _add_column(conn, 'settings', 'location_id', "INTEGER")
+    _add_column(conn, 'settings', 'label_width', "INTEGER DEFAULT 50")
+    _add_column(conn, 'settings', 'label_height', "INTEGER DEFAULT 25")
+    _add_column(conn, 'settings', 'margin_top', "INTEGER DEFAULT 0")
+    _add_column(conn, 'settings', 'margin_right', "INTEGER DEFAULT 0")
+
+
+def migration_002_indexes(conn):
+    # Available stock ordered by expiry (pharmacist dashboard) and per location
+    # (nurse dashboard, location stock, network status map)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_available_expiry ON vials(expiry_date) WHERE status = 'AVAILABLE'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_available_location_expiry ON vials(location_id, expiry_date) WHERE status = 'AVAILABLE'")
+
+    # Per location/drug counts (minimum stock checks, location delete guard)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_location_drug_status ON vials(location_id, drug_id, status)")
+
+    # Usage report range scan, covering so the vials rows are never touched
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_used_at ON vials(used_at, status, drug_id, location_id) WHERE used_at IS NOT NULL")
+
+    # Most recent first search results
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_created_at ON vials(created_at)")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transfer_items_transfer ON transfer_items(transfer_id, vial_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transfer_items_vial ON transfer_items(vial_id, transfer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_from ON transfers(from_location_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transfers_to ON transfers(to_location_id, created_at)")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_location ON users(location_id)")
+
+
+def migration_003_structured_audit_log(conn):
+    _add_column(conn, 'audit_log', 'vial_id', "INTEGER REFERENCES vials(id)")
+    _add_column(conn, 'audit_log', 'asset_id', "TEXT")
+    _add_column(conn, 'audit_log', 'location_id', "INTEGER REFERENCES locations(id)")
+
+    # Per-asset references for entries that cover several vials at once
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log_assets (
+            audit_id INTEGER NOT NULL,
+            asset_id TEXT NOT NULL,
+            vial_id INTEGER,
+            PRIMARY KEY (asset_id, audit_id),
+            FOREIGN KEY (audit_id) REFERENCES audit_log(id),
+            FOREIGN KEY (vial_id) REFERENCES vials(id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Backfill from the JSON details written by older versions
+    rows = conn.execute("SELECT id, details FROM audit_log WHERE details IS NOT NULL").fetchall()
+    single, multiple = [], []
+    for audit_id, details in rows:
+        try:
+            data = json.loads(details)
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        asset_id = data.get('asset_id')
+        location_id = data.get('location_id')
+        if asset_id or location_id:
+            single.append((asset_id, location_id, asset_id, audit_id))
+        for listed_asset in data.get('asset_ids') or []:
+            multiple.append((audit_id, listed_asset, listed_asset))
+
+    conn.executemany("""
+        UPDATE audit_log
+        SET asset_id = ?, location_id = ?, vial_id = (SELECT id FROM vials WHERE asset_id = ?)
+        WHERE id = ?
+    """, single)
+    conn.executemany("""
+        INSERT OR IGNORE INTO audit_log_assets (audit_id, asset_id, vial_id)
+        VALUES (?, ?, (SELECT id FROM vials WHERE asset_id = ?))
+    """, multiple)
+
+    # Use/discard details never carried a location; a consumed vial never moves again
+    conn.execute("""
+        UPDATE audit_log
+        SET location_id = (SELECT location_id FROM vials WHERE vials.id = audit_log.vial_id)
+        WHERE location_id IS NULL AND vial_id IS NOT NULL
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_asset_action ON audit_log(asset_id, action)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_vial_action ON audit_log(vial_id, action)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_location_timestamp ON audit_log(location_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_action_timestamp ON audit_log(action, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_assets_vial ON audit_log_assets(vial_id)")
+
+
+def migration_004_vial_events(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vial_events (
+            vial_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            user_id INTEGER,
+            location_id INTEGER,
+            transfer_id INTEGER,
+            details TEXT,
+            PRIMARY KEY (vial_id, seq),
+            FOREIGN KEY (vial_id) REFERENCES vials(id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (location_id) REFERENCES locations(id),
+            FOREIGN KEY (transfer_id) REFERENCES transfers(id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Rebuild the history of existing vials from the rows the old journey read
+    events = {}
+
+    def add(vial_id, event_type, timestamp, user_id, location_id, transfer_id=None, details=None):
+        if timestamp is not None:
+            events.setdefault(vial_id, []).append(
+                (str(timestamp), event_type, user_id, location_id, transfer_id, details)
+            )
+
+    transfers = conn.execute("""
+        SELECT ti.vial_id, t.id, t.from_location_id, t.to_location_id, t.status,
+               t.created_by, t.created_at, t.approved_by, t.approved_at,
+               t.completed_by, t.completed_at
+        FROM transfer_items ti
+        JOIN transfers t ON t.id = ti.transfer_id
+        ORDER BY t.created_at
+    """).fetchall()
+    first_source = {}
+    for (vial_id, transfer_id, from_id, to_id, status, created_by, created_at,
+         approved_by, approved_at, completed_by, completed_at) in transfers:
+        first_source.setdefault(vial_id, from_id)
+        add(vial_id, 'TRANSFER_STARTED', created_at, created_by, from_id, transfer_id)
+        add(vial_id, 'TRANSFER_APPROVED', approved_at, approved_by, to_id, transfer_id)
+        add(vial_id, 'TRANSFER_COMPLETED', completed_at, completed_by, to_id, transfer_id)
+
+    vials = conn.execute("""
+        SELECT v.id, v.created_at, v.location_id, v.status, v.used_at, v.used_by,
+               v.patient_mrn, v.clinical_notes, v.discard_reason, v.disposal_register_number,
+               COALESCE(
+                   (SELECT user_id FROM audit_log WHERE asset_id = v.asset_id AND action = 'RECEIVE_STOCK' LIMIT 1),
+                   (SELECT a.user_id FROM audit_log_assets r JOIN audit_log a ON a.id = r.audit_id
+                    WHERE r.asset_id = v.asset_id AND a.action = 'RECEIVE_STOCK' LIMIT 1)
+               )
+        FROM vials v
+    """).fetchall()
+    for (vial_id, created_at, location_id, status, used_at, used_by, patient_mrn,
+         clinical_notes, discard_reason, register_number, received_by) in vials:
+        # A transferred vial was received wherever its first transfer left from
+        add(vial_id, 'CREATED', created_at, received_by, first_source.get(vial_id, location_id))
+        if status == 'USED_CLINICAL':
+            add(vial_id, 'USED', used_at, used_by, location_id, details=json.dumps(
+                {'patient_mrn': patient_mrn, 'clinical_notes': clinical_notes}))
+        elif status == 'DISCARDED':
+            add(vial_id, 'DISCARDED', used_at, used_by, location_id, details=json.dumps(
+                {'discard_reason': discard_reason, 'disposal_register_number': register_number}))
+
+    rows = []
+    for vial_id, history in events.items():
+        history.sort(key=lambda event: event[0])
+        for seq, (timestamp, event_type, user_id, location_id, transfer_id, details) in enumerate(history, 1):
+            rows.append((vial_id, seq, event_type, timestamp, user_id, location_id, transfer_id, details))
+    conn.executemany("""
+        INSERT OR IGNORE INTO vial_events
+            (vial_id, seq, event_type, timestamp, user_id, location_id, transfer_id, details)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def migration_005_asset_sequences(conn):
+    # Next free number per asset ID prefix (drug code + location), see asset_ids.py
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS asset_sequences (
+            prefix TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def migration_006_stock_counts(conn):
+    # Running per location/drug counts, maintained by triggers on vials so
+    # every write path - present and future - keeps them in step
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_counts (
+            location_id INTEGER NOT NULL,
+            drug_id INTEGER NOT NULL,
+            available INTEGER NOT NULL DEFAULT 0,
+            in_transit INTEGER NOT NULL DEFAULT 0,
+            expiring_30 INTEGER NOT NULL DEFAULT 0,
+            expiring_90 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (location_id, drug_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # The expiring_* columns count against fixed cut-off dates rather than
+    # 'now', so additions and removals always agree. The server rolls the
+    # dates forward daily and recomputes those two columns in one transaction.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_counts_window (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            critical_before DATE NOT NULL,
+            warning_before DATE NOT NULL
+        )
+    ''')
+    conn.execute("""
+        INSERT OR IGNORE INTO stock_counts_window (id, critical_before, warning_before)
+        VALUES (1, date('now', '+30 days'), date('now', '+90 days'))
+    """)
+
+    add_new = """
+        INSERT OR IGNORE INTO stock_counts (location_id, drug_id) VALUES (NEW.location_id, NEW.drug_id);
+        UPDATE stock_counts SET
+            available = available + (NEW.status = 'AVAILABLE'),
+            in_transit = in_transit + (NEW.status = 'IN_TRANSIT'),
+            expiring_30 = expiring_30 + (NEW.status = 'AVAILABLE' AND NEW.expiry_date <= (SELECT critical_before FROM stock_counts_window)),
+            expiring_90 = expiring_90 + (NEW.status = 'AVAILABLE' AND NEW.expiry_date <= (SELECT warning_before FROM stock_counts_window))
+        WHERE location_id = NEW.location_id AND drug_id = NEW.drug_id;
+    """
+    remove_old = """
+        UPDATE stock_counts SET
+            available = available - (OLD.status = 'AVAILABLE'),
+            in_transit = in_transit - (OLD.status = 'IN_TRANSIT'),
+            expiring_30 = expiring_30 - (OLD.status = 'AVAILABLE' AND OLD.expiry_date <= (SELECT critical_before FROM stock_counts_window)),
+            expiring_90 = expiring_90 - (OLD.status = 'AVAILABLE' AND OLD.expiry_date <= (SELECT warning_before FROM stock_counts_window))
+        WHERE location_id = OLD.location_id AND drug_id = OLD.drug_id;
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS stock_counts_vial_insert AFTER INSERT ON vials BEGIN {add_new} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS stock_counts_vial_delete AFTER DELETE ON vials BEGIN {remove_old} END")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS stock_counts_vial_update
+        AFTER UPDATE OF status, location_id, drug_id, expiry_date ON vials
+        WHEN OLD.status IS NOT NEW.status OR OLD.location_id IS NOT NEW.location_id
+          OR OLD.drug_id IS NOT NEW.drug_id OR OLD.expiry_date IS NOT NEW.expiry_date
+        BEGIN {remove_old} {add_new} END
+    """)
+
+    conn.execute("DELETE FROM stock_counts")
+    conn.execute("""
+        INSERT INTO stock_counts (location_id, drug_id, available, in_transit, expiring_30, expiring_90)
+        SELECT 
+            location_id, drug_id,
+            SUM(status = 'AVAILABLE'),
+            SUM(status = 'IN_TRANSIT'),
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT critical_before FROM stock_counts_window)),
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT warning_before FROM stock_counts_window))
+        FROM vials
+        WHERE status IN ('AVAILABLE', 'IN_TRANSIT')
+        GROUP BY location_id, drug_id
+    """)
+
+
+def expiry_day_sql(column):
+    """SQL for a date column as a whole day number (days since 1970-01-01)."""
+    return f"CAST(julianday(date({column})) - 2440587.5 AS INTEGER)"
+
+
+def expiry_bucket_sql(column):
+    """SQL classifying a date column against the stock_counts_window cut-offs."""
+    return f"""CASE
+        WHEN date({column}) <= (SELECT critical_before FROM stock_counts_window) THEN 'critical'
+        WHEN date({column}) <= (SELECT warning_before FROM stock_counts_window) THEN 'warning'
+        ELSE 'healthy'
+    END"""
+
+
+def migration_007_expiry_buckets(conn):
+    # expiry_day turns "expiring within N days" into an integer range on an
+    # index. expiry_bucket is stored against the same cut-offs as the
+    # stock_counts expiring_* columns; the server re-buckets the vials that
+    # cross a cut-off when it rolls the window each day.
+    _add_column(conn, 'vials', 'expiry_day', 'INTEGER')
+    _add_column(conn, 'vials', 'expiry_bucket', 'TEXT')
+
+    set_expiry = f"""
+        UPDATE vials SET
+            expiry_day = {expiry_day_sql('NEW.expiry_date')},
+            expiry_bucket = {expiry_bucket_sql('NEW.expiry_date')}
+        WHERE id = NEW.id;
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS vials_expiry_insert AFTER INSERT ON vials BEGIN {set_expiry} END")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS vials_expiry_update
+        AFTER UPDATE OF expiry_date ON vials
+        WHEN OLD.expiry_date IS NOT NEW.expiry_date
+        BEGIN {set_expiry} END
+    """)
+    conn.execute(f"""
+        UPDATE vials SET
+            expiry_day = {expiry_day_sql('expiry_date')},
+            expiry_bucket = {expiry_bucket_sql('expiry_date')}
+    """)
+
+    # The day-number indexes replace the expiry_date ones
+    conn.execute("DROP INDEX IF EXISTS idx_vials_available_expiry")
+    conn.execute("DROP INDEX IF EXISTS idx_vials_available_location_expiry")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_available_expiry_day ON vials(expiry_day) WHERE status = 'AVAILABLE'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_available_location_expiry_day ON vials(location_id, expiry_day) WHERE status = 'AVAILABLE'")
+    # Re-bucketing covers every vial - transfer history shows colours for used ones too
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_expiry_day ON vials(expiry_day)")
+
+
+def migration_008_change_log(conn):
+    # One entry per changed row, written in the transaction that changed it.
+    # A later change to the same row replaces its entry under a new seq, so
+    # the log stays compacted and "everything after seq N" is an index range.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            changed_at TIMESTAMP NOT NULL,
+            UNIQUE (table_name, row_id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_changed_at ON change_log(changed_at)")
+
+    # Entries up to pruned_through have been dropped by retention; a client
+    # that last synced before it has missed changes
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log_horizon (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pruned_through INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO change_log_horizon (id, pruned_through) VALUES (1, 0)")
+
+
+def migration_009_vial_search(conn):
+    # Status-only search walks the newest vials of one status
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vials_status_created ON vials(status, created_at)")
+
+    # Trigram index behind stock search: any substring of three or more
+    # characters is an index lookup instead of a LIKE over every vial.
+    # Without FTS5 (or its trigram tokenizer) search keeps using LIKE.
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS vial_search USING fts5(
+                asset_id, batch_number, drug_name, goods_receipt_number, disposal_register_number,
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Full-text stock search unavailable, falling back to LIKE: {e}")
+        return
+
+    index_new = """
+        INSERT INTO vial_search (rowid, asset_id, batch_number, drug_name, goods_receipt_number, disposal_register_number)
+        VALUES (NEW.id, NEW.asset_id, NEW.batch_number, (SELECT name FROM drugs WHERE id = NEW.drug_id),
+                NEW.goods_receipt_number, NEW.disposal_register_number);
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS vials_search_insert AFTER INSERT ON vials BEGIN {index_new} END")
+    # Status changes (the common update) leave the index alone
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS vials_search_update
+        AFTER UPDATE OF asset_id, batch_number, drug_id, goods_receipt_number, disposal_register_number ON vials
+        BEGIN
+            DELETE FROM vial_search WHERE rowid = OLD.id;
+            {index_new}
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS vials_search_delete AFTER DELETE ON vials
+        BEGIN DELETE FROM vial_search WHERE rowid = OLD.id; END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS drugs_search_update AFTER UPDATE OF name ON drugs
+        BEGIN
+            UPDATE vial_search SET drug_name = NEW.name
+            WHERE rowid IN (SELECT id FROM vials WHERE drug_id = NEW.id);
+        END
+    """)
+
+    conn.execute("DELETE FROM vial_search")
+    conn.execute("""
+        INSERT INTO vial_search (rowid, asset_id, batch_number, drug_name, goods_receipt_number, disposal_register_number)
+        SELECT v.id, v.asset_id, v.batch_number, d.name, v.goods_receipt_number, v.disposal_register_number
+        FROM vials v LEFT JOIN drugs d ON d.id = v.drug_id
+    """)
+
+
+def migration_010_notification_outbox(conn):
+    # Email and SMS are written here in the transaction that causes them and
+    # sent afterwards by the server's dispatcher, so a request never waits
+    # on the mail or SMS provider and a committed alert is never lost
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL CHECK(channel IN ('email', 'sms')),
+            recipient TEXT NOT NULL,
+            subject TEXT,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING' CHECK(status IN ('PENDING', 'SENT', 'FAILED')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            sent_at TIMESTAMP
+        )
+    ''')
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+        ON notification_outbox(channel, next_attempt_at) WHERE status = 'PENDING'
+    """)
+
+
+def migration_011_low_stock_alerts(conn):
+    # Alert state per location/drug: the last level emailed and when, and
+    # whether later drops are waiting for the next digest. Rows are removed
+    # once the pair is back at its minimum.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS low_stock_alerts (
+            location_id INTEGER NOT NULL,
+            drug_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            alerted_at TIMESTAMP NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (location_id, drug_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def migration_012_print_jobs(conn):
+    # Label print jobs, spooled to each printer by a background worker.
+    # printed counts labels already sent, so an interrupted job resumes there.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS print_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location_id INTEGER NOT NULL,
+            printer_ip TEXT NOT NULL,
+            printer_port INTEGER NOT NULL,
+            asset_ids TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'QUEUED'
+                CHECK(status IN ('QUEUED', 'PRINTING', 'DONE', 'FAILED')),
+            total INTEGER NOT NULL,
+            printed INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP NOT NULL,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (location_id) REFERENCES locations(id)
+        )
+    ''')
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_print_jobs_active
+        ON print_jobs(printer_ip, printer_port, id) WHERE status IN ('QUEUED', 'PRINTING')
+    """)
+
+
+# Append new migrations here. Never edit or renumber one that has shipped.
+MIGRATIONS = [
+    (1, 'Baseline schema', migration_001_baseline),
+    (2, 'Secondary indexes for stock, transfer and report queries', migration_002_indexes),
+    (3, 'Structured, indexed audit log columns', migration_003_structured_audit_log),
+    (4, 'Append-only vial event store', migration_004_vial_events),
+    (5, 'Asset ID sequences', migration_005_asset_sequences),
+    (6, 'Trigger-maintained stock counts', migration_006_stock_counts),
+    (7, 'Expiry day numbers and buckets', migration_007_expiry_buckets),
+    (8, 'Row-level change log for delta sync', migration_008_change_log),
+    (9, 'Trigram full-text index for stock search', migration_009_vial_search),
+    (10, 'Notification outbox', migration_010_notification_outbox),
+    (11, 'Low stock alert state', migration_011_low_stock_alerts),
+    (12, 'Label print jobs', migration_012_print_jobs),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ENGINE
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply all pending migrations and return the versions that ran."""
+    # Fast path for a current schema
+    if get_version(conn) >= LATEST_VERSION:
+        return []
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another instance may have migrated while we waited for the lock
+        current = get_version(conn)
+        applied = []
+        for number, description, func in MIGRATIONS:
+            if number <= current:
+                continue
+            logging.info(f"Applying schema migration {number}: {description}")
+            func(conn)
+            applied.append(number)
+        conn.execute(f"PRAGMA user_version = {LATEST_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return applied
+
+
+def schema_status(conn):
+    """Describe the schema version and table layout without changing anything."""
+    current = get_version(conn)
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    return {
+        'version': current,
+        'latest_version': LATEST_VERSION,
+        'pending': [(number, description) for number, description, _ in MIGRATIONS if number > current],
+        'tables': {table: _columns(conn, table) for table in tables}
+    }
+
+
+def connect(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
@@ -0,0 +1,136 @@
+"""Outbound email and SMS transports.
+
+A transport sends one message at a time and keeps its connection between
+messages: SmtpTransport holds one logged-in SMTP session (reconnecting when
+it has gone idle or the server dropped it), TwilioTransport one REST client.
+Transports are not thread-safe; give each sending thread its own.
+
+SinkTransport is the local stand-in. It sends nothing: messages are logged
+and, given a path, appended to it as JSON lines - for tests, and for
+installs without credentials.
+
+send() raises SendError on failure. permanent=True means retrying the same
+message cannot succeed (a rejected recipient, for instance).
+"""
+import json
+import logging
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+class SendError(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def backoff(attempts, base, cap):
+    """Seconds to wait before retry number `attempts`: exponential, capped, jittered."""
+    return min(cap, base * 2 ** max(attempts - 1, 0)) * random.uniform(0.5, 1.0)
+
+
+class SmtpTransport:
+    IDLE_TIMEOUT = 60  # Office 365 drops idle sessions; close ours first
+
+    def __init__(self, host, port, sender, password, timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.timeout = timeout
+        self._smtp = None
+        self._used_at = 0
+
+    def _session(self):
+        if self._smtp is not None and time.monotonic() - self._used_at > self.IDLE_TIMEOUT:
+            self.close()
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                smtp.starttls()
+                smtp.login(self.sender, self.password)
+            except Exception:
+                smtp.close()
+                raise
+            self._smtp = smtp
+        return self._smtp
+
+    def send(self, recipient, subject, body):
+        message = MIMEMultipart("alternative")
+        message["Subject"] = subject or ""
+        message["From"] = self.sender
+        message["To"] = recipient
+        message.attach(MIMEText(body, "plain"))
+
+        # A session the server has dropped only shows up when used: reconnect once
+        for attempt in (1, 2):
+            try:
+                self._session().sendmail(self.sender, recipient, message.as_string())
+                self._used_at = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected as e:
+                self.close()
+                if attempt == 2:
+                    raise SendError(f"SMTP server disconnected: {e}")
+            except smtplib.SMTPRecipientsRefused as e:
+                raise SendError(f"Recipient refused: {e}", permanent=True)
+            except smtplib.SMTPDataError as e:
+                self.close()
+                raise SendError(f"Message rejected: {e}", permanent=e.smtp_code >= 500)
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                raise SendError(f"SMTP error: {e}")
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+
+class TwilioTransport:
+    def __init__(self, account_sid, auth_token, from_number):
+        from twilio.rest import Client
+        self.from_number = from_number
+        self._client = Client(account_sid, auth_token)
+
+    def send(self, recipient, subject, body):
+        from twilio.base.exceptions import TwilioRestException
+        try:
+            message = self._client.messages.create(body=body, from_=self.from_number, to=recipient)
+        except TwilioRestException as e:
+            # 4xx other than rate limiting: bad number, unverified recipient, ...
+            raise SendError(f"Twilio error {e.status}: {e.msg}", permanent=400 <= e.status < 500 and e.status != 429)
+        except Exception as e:
+            raise SendError(f"Twilio request failed: {e}")
+        logging.info(f"SMS sent to {recipient}: {message.sid}")
+
+    def close(self):
+        pass
+
+
+class SinkTransport:
+    _file_lock = threading.Lock()
+
+    def __init__(self, channel, path=None):
+        self.channel = channel
+        self.path = path
+
+    def send(self, recipient, subject, body):
+        if self.path is None:
+            logging.info(f"--- {self.channel.upper()} SINK (not sent) ---\nTo: {recipient}\nSubject: {subject}\nBody:\n{body}\n--------------------------------")
+            return
+        record = {'channel': self.channel, 'to': recipient, 'subject': subject, 'body': body,
+                  'at': datetime.now().isoformat()}
+        with self._file_lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        pass
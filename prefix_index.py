@@ -0,0 +1,187 @@
+"""In-memory prefix index for barcode scans and typeahead.
+
+Asset IDs, batch numbers and drug names are kept upper-cased in sorted
+lists, so every key starting with a prefix is one contiguous slice found
+with two binary searches. Each vial also carries its status and location,
+so a lookup never touches the database.
+
+The index only knows what it is told: load() fills it from full table reads
+and put_vial()/put_drug() keep it current as writes commit. Updates that
+arrive while a load is reading are replayed over the loaded data, so a load
+can run alongside the write path.
+"""
+import bisect
+import threading
+
+MAX_SCAN = 5000  # entries a single lookup may walk past the scope filters
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._assets = []  # sorted (ASSET_ID, vial_id)
+        self._batches = []  # sorted (BATCH_NUMBER, drug_id, batch_number)
+        self._drugs = []  # sorted (NAME, drug_id)
+        self._vials = {}  # vial_id -> (asset_id, batch_number, drug_id, status, location_id)
+        self._batch_vials = {}  # (batch_number, drug_id) -> vial ids
+        self._drug_names = {}  # drug_id -> name
+        self._pending = None  # updates made while a load is reading
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loaded = False
+        self.stats = {'loads': 0, 'lookups': 0, 'updates': 0}
+
+    @staticmethod
+    def _insert(keys, entry):
+        i = bisect.bisect_left(keys, entry)
+        if i == len(keys) or keys[i] != entry:
+            keys.insert(i, entry)
+
+    @staticmethod
+    def _remove(keys, entry):
+        i = bisect.bisect_left(keys, entry)
+        if i < len(keys) and keys[i] == entry:
+            del keys[i]
+
+    @staticmethod
+    def _range(keys, prefix):
+        return bisect.bisect_left(keys, (prefix,)), bisect.bisect_left(keys, (prefix + '\uffff',))
+
+    def load(self, fetch):
+        """Rebuild from fetch(), which returns (vials, drugs): rows of
+        (id, asset_id, batch_number, drug_id, status, location_id) and (id, name)."""
+        with self._load_lock:
+            with self._lock:
+                self._pending = {}
+            try:
+                vials, drugs = fetch()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            vials = {row[0]: tuple(row[1:]) for row in vials}
+            drug_names = {row[0]: row[1] for row in drugs}
+
+            with self._lock:
+                for kind, key, values in self._pending.values():
+                    if kind == 'drug':
+                        drug_names[key] = values
+                    elif values is None:
+                        vials.pop(key, None)
+                    else:
+                        vials[key] = values
+                self._pending = None
+
+                batch_vials = {}
+                for vial_id, (_, batch_number, drug_id, _, _) in vials.items():
+                    batch_vials.setdefault((batch_number, drug_id), set()).add(vial_id)
+                self._vials = vials
+                self._batch_vials = batch_vials
+                self._drug_names = drug_names
+                self._assets = sorted((values[0].upper(), vial_id) for vial_id, values in vials.items())
+                self._batches = sorted((batch_number.upper(), drug_id, batch_number) for batch_number, drug_id in batch_vials)
+                self._drugs = sorted((name.upper(), drug_id) for drug_id, name in drug_names.items())
+                self.loaded = True
+                self.stats['loads'] += 1
+
+    def _drop_vial(self, vial_id):
+        # Caller holds the lock
+        old = self._vials.pop(vial_id, None)
+        if old is None:
+            return
+        self._remove(self._assets, (old[0].upper(), vial_id))
+        batch = (old[1], old[2])
+        members = self._batch_vials.get(batch)
+        if members is not None:
+            members.discard(vial_id)
+            if not members:
+                del self._batch_vials[batch]
+                self._remove(self._batches, (old[1].upper(), old[2], old[1]))
+
+    def put_vial(self, vial_id, asset_id, batch_number, drug_id, status, location_id):
+        values = (asset_id, batch_number, drug_id, status, location_id)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[('vial', vial_id)] = ('vial', vial_id, values)
+            self._drop_vial(vial_id)
+            self._vials[vial_id] = values
+            self._insert(self._assets, (asset_id.upper(), vial_id))
+            batch = (batch_number, drug_id)
+            if batch not in self._batch_vials:
+                self._batch_vials[batch] = set()
+                self._insert(self._batches, (batch_number.upper(), drug_id, batch_number))
+            self._batch_vials[batch].add(vial_id)
+            self.stats['updates'] += 1
+
+    def remove_vial(self, vial_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[('vial', vial_id)] = ('vial', vial_id, None)
+            self._drop_vial(vial_id)
+            self.stats['updates'] += 1
+
+    def put_drug(self, drug_id, name):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[('drug', drug_id)] = ('drug', drug_id, name)
+            old = self._drug_names.get(drug_id)
+            if old is not None:
+                self._remove(self._drugs, (old.upper(), drug_id))
+            self._drug_names[drug_id] = name
+            self._insert(self._drugs, (name.upper(), drug_id))
+            self.stats['updates'] += 1
+
+    def lookup(self, prefix, limit=10, location_id=None, status=None):
+        """Asset IDs, batches and drugs starting with prefix (case-insensitive).
+
+        location_id and status narrow the assets and batches; a batch is
+        listed if any of its vials is in scope.
+        """
+        prefix = prefix.strip().upper()
+        result = {'assets': [], 'batches': [], 'drugs': []}
+        if not prefix:
+            return result
+
+        def in_scope(values):
+            return ((location_id is None or values[4] == location_id)
+                    and (status is None or values[3] == status))
+
+        with self._lock:
+            self.stats['lookups'] += 1
+            lo, hi = self._range(self._assets, prefix)
+            for _, vial_id in self._assets[lo:min(hi, lo + MAX_SCAN)]:
+                values = self._vials[vial_id]
+                if in_scope(values):
+                    asset_id, batch_number, drug_id, vial_status, vial_location = values
+                    result['assets'].append({
+                        'vial_id': vial_id,
+                        'asset_id': asset_id,
+                        'batch_number': batch_number,
+                        'drug_id': drug_id,
+                        'drug_name': self._drug_names.get(drug_id),
+                        'status': vial_status,
+                        'location_id': vial_location
+                    })
+                    if len(result['assets']) == limit:
+                        break
+
+            lo, hi = self._range(self._batches, prefix)
+            for _, drug_id, batch_number in self._batches[lo:min(hi, lo + MAX_SCAN)]:
+                members = self._batch_vials[(batch_number, drug_id)]
+                if any(in_scope(self._vials[vial_id]) for vial_id in members):
+                    result['batches'].append({
+                        'batch_number': batch_number,
+                        'drug_id': drug_id,
+                        'drug_name': self._drug_names.get(drug_id)
+                    })
+                    if len(result['batches']) == limit:
+                        break
+
+            lo, hi = self._range(self._drugs, prefix)
+            result['drugs'] = [{'drug_id': drug_id, 'name': self._drug_names[drug_id]}
+                               for _, drug_id in self._drugs[lo:min(hi, lo + limit)]]
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, loaded=self.loaded, vials=len(self._vials),
+                        batches=len(self._batches), drugs=len(self._drugs))
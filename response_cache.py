@@ -0,0 +1,127 @@
+"""In-process cache for read endpoint responses.
+
+Entries are keyed by endpoint and request parameters and tagged with the
+tables the response was built from. Every table has a version number that
+is bumped when a committed write touches it; entries tagged with that table
+are dropped, and a response computed while the write was in flight is never
+stored because the versions it started from are out of date by then.
+
+Memory is bounded by max_bytes (least recently used entries go first) and
+max_age catches writes made by other processes, which never bump versions here
+unless the caller notices them and calls invalidate_all().
+
+The same versions double as HTTP validators: validator() returns them with
+the time any of the tables last changed.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_AGE = 300
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (tables, stored_at, value, size), oldest use first
+        self._by_table = {}  # table -> keys of entries built from it
+        self._versions = {}
+        self._epoch = 0  # bumped by invalidate_all(), part of every version
+        self._changed_at = {}
+        self._epoch_at = time.time()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'stale_stores': 0,
+                      'invalidated': 0, 'expired': 0, 'evicted': 0, 'too_large': 0}
+
+    def _current(self, tables):
+        return (self._epoch,) + tuple(self._versions.get(table, 0) for table in tables)
+
+    def _drop(self, key):
+        tables, _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+    def versions(self, tables):
+        """Table versions to hand back to put() once the response is built."""
+        with self._lock:
+            return self._current(tables)
+
+    def validator(self, tables):
+        """(versions, changed_at): versions as for put(), and the time.time()
+        at which one of tables last changed."""
+        with self._lock:
+            changed_at = max([self._changed_at.get(table, 0) for table in tables] + [self._epoch_at])
+            return self._current(tables), changed_at
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.max_age:
+                self._drop(key)
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def put(self, key, tables, versions, value, size):
+        """Store value unless one of its tables was written since versions()."""
+        with self._lock:
+            if self._current(tables) != versions:
+                self.stats['stale_stores'] += 1
+                return False
+            if size > self.max_bytes:
+                self.stats['too_large'] += 1
+                return False
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (tuple(tables), time.monotonic(), value, size)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats['evicted'] += 1
+            self.stats['stores'] += 1
+            return True
+
+    def invalidate(self, tables):
+        with self._lock:
+            now = time.time()
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._changed_at[table] = now
+                for key in list(self._by_table.pop(table, ())):
+                    if key in self._entries:
+                        self._drop(key)
+                        self.stats['invalidated'] += 1
+
+    def invalidate_all(self):
+        """Drop everything, for writes that cannot be tied to tables."""
+        with self._lock:
+            self._epoch += 1
+            self._epoch_at = time.time()
+            self.stats['invalidated'] += len(self._entries)
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                hit_rate=self.stats['hits'] / lookups if lookups else 0.0
+            )
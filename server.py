@@ -1,20 +1,26 @@
-import os, sys, time, threading, sqlite3, shutil, queue, socket, glob
+import os, sys, time, threading, sqlite3, queue, socket, glob
+import functools
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import base64
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, has_app_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import logging
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
-from twilio.rest import Client
 from dotenv import load_dotenv
+import migrations
+from asset_ids import AssetIdAllocator, asset_prefix
+from response_cache import ResponseCache
+from prefix_index import PrefixIndex
+from notifications import SendError, SmtpTransport, TwilioTransport, SinkTransport, backoff
 
 # Load environment variables from .env file
 load_dotenv()
@@ -27,9 +33,11 @@ else:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     STATIC_FOLDER = os.path.join(BASE_DIR, 'frontend', 'build')
 
-DB_FILE = os.path.join(BASE_DIR, 'sys_data.dat')
-BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
-LOG_FILE = os.path.join(BASE_DIR, 'debug_log.txt')
+# Database, backups and log live next to the app unless DATA_DIR says otherwise
+DATA_DIR = os.environ.get('DATA_DIR', BASE_DIR)
+DB_FILE = os.path.join(DATA_DIR, 'sys_data.dat')
+BACKUP_DIR = os.path.join(DATA_DIR, 'backups')
+LOG_FILE = os.path.join(DATA_DIR, 'debug_log.txt')
 
 # Create backup directory if it doesn't exist
 os.makedirs(BACKUP_DIR, exist_ok=True)
@@ -42,237 +50,726 @@ app = Flask(__name__, static_folder=STATIC_FOLDER, static_url_path='/')
 CORS(app)
 
 # 1. WRITE QUEUE for concurrent access
-write_queue = queue.Queue()
+# Priority lanes: lower runs first. Clinical use/discard must never wait behind
+# a bulk receipt or a stock level import.
+PRIORITY_CLINICAL = 0
+PRIORITY_TRANSFER = 1
+PRIORITY_ADMIN = 2
+PRIORITY_NAMES = {PRIORITY_CLINICAL: 'clinical', PRIORITY_TRANSFER: 'transfer', PRIORITY_ADMIN: 'admin'}
+
+# Seconds a caller will wait for its write before getting a 504
+WRITE_TIMEOUTS = {PRIORITY_CLINICAL: 30, PRIORITY_TRANSFER: 30, PRIORITY_ADMIN: 60}
+
+# Backpressure: lower lanes are shed first as the queue fills up
+WRITE_QUEUE_MAX_DEPTH = int(os.environ.get('WRITE_QUEUE_MAX_DEPTH', 200))
+WRITE_QUEUE_SHED_AT = {PRIORITY_CLINICAL: 1.0, PRIORITY_TRANSFER: 0.75, PRIORITY_ADMIN: 0.5}
+
+# Everything already queued is committed together, up to this many operations
+WRITE_BATCH_MAX = 100
+
+write_queue = queue.PriorityQueue()
+_write_seq = iter(range(1, sys.maxsize))  # FIFO tie-break within a lane
+
+write_stats = {
+    'batches': 0,
+    'operations': 0,
+    'failed_operations': 0,
+    'failed_batches': 0,
+    'max_batch': 0
+}
+lane_stats = {
+    name: {
+        'submitted': 0,
+        'shed': 0,
+        'timed_out': 0,
+        'completed': 0,
+        'queue_wait_total_ms': 0.0,
+        'queue_wait_max_ms': 0.0,
+        'exec_total_ms': 0.0,
+        'exec_max_ms': 0.0
+    }
+    for name in PRIORITY_NAMES.values()
+}
+_stats_lock = threading.Lock()
+
+class WriteQueueFull(Exception):
+    pass
+
+class WriteTimeout(Exception):
+    pass
+
+class _WriteRequest:
+    def __init__(self, func, args, priority, timeout):
+        self.func = func
+        self.args = args
+        self.lane = PRIORITY_NAMES[priority]
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout
+        self.result = queue.Queue(maxsize=1)
+        self.state = 'queued'
+        self._lock = threading.Lock()
+
+    def transition(self, from_state, to_state):
+        # The caller (on timeout) and the worker (on pickup) race for a queued request
+        with self._lock:
+            if self.state != from_state:
+                return False
+            self.state = to_state
+            return True
+
+# Called with the changes of every committed batch, in the worker thread.
+# Hooks must be quick: the next batch waits for them.
+_commit_hooks = []
+
+def on_commit(hook):
+    _commit_hooks.append(hook)
+    return hook
+
+def record_change(table, row_id=None, location_id=None):
+    """Note what the running write operation touched.
+
+    Changes reach the commit hooks only if the batch commits; an operation
+    that rolls back to its savepoint takes its changes with it. Changes with
+    a row_id to a table in CHANGE_LOG_ROWS also go into the change log, in
+    the same transaction. Outside the write queue worker this does nothing.
+    """
+    changes = getattr(_local, 'changes', None)
+    if changes is not None:
+        changes.append({'table': table, 'row_id': row_id, 'location_id': location_id})
+
+def _log_changes(conn, changes):
+    # Replacing moves a row's entry to the end of the log under a new seq
+    rows = dict.fromkeys(
+        (change['table'], change['row_id']) for change in changes
+        if change['row_id'] is not None and change['table'] in CHANGE_LOG_ROWS
+    )
+    if rows:
+        now = datetime.now()
+        conn.executemany(
+            "INSERT OR REPLACE INTO change_log (table_name, row_id, changed_at) VALUES (?, ?, ?)",
+            [(table, row_id, now) for table, row_id in rows]
+        )
+
+def _run_commit_hooks(changes):
+    for hook in _commit_hooks:
+        try:
+            hook(changes)
+        except Exception as e:
+            logging.error(f"Commit hook {hook.__name__} failed: {str(e)}")
+
+class _WriterSession:
+    """Writer connection as seen by logic functions running in the worker.
+
+    The worker owns the transaction, so commit() and the implicit commit of
+    `with get_db() as conn:` are deferred until the whole batch has run.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_local.conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def commit(self):
+        pass
 
 def worker():
+    # The worker owns the single writer connection for the life of the process
+    _local.conn = _connect()
+    _local.checked_at = time.time()
+    _local.storage_generation = _storage_generation
+    _local.session = _WriterSession()
     while True:
-        func, args, res_q = write_queue.get()
+        batch = _claim([write_queue.get()[2]])
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.extend(_claim([write_queue.get_nowait()[2]]))
+            except queue.Empty:
+                break
+
+        if batch:
+            _ensure_writer()
+            for req, result in _run_batch(batch):
+                req.result.put(result)
+
+def _claim(requests):
+    # Drop requests whose caller has given up; nothing is written for them
+    claimed = []
+    now = time.monotonic()
+    for req in requests:
+        if now > req.deadline and req.transition('queued', 'expired'):
+            req.result.put(WriteTimeout("Write expired in queue"))
+            continue
+        if req.transition('queued', 'running'):
+            with _stats_lock:
+                stats = lane_stats[req.lane]
+                wait_ms = (now - req.enqueued_at) * 1000
+                stats['queue_wait_total_ms'] += wait_ms
+                stats['queue_wait_max_ms'] = max(stats['queue_wait_max_ms'], wait_ms)
+            claimed.append(req)
+    return claimed
+
+def _run_batch(batch):
+    # One transaction per batch, one savepoint per operation: a failing operation
+    # is rolled back on its own and the rest still commit with a single fsync
+    conn = _local.conn
+    results = []
+    changes = []
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for req in batch:
+            conn.execute("SAVEPOINT write_op")
+            start = time.perf_counter()
+            _local.changes = []
+            try:
+                result = req.func(*req.args)
+                _log_changes(conn, _local.changes)
+                changes.extend(_local.changes)
+            except Exception as e:
+                logging.error(f"Write queue error: {str(e)}")
+                conn.execute("ROLLBACK TO write_op")
+                asset_allocator.reset()
+                write_stats['failed_operations'] += 1
+                result = e
+            finally:
+                _local.changes = None
+            conn.execute("RELEASE write_op")
+            exec_ms = (time.perf_counter() - start) * 1000
+            with _stats_lock:
+                stats = lane_stats[req.lane]
+                stats['completed'] += 1
+                stats['exec_total_ms'] += exec_ms
+                stats['exec_max_ms'] = max(stats['exec_max_ms'], exec_ms)
+            results.append((req, result))
+        conn.commit()
+    except Exception as e:
+        # Nothing in this batch reached the database
+        logging.error(f"Write batch of {len(batch)} failed: {str(e)}")
         try:
-            res_q.put(func(*args))
-        except Exception as e:
-            logging.error(f"Write queue error: {str(e)}")
-            res_q.put(e)
-        finally:
-            write_queue.task_done()
+            conn.rollback()
+        except sqlite3.Error:
+            pass
+        asset_allocator.reset()
+        write_stats['failed_batches'] += 1
+        return [(req, e) for req in batch]
 
-threading.Thread(target=worker, daemon=True).start()
+    try:
+        external_writes.ours()
+    except sqlite3.Error as e:
+        logging.error(f"Could not read data_version after commit: {str(e)}")
+    write_stats['batches'] += 1
+    write_stats['operations'] += len(batch)
+    write_stats['max_batch'] = max(write_stats['max_batch'], len(batch))
+    if changes:
+        _run_commit_hooks(changes)
+    return results
+
+def queue_write(func, *args, priority=PRIORITY_ADMIN, timeout=None):
+    lane = PRIORITY_NAMES[priority]
+    if write_queue.qsize() >= WRITE_QUEUE_MAX_DEPTH * WRITE_QUEUE_SHED_AT[priority]:
+        with _stats_lock:
+            lane_stats[lane]['shed'] += 1
+        raise WriteQueueFull(f"Write queue is full ({lane} writes are being shed)")
+
+    req = _WriteRequest(func, args, priority, timeout or WRITE_TIMEOUTS[priority])
+    with _stats_lock:
+        lane_stats[lane]['submitted'] += 1
+    write_queue.put((priority, next(_write_seq), req))
 
-def queue_write(func, *args):
-    q = queue.Queue()
-    write_queue.put((func, args, q))
-    res = q.get()
+    try:
+        res = req.result.get(timeout=max(req.deadline - time.monotonic(), 0))
+    except queue.Empty:
+        if req.transition('queued', 'cancelled'):
+            with _stats_lock:
+                lane_stats[lane]['timed_out'] += 1
+            raise WriteTimeout(f"Write did not start within {timeout or WRITE_TIMEOUTS[priority]}s")
+        # Already running (or just expired) - the outcome is on its way
+        res = req.result.get()
+
+    if isinstance(res, WriteTimeout):
+        with _stats_lock:
+            lane_stats[lane]['timed_out'] += 1
     if isinstance(res, Exception):
         raise res
     return res
 
+def write_queue_snapshot():
+    with _stats_lock:
+        lanes = {name: dict(stats) for name, stats in lane_stats.items()}
+    return dict(write_stats, depth=write_queue.qsize(), lanes=lanes)
+
+@app.errorhandler(WriteQueueFull)
+def handle_write_queue_full(e):
+    logging.warning(f"Write rejected: {str(e)}")
+    return jsonify({"error": "Server is busy, please try again"}), 503
+
+@app.errorhandler(WriteTimeout)
+def handle_write_timeout(e):
+    logging.warning(f"Write timed out: {str(e)}")
+    return jsonify({"error": "The request timed out, please try again"}), 504
+
 # 2. DB HELPERS
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_HEALTH_CHECK_INTERVAL = 30  # Seconds a connection may sit idle before it is re-validated
+
+# Storage profiles. journal_mode is a property of the database file and is
+# switched once at startup; the remaining settings are applied per connection.
+STORAGE_PROFILES = {
+    # Rollback journal - the only safe choice when sys_data.dat lives on a network share
+    'legacy': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000, 'mmap_size': 0},
+    # WAL with fsync on every commit
+    'wal_safe': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'cache_size': -16000, 'mmap_size': 67108864},
+    # WAL with fsync at checkpoints only (committed data survives an app crash, not a power cut)
+    'wal': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -16000, 'mmap_size': 67108864},
+}
+
+def _is_network_path(path):
+    if path.startswith('\\\\'):
+        return True
+    if sys.platform == 'win32':
+        import ctypes
+        drive = os.path.splitdrive(os.path.abspath(path))[0]
+        DRIVE_REMOTE = 4
+        return bool(drive) and ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == DRIVE_REMOTE
+    return False
+
+def _load_storage_profile():
+    name = os.environ.get('DB_STORAGE_PROFILE', 'wal').lower()
+    if name not in STORAGE_PROFILES:
+        logging.warning(f"Unknown DB_STORAGE_PROFILE '{name}' - using 'wal'")
+        name = 'wal'
+
+    # WAL relies on shared memory, which does not work across machines
+    if STORAGE_PROFILES[name]['journal_mode'] == 'WAL' and _is_network_path(DB_FILE):
+        logging.warning(f"{DB_FILE} is on a network drive - WAL is unsafe there, using 'legacy' storage profile")
+        name = 'legacy'
+
+    profile = dict(STORAGE_PROFILES[name], name=name)
+    profile['synchronous'] = os.environ.get('DB_SYNCHRONOUS', profile['synchronous']).upper()
+    profile['cache_size'] = int(os.environ.get('DB_CACHE_SIZE', profile['cache_size']))
+    profile['mmap_size'] = int(os.environ.get('DB_MMAP_SIZE', profile['mmap_size']))
+    if profile['synchronous'] not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f"Invalid DB_SYNCHRONOUS value: {profile['synchronous']}")
+    return profile
+
+STORAGE = _load_storage_profile()
+
+_local = threading.local()
+_storage_generation = 0  # bumped when apply_storage_profile() changes the journal mode
+
+class PoolTimeout(Exception):
+    pass
+
+def _synchronous_for(journal_mode):
+    # The profile's setting assumes its journal mode. A file left in rollback
+    # journal mode (conversion to WAL deferred) needs FULL to survive a power cut.
+    journal_mode = journal_mode.upper()
+    if journal_mode != STORAGE['journal_mode'] and journal_mode != 'WAL':
+        return STORAGE_PROFILES['legacy']['synchronous']
+    return STORAGE['synchronous']
+
+def _connect():
+    # PRAGMAs are per-connection, so they are applied exactly once here
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA busy_timeout = 30000")
-    conn.execute("PRAGMA journal_mode = DELETE")
-    conn.execute("PRAGMA synchronous = FULL")
+    if STORAGE['journal_mode'] != 'WAL':
+        journal_mode = conn.execute(f"PRAGMA journal_mode = {STORAGE['journal_mode']}").fetchone()[0]
+    else:
+        # WAL is persistent in the file and is set once by apply_storage_profile()
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.execute(f"PRAGMA synchronous = {_synchronous_for(journal_mode)}")
+    conn.execute(f"PRAGMA cache_size = {STORAGE['cache_size']}")
+    conn.execute(f"PRAGMA mmap_size = {STORAGE['mmap_size']}")
     return conn
 
-# 3. DATABASE INITIALIZATION
-def init_db():
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT NOT NULL CHECK(role IN ('PHARMACIST', 'PHARMACY_TECH', 'NURSE')),
-                location_id INTEGER NOT NULL,
-                can_delegate BOOLEAN DEFAULT 0,
-                is_supervisor BOOLEAN DEFAULT 0,
-                email TEXT,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                version INTEGER DEFAULT 1,
-                FOREIGN KEY (location_id) REFERENCES locations(id)
-            )
-        ''')
-        
-        # Locations table (Hub pharmacies, wards, remote sites)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS locations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL CHECK(type IN ('HUB', 'WARD', 'REMOTE')),
-                parent_hub_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                version INTEGER DEFAULT 1,
-                FOREIGN KEY (parent_hub_id) REFERENCES locations(id)
-            )
-        ''')
-        
-        # Drug catalog
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS drugs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                category TEXT,
-                storage_temp TEXT,
-                unit_price REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                version INTEGER DEFAULT 1
-            )
-        ''')
-        
-        # Stock levels per location
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stock_levels (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                location_id INTEGER NOT NULL,
-                drug_id INTEGER NOT NULL,
-                min_stock INTEGER DEFAULT 0,
-                version INTEGER DEFAULT 1,
-                FOREIGN KEY (location_id) REFERENCES locations(id),
-                FOREIGN KEY (drug_id) REFERENCES drugs(id),
-                UNIQUE(location_id, drug_id)
-            )
-        ''')
-        
-        # Individual vial tracking
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS vials (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                asset_id TEXT UNIQUE NOT NULL,
-                drug_id INTEGER NOT NULL,
-                batch_number TEXT NOT NULL,
-                expiry_date DATE NOT NULL,
-                location_id INTEGER NOT NULL,
-                status TEXT NOT NULL DEFAULT 'AVAILABLE' 
-                    CHECK(status IN ('AVAILABLE', 'USED_CLINICAL', 'DISCARDED', 'IN_TRANSIT')),
-                discard_reason TEXT,
-                patient_mrn TEXT,
-                clinical_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                used_at TIMESTAMP,
-                used_by INTEGER,
-                version INTEGER DEFAULT 1,
-                FOREIGN KEY (drug_id) REFERENCES drugs(id),
-                FOREIGN KEY (location_id) REFERENCES locations(id),
-                FOREIGN KEY (used_by) REFERENCES users(id)
-            )
-        ''')
-        
-        # Add columns to existing vials table if they don't exist
-        try:
-            cursor.execute("ALTER TABLE vials ADD COLUMN patient_mrn TEXT")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
-        
-        try:
-            cursor.execute("ALTER TABLE vials ADD COLUMN clinical_notes TEXT")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
+def apply_storage_profile():
+    """Convert the database file to the configured journal mode.
 
-        # Add completed_by column to transfers table if it doesn't exist
-        try:
-            cursor.execute("ALTER TABLE transfers ADD COLUMN completed_by INTEGER REFERENCES users(id)")
-        except sqlite3.OperationalError:
-            pass
+    Runs once at startup before init_db(). An existing file is integrity
+    checked and backed up before its journal mode is changed; if another
+    instance still has it open the conversion is skipped and retried on the
+    next start.
+    """
+    global _storage_generation
+    target = STORAGE['journal_mode']
+    # Threads started at import may already have opened (and so created) an empty file
+    is_new = not os.path.exists(DB_FILE) or os.path.getsize(DB_FILE) == 0
 
-        # Add is_supervisor column to users table if it doesn't exist
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN is_supervisor BOOLEAN DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
+    conn = sqlite3.connect(DB_FILE, timeout=5)
+    current = None
+    try:
+        current = conn.execute("PRAGMA journal_mode").fetchone()[0].upper()
+        if current == target:
+            return
+
+        if not is_new:
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            if check != 'ok':
+                logging.error(f"Skipping journal mode conversion - quick_check failed: {check}")
+                return
+            perform_backup()
+
+        new_mode = conn.execute(f"PRAGMA journal_mode = {target}").fetchone()[0].upper()
+        if new_mode == target:
+            logging.info(f"Database journal mode converted from {current} to {new_mode} (profile '{STORAGE['name']}')")
+            # Connections opened before the switch chose their PRAGMAs for the old mode
+            db_pool.discard_idle()
+            _storage_generation += 1
+        else:
+            logging.warning(f"Could not switch journal mode to {target} (still {new_mode}) - database may be open elsewhere")
+        current = new_mode
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Journal mode conversion deferred: {str(e)}")
+    finally:
+        conn.close()
+        if current is not None and current != target:
+            # Until the next start, run with the journal mode the file is actually in
+            STORAGE['synchronous'] = _synchronous_for(current)
+            STORAGE['journal_mode'] = current
+
+def _is_healthy(conn):
+    try:
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except sqlite3.Error:
+        return False
 
-        # Add must_change_password column to users table if it doesn't exist
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN must_change_password BOOLEAN DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
+class ConnectionPool:
+    """Bounded pool of long-lived reader connections.
+
+    A request checks a connection out on its first get_db() call and hands it
+    back when the app context is torn down. Connections that have been idle
+    longer than DB_HEALTH_CHECK_INTERVAL are pinged before reuse and replaced
+    if they no longer respond.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._idle = []  # LIFO of (conn, last_used) so hot connections stay hot
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0
+        }
+
+    def acquire(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_total_ms'] += waited_ms
+            self._stats['wait_max_ms'] = max(self._stats['wait_max_ms'], waited_ms)
+            conn, last_used = self._idle.pop() if self._idle else (None, None)
 
-        # Add reset_token and reset_token_expiry columns
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN reset_token TEXT")
-        except sqlite3.OperationalError:
-            pass
-            
+            if conn is not None and time.time() - last_used > DB_HEALTH_CHECK_INTERVAL and not _is_healthy(conn):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = _connect()
+                with self._lock:
+                    self._stats['created'] += 1
+            return conn
+        except Exception:
+            self._give_back_slot()
+            raise
+
+    def release(self, conn):
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN reset_token_expiry TIMESTAMP")
-        except sqlite3.OperationalError:
-            pass
-
-        # Add mobile_number column
+            # Never hand a connection with a dangling transaction to the next request
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        self._give_back_slot()
+
+    def discard_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _close(self, conn):
+        with self._lock:
+            self._stats['discarded'] += 1
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN mobile_number TEXT")
-        except sqlite3.OperationalError:
+            conn.close()
+        except sqlite3.Error:
             pass
 
-        # Add goods_receipt_number to vials
-        try:
-            cursor.execute("ALTER TABLE vials ADD COLUMN goods_receipt_number TEXT")
-        except sqlite3.OperationalError:
-            pass
+    def _give_back_slot(self):
+        with self._lock:
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['size'] = self.size
+        stats['wait_avg_ms'] = stats['wait_total_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
 
-        # Add disposal_register_number to vials
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+def get_db():
+    # The write_queue worker always uses its dedicated writer connection
+    session = getattr(_local, 'session', None)
+    if session is not None:
+        return session
+
+    # Request threads borrow one pooled connection for the whole request
+    if has_app_context():
+        if 'db' not in g:
+            g.db = db_pool.acquire()
+        return g.db
+
+    # Startup and maintenance code runs outside a request
+    return _connect()
+
+def _ensure_writer():
+    if _local.storage_generation != _storage_generation:
+        # Opened before the journal mode switch: reconnect to pick up its PRAGMAs
         try:
-            cursor.execute("ALTER TABLE vials ADD COLUMN disposal_register_number TEXT")
-        except sqlite3.OperationalError:
+            _local.conn.close()
+        except sqlite3.Error:
             pass
+        _local.conn = _connect()
+        _local.storage_generation = _storage_generation
+        _local.checked_at = time.time()
+    if time.time() - _local.checked_at > DB_HEALTH_CHECK_INTERVAL:
+        if not _is_healthy(_local.conn):
+            logging.warning("Writer connection failed health check - reconnecting")
+            try:
+                _local.conn.close()
+            except sqlite3.Error:
+                pass
+            _local.conn = _connect()
+        _local.checked_at = time.time()
+
+def log_audit(cursor, user_id, action, details, vial_id=None, asset_id=None, location_id=None):
+    # The indexed columns are what lookups use; details keeps the full context
+    cursor.execute("""
+        INSERT INTO audit_log (user_id, action, details, timestamp, vial_id, asset_id, location_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, action, json.dumps(details), datetime.now(), vial_id, asset_id, location_id))
+
+def record_vial_event(cursor, vial_id, event_type, user_id, location_id, transfer_id=None, details=None):
+    # Append to the vial's history; seq is the next slot in its (vial_id, seq) range
+    cursor.execute("""
+        INSERT INTO vial_events (vial_id, seq, event_type, timestamp, user_id, location_id, transfer_id, details)
+        SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ?, ?, ?
+        FROM vial_events WHERE vial_id = ?
+    """, (vial_id, event_type, datetime.now(), user_id, location_id, transfer_id,
+          json.dumps(details) if details else None, vial_id))
+
+TRANSFER_EVENTS = {
+    'approve': 'TRANSFER_APPROVED',
+    'complete': 'TRANSFER_COMPLETED',
+    'cancel': 'TRANSFER_CANCELLED'
+}
+
+def record_transfer_events(cursor, transfer_id, event_type, user_id, location_id):
+    # One event for every vial on the transfer, in a single statement
+    cursor.execute("""
+        INSERT INTO vial_events (vial_id, seq, event_type, timestamp, user_id, location_id, transfer_id)
+        SELECT ti.vial_id,
+               COALESCE((SELECT MAX(seq) FROM vial_events e WHERE e.vial_id = ti.vial_id), 0) + 1,
+               ?, ?, ?, ?, ti.transfer_id
+        FROM transfer_items ti
+        WHERE ti.transfer_id = ?
+    """, (event_type, datetime.now(), user_id, location_id, transfer_id))
+
+# Expiry buckets. vials.expiry_day and vials.expiry_bucket are kept by
+# triggers (migrations.py); the bucket cut-offs are the stock_counts_window
+# dates, which roll_expiry_window moves forward each day.
+EXPIRY_CRITICAL_DAYS = 30
+EXPIRY_WARNING_DAYS = 90
+EXPIRY_COLOR_SQL = "CASE v.expiry_bucket WHEN 'critical' THEN 'red' WHEN 'warning' THEN 'amber' ELSE 'green' END"
+EPOCH = datetime(1970, 1, 1)
+
+def day_number(value):
+    # Whole days since 1970-01-01, as stored in vials.expiry_day
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], '%Y-%m-%d')
+    return (value - EPOCH).days
+
+def today_day():
+    return day_number(datetime.utcnow())
+
+def expiry_bucket(days_left):
+    if days_left <= EXPIRY_CRITICAL_DAYS:
+        return 'critical'
+    if days_left <= EXPIRY_WARNING_DAYS:
+        return 'warning'
+    return 'healthy'
+
+# Response cache for polled read endpoints. Writes through the queue record
+# the tables they touch (record_change); the commit hook below drops every
+# cached response built from one of them.
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_MB', 32)) * 1024 * 1024,
+    max_age=int(os.environ.get('RESPONSE_CACHE_MAX_AGE', 300))
+)
+
+@on_commit
+def _invalidate_response_cache(changes):
+    response_cache.invalidate({change['table'] for change in changes})
+
+class ExternalWriteWatch:
+    """Notices commits made by other processes, via PRAGMA data_version.
+
+    data_version changes whenever a connection other than the one asking
+    commits, so a private connection that never writes sees every commit.
+    The write worker calls ours() right after each of its own commits; any
+    other change found by check() came from outside.
+    """
+    CHECK_INTERVAL = 1.0  # seconds
+
+    def __init__(self):
+        self._conn = None
+        self._known = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.stats = {'checks': 0, 'external_writes': 0}
+
+    def _read(self):
+        # Caller holds the lock
+        if self._conn is None:
+            self._conn = _connect()
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def ours(self):
+        with self._lock:
+            self._known = self._read()
+
+    def check(self):
+        if time.monotonic() - self._checked_at < self.CHECK_INTERVAL:
+            return
+        with self._lock:
+            self._checked_at = time.monotonic()
+            version = self._read()
+            external = self._known is not None and version != self._known
+            self._known = version
+            self.stats['checks'] += 1
+        if external:
+            # No way to tell what changed - forget everything derived from the data
+            self.stats['external_writes'] += 1
+            logging.info("Database changed outside this process - invalidating cached reads")
+            response_cache.invalidate_all()
+            network_status.invalidate(everything=True)
+            event_broker.resync('external write')
+            vial_prefix.loaded = False
+            invalidate_label_formats()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+external_writes = ExternalWriteWatch()
+
+# Conditional GET. Validators come from the write path (table versions,
+# status map generations) so a client that is up to date gets its 304
+# before any query runs. A restart changes every ETag.
+BOOT_ID = uuid.uuid4().hex
+
+def make_etag(*parts):
+    return hashlib.blake2b(repr((BOOT_ID,) + parts).encode(), digest_size=8).hexdigest()
+
+def with_validators(response, etag, changed_at):
+    response.set_etag(etag, weak=True)
+    response.last_modified = changed_at
+    # Always revalidate: polling clients get a 304 instead of the body
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
+
+def not_modified(etag, changed_at):
+    """A 304 if the request's If-None-Match already holds etag, else None."""
+    if request.if_none_match.contains_weak(etag):
+        return with_validators(app.response_class(status=304), etag, changed_at)
+    return None
+
+def cached(*tables):
+    """Serve a GET endpoint's 200 responses from response_cache, with validators.
+
+    tables must list every table the response reads.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            external_writes.check()
+            versions, changed_at = response_cache.validator(tables)
+            # The local date covers endpoints whose defaults follow the calendar
+            etag = make_etag(request.path, versions, datetime.now().strftime('%Y-%m-%d'))
+            response = not_modified(etag, changed_at)
+            if response is not None:
+                return response
+
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            hit = response_cache.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                return with_validators(app.response_class(body, mimetype=mimetype), etag, changed_at)
+
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                body = response.get_data()
+                response_cache.put(key, tables, versions, (body, response.mimetype), len(body))
+                with_validators(response, etag, changed_at)
+            return response
+        return wrapper
+    return decorator
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    logging.error(f"Connection pool exhausted: {str(e)}")
+    return jsonify({"error": "Server is busy, please try again"}), 503
 
-        
-        # Stock transfers
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transfers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                from_location_id INTEGER NOT NULL,
-                to_location_id INTEGER NOT NULL,
-                status TEXT NOT NULL DEFAULT 'PENDING' 
-                    CHECK(status IN ('PENDING', 'IN_TRANSIT', 'COMPLETED', 'CANCELLED')),
-                created_by INTEGER NOT NULL,
-                approved_by INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                approved_at TIMESTAMP,
-                completed_at TIMESTAMP,
-                version INTEGER DEFAULT 1,
-                FOREIGN KEY (from_location_id) REFERENCES locations(id),
-                FOREIGN KEY (to_location_id) REFERENCES locations(id),
-                FOREIGN KEY (created_by) REFERENCES users(id),
-                FOREIGN KEY (approved_by) REFERENCES users(id)
-            )
-        ''')
-        
-        # Transfer items
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transfer_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                transfer_id INTEGER NOT NULL,
-                vial_id INTEGER NOT NULL,
-                FOREIGN KEY (transfer_id) REFERENCES transfers(id),
-                FOREIGN KEY (vial_id) REFERENCES vials(id)
-            )
-        ''')
-        
-        # Audit log
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS audit_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                action TEXT NOT NULL,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-
-        # Settings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                printer_ip TEXT,
-                printer_port TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+threading.Thread(target=worker, daemon=True).start()
+
+# 3. DATABASE INITIALIZATION
+def init_db():
+    with get_db() as conn:
+        # Schema changes live in migrations.py
+        applied = migrations.migrate(conn)
+        if applied:
+            logging.info(f"Database migrated to schema version {applied[-1]}")
+
+        # The expiry cut-offs may be days old if the server was stopped
+        if roll_expiry_window(conn.cursor()):
+            conn.commit()
+
+        cursor = conn.cursor()
         
         # Insert initial data if empty
         cursor.execute("SELECT COUNT(*) FROM locations")
@@ -351,6 +848,7 @@ def init_db():
                             INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status)
                             VALUES (?, ?, ?, ?, ?, 'AVAILABLE')
                         """, (asset_id, tenecteplase_id, batch_num, expiry_date, loc['id']))
+                        record_vial_event(cursor, cursor.lastrowid, 'CREATED', None, loc['id'])
                         vial_idx += 1
             
             # --- ANTIVENOMS: 2 batches each, 5 vials per batch (10 per antivenom type) ---
@@ -372,6 +870,7 @@ def init_db():
                             INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status)
                             VALUES (?, ?, ?, ?, ?, 'AVAILABLE')
                         """, (asset_id, antivenom_id, batch_num, expiry_date, loc['id']))
+                        record_vial_event(cursor, cursor.lastrowid, 'CREATED', None, loc['id'])
                         vial_idx += 1
 
         
@@ -425,56 +924,114 @@ def login():
     return jsonify({'success': False, 'error': 'Invalid credentials'}), 401
 
 # 5. STOCK OPERATIONS
-def receive_stock_logic(drug_id, batch_number, expiry_date, quantity, location_id, user_id, goods_receipt_number=None):
+# Blocks are reserved in the write transaction; _run_batch resets them on rollback
+asset_allocator = AssetIdAllocator(block_size=int(os.environ.get('ASSET_ID_BLOCK', 50)))
+
+def receive_stock_logic(lines, location_id, user_id, goods_receipt_number=None):
+    """Receive one goods receipt: any number of lines of (drug, batch, expiry, quantity).
+
+    All rows are built up front and written with executemany, so writer time
+    stays nearly flat as the delivery grows. The receipt is audited once, with
+    a per-vial reference row for each asset it created.
+    """
+    if not lines:
+        return {"error": "Receipt has no lines"}, 400
+    if any(int(line['quantity']) < 1 for line in lines):
+        return {"error": "Quantity must be at least 1"}, 400
+
     with get_db() as conn:
         cursor = conn.cursor()
         
-        # Get drug info
-        drug = cursor.execute("SELECT * FROM drugs WHERE id = ?", (drug_id,)).fetchone()
-        if not drug:
-            return {"error": "Drug not found"}, 404
+        # Get drug info once per distinct drug
+        drugs = {}
+        for drug_id in {line['drug_id'] for line in lines}:
+            drug = cursor.execute("SELECT * FROM drugs WHERE id = ?", (drug_id,)).fetchone()
+            if not drug:
+                return {"error": "Drug not found"}, 404
+            drugs[drug_id] = drug
         
         # Generate unique asset IDs
-        timestamp = int(time.time())
-        asset_ids = []
-        for i in range(quantity):
-            # Format: DRUG-LOC-TIMESTAMP-SEQ
-            asset_id = f"{drug['name'][:3].upper()}-{location_id}-{timestamp}-{i+1}"
-            
-            cursor.execute("""
-                INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status, goods_receipt_number, created_at)
-                VALUES (?, ?, ?, ?, ?, 'AVAILABLE', ?, ?)
-            """, (asset_id, drug_id, batch_number, expiry_date, location_id, goods_receipt_number, datetime.now()))
-            asset_ids.append(asset_id)
-            
-            # Log action
-            cursor.execute("""
-                INSERT INTO audit_log (user_id, action, details, timestamp)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, 'RECEIVE_STOCK', json.dumps({
-                'asset_id': asset_id,
-                'location_id': location_id,
-                'goods_receipt_number': goods_receipt_number
-            }), datetime.now()))
+        # Format: DRUG-LOC-SEQ, from the per-prefix sequence (see asset_ids.py)
+        now = datetime.now()
+        vial_rows = []
+        line_results = []
+        for line in lines:
+            drug = drugs[line['drug_id']]
+            line_assets = asset_allocator.allocate(cursor, asset_prefix(drug['name'], location_id), int(line['quantity']))
+            for asset_id in line_assets:
+                vial_rows.append((asset_id, drug['id'], line['batch_number'], line['expiry_date'],
+                                  location_id, goods_receipt_number, now))
+            line_results.append({
+                "drug_id": drug['id'],
+                "drug_name": drug['name'],
+                "batch_number": line['batch_number'],
+                "expiry_date": line['expiry_date'],
+                "asset_ids": line_assets,
+                "total_value": drug['unit_price'] * len(line_assets)
+            })
+        
+        # New rowids are always above the current maximum, and we hold the write lock
+        last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM vials").fetchone()[0]
+        cursor.executemany("""
+            INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status, goods_receipt_number, created_at)
+            VALUES (?, ?, ?, ?, ?, 'AVAILABLE', ?, ?)
+        """, vial_rows)
+        created = cursor.execute(
+            "SELECT id, asset_id FROM vials WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        
+        # Log action: one summary row plus a reference per vial
+        log_audit(cursor, user_id, 'RECEIVE_STOCK', {
+            'location_id': location_id,
+            'goods_receipt_number': goods_receipt_number,
+            'quantity': len(vial_rows),
+            'lines': [{
+                'drug_id': line['drug_id'],
+                'batch_number': line['batch_number'],
+                'expiry_date': line['expiry_date'],
+                'quantity': len(line['asset_ids'])
+            } for line in line_results]
+        }, location_id=location_id)
+        audit_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO audit_log_assets (audit_id, asset_id, vial_id) VALUES (?, ?, ?)",
+            [(audit_id, v['asset_id'], v['id']) for v in created]
+        )
+        
+        # A new vial's history starts at seq 1
+        cursor.executemany("""
+            INSERT INTO vial_events (vial_id, seq, event_type, timestamp, user_id, location_id)
+            VALUES (?, 1, 'CREATED', ?, ?, ?)
+        """, [(v['id'], now, user_id, location_id) for v in created])
+        for v in created:
+            record_change('vials', row_id=v['id'], location_id=location_id)
         
         conn.commit()
         
         return {
             "success": True,
-            "asset_ids": asset_ids,
-            "drug_name": drug['name'],
-            "total_value": drug['unit_price'] * quantity
+            "asset_ids": [v['asset_id'] for v in created],
+            "drug_name": ', '.join(dict.fromkeys(line['drug_name'] for line in line_results)),
+            "total_value": sum(line['total_value'] for line in line_results),
+            "lines": line_results
         }, 200
 
 @app.route('/api/receive_stock', methods=['POST'])
 def receive_stock():
     data = request.json
+    # A multi-line goods receipt sends "lines"; a single line may be sent flat
+    if 'lines' in data:
+        lines = data['lines']
+    else:
+        lines = [{
+            'drug_id': data['drug_id'],
+            'batch_number': data['batch_number'],
+            'expiry_date': data['expiry_date'],
+            'quantity': data['quantity']
+        }]
     result, status = queue_write(
         receive_stock_logic,
-        data['drug_id'],
-        data['batch_number'],
-        data['expiry_date'],
-        data['quantity'],
+        lines,
         data['location_id'],
         data['user_id'],
         data.get('goods_receipt_number')
@@ -508,38 +1065,47 @@ def use_stock_logic(vial_id, user_id, action, discard_reason=None, user_version=
             WHERE id = ?
         """, (new_status, datetime.now(), user_id, discard_reason, patient_mrn, clinical_notes, disposal_register_number, vial_id))
         
-        # Check if stock is below minimum
+        # Check if stock is below minimum (stock_counts is kept current by triggers on vials)
         cursor.execute("""
             SELECT 
-                COUNT(*) as available_count,
+                COALESCE(sc.available, 0) as available_count,
                 sl.min_stock,
                 d.name as drug_name,
                 l.name as location_name
-            FROM vials v
-            JOIN drugs d ON v.drug_id = d.id
-            JOIN locations l ON v.location_id = l.id
-            LEFT JOIN stock_levels sl ON sl.location_id = v.location_id AND sl.drug_id = v.drug_id
-            WHERE v.location_id = ? AND v.drug_id = ? AND v.status = 'AVAILABLE'
-            GROUP BY d.name, l.name, sl.min_stock
+            FROM drugs d
+            JOIN locations l ON l.id = ?
+            LEFT JOIN stock_counts sc ON sc.location_id = l.id AND sc.drug_id = d.id
+            LEFT JOIN stock_levels sl ON sl.location_id = l.id AND sl.drug_id = d.id
+            WHERE d.id = ?
         """, (vial['location_id'], vial['drug_id']))
         
         stock_info = cursor.fetchone()
         
         # Log the action
-        cursor.execute("""
-            INSERT INTO audit_log (user_id, action, details, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, action + '_STOCK', json.dumps({
+        log_audit(cursor, user_id, action + '_STOCK', {
             'asset_id': vial['asset_id'],
             'drug_id': vial['drug_id'],
             'discard_reason': discard_reason,
             'disposal_register_number': disposal_register_number
-        }), datetime.now()))
-        
-        conn.commit()
+        }, vial_id=vial_id, asset_id=vial['asset_id'], location_id=vial['location_id'])
+        if new_status == 'USED_CLINICAL':
+            record_vial_event(cursor, vial_id, 'USED', user_id, vial['location_id'], details={
+                'patient_mrn': patient_mrn,
+                'clinical_notes': clinical_notes
+            })
+        else:
+            record_vial_event(cursor, vial_id, 'DISCARDED', user_id, vial['location_id'], details={
+                'discard_reason': discard_reason,
+                'disposal_register_number': disposal_register_number
+            })
+        record_change('vials', row_id=vial_id, location_id=vial['location_id'])
         
-        # Check if notification needed
+        # Check if notification needed; it is sent once this commits
         needs_notification = stock_info and stock_info['min_stock'] and stock_info['available_count'] < stock_info['min_stock']
+        if needs_notification:
+            note_low_stock(cursor, vial['location_id'], vial['drug_id'], stock_info)
+        
+        conn.commit()
         
         return {
             "success": True,
@@ -559,13 +1125,11 @@ def use_stock():
         data.get('discard_reason'),
         data.get('version'),
         data.get('patient_mrn'),
-        data.get('clinical_notes')
+        data.get('clinical_notes'),
+        data.get('disposal_register_number'),
+        priority=PRIORITY_CLINICAL
     )
 
-    # Send notification if needed
-    if status == 200 and result.get('needs_notification'):
-        send_low_stock_notification(result['stock_info'])
-    
     return jsonify(result), status
 
 # 7. STOCK TRANSFERS
@@ -620,6 +1184,22 @@ def create_transfer_logic(from_location_id, to_location_id, vial_ids, created_by
                     UPDATE vials SET status = 'IN_TRANSIT', version = version + 1
                     WHERE id = ?
                 """, (vial_id,))
+
+        record_transfer_events(cursor, transfer_id, 'TRANSFER_STARTED', created_by, from_location_id)
+        if status == 'COMPLETED':
+            record_transfer_events(cursor, transfer_id, 'TRANSFER_COMPLETED', created_by, to_location_id)
+
+        log_audit(cursor, created_by, 'CREATE_TRANSFER', {
+            'transfer_id': transfer_id,
+            'from_location_id': from_location_id,
+            'to_location_id': to_location_id,
+            'vial_ids': vial_ids,
+            'status': status
+        }, location_id=from_location_id)
+        for location_id in (from_location_id, to_location_id):
+            record_change('transfers', row_id=transfer_id, location_id=location_id)
+            for vial_id in vial_ids:
+                record_change('vials', row_id=vial_id, location_id=location_id)
         
         conn.commit()
         
@@ -638,121 +1218,584 @@ def create_transfer():
         data['from_location_id'],
         data['to_location_id'],
         data['vial_ids'],
-        data['created_by']
+        data['created_by'],
+        priority=PRIORITY_TRANSFER
     )
     return jsonify(result), status
 
 # 8. DASHBOARD DATA
+# Keyset pagination cursors: an opaque (sort key, id) pair
+def encode_cursor(sort_key, row_id):
+    return base64.urlsafe_b64encode(f"{sort_key}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    sort_key, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+    return sort_key, int(row_id)
+
+# Columns the stock feed may return. Clinical fields (patient_mrn,
+# clinical_notes, ...) are deliberately not selectable.
+DASHBOARD_FIELDS = {
+    'id': 'v.id',
+    'asset_id': 'v.asset_id',
+    'drug_id': 'v.drug_id',
+    'batch_number': 'v.batch_number',
+    'expiry_date': 'v.expiry_date',
+    'location_id': 'v.location_id',
+    'status': 'v.status',
+    'version': 'v.version',
+    'goods_receipt_number': 'v.goods_receipt_number',
+    'created_at': 'v.created_at',
+    'drug_name': 'd.name',
+    'category': 'd.category',
+    'storage_temp': 'd.storage_temp',
+    'unit_price': 'd.unit_price',
+    'location_name': 'l.name',
+    'location_type': 'l.type',
+    'expiry_day': 'v.expiry_day',
+    'expiry_bucket': 'v.expiry_bucket',
+    'days_until_expiry': 'v.expiry_day',  # made relative to today after the fetch
+    'status_color': EXPIRY_COLOR_SQL
+}
+# What the dashboard grid renders
+DASHBOARD_DEFAULT_FIELDS = (
+    'id', 'asset_id', 'drug_id', 'batch_number', 'expiry_date', 'location_id', 'version',
+    'drug_name', 'category', 'storage_temp', 'unit_price', 'location_name', 'location_type',
+    'days_until_expiry', 'status_color'
+)
+DASHBOARD_PAGE_SIZE = 50
+DASHBOARD_PAGE_MAX = 500
+
+def expiry_bounds(conn, bucket):
+    """(after, up_to) expiry_day range holding exactly the vials in a bucket.
+
+    The cut-offs are the ones the stored buckets were computed against, so
+    the filter agrees with status_color and stays an index range.
+    """
+    window = conn.execute("SELECT critical_before, warning_before FROM stock_counts_window").fetchone()
+    critical, warning = day_number(window['critical_before']), day_number(window['warning_before'])
+    lowest, highest = -sys.maxsize, sys.maxsize
+    return {
+        'critical': (lowest, critical),
+        'warning': (critical, warning),
+        'healthy': (warning, highest),
+        None: (lowest, highest)
+    }[bucket]
+
+def _dashboard_user(conn, user_id):
+    # Returned to the client (and cached), so never the password hash or reset token
+    return conn.execute("""
+        SELECT u.id, u.username, u.role, u.location_id, u.can_delegate, u.is_supervisor, u.email,
+               u.mobile_number, u.is_active, u.must_change_password, u.created_at, u.version,
+               l.name as location_name, l.type as location_type
+        FROM users u
+        JOIN locations l ON u.location_id = l.id
+        WHERE u.id = ?
+    """, (user_id,)).fetchone()
+
+def _sees_network(user):
+    return user['role'] in ['PHARMACIST', 'PHARMACY_TECH']
+
+def _dashboard_stats(conn, user):
+    # Counters are maintained on write (stock_counts), so this never reads vials
+    if _sees_network(user):
+        counts = conn.execute("""
+            SELECT 
+                COALESCE(SUM(available), 0) as available,
+                COALESCE(SUM(expiring_30), 0) as expiring_30,
+                COALESCE(SUM(expiring_90), 0) as expiring_90
+            FROM stock_counts
+        """).fetchone()
+    else:
+        counts = conn.execute("""
+            SELECT 
+                COALESCE(SUM(available), 0) as available,
+                COALESCE(SUM(expiring_30), 0) as expiring_30,
+                COALESCE(SUM(expiring_90), 0) as expiring_90
+            FROM stock_counts
+            WHERE location_id = ?
+        """, (user['location_id'],)).fetchone()
+    return {
+        'total_stock': counts['available'],
+        'expiring_soon': counts['expiring_30'],
+        'warning_stock': counts['expiring_90'] - counts['expiring_30'],
+        'healthy_stock': counts['available'] - counts['expiring_90']
+    }
+
+def _dashboard_feed(conn, fields, location_id=None, drug_id=None, bucket=None, after=None, limit=-1):
+    """AVAILABLE vials in expiry order, keyset-paginated on (expiry_day, id)."""
+    columns = ', '.join(f"{DASHBOARD_FIELDS[field]} as {field}" for field in fields)
+    expiry_after, expiry_up_to = expiry_bounds(conn, bucket)
+    after = after or (-sys.maxsize, 0)
+
+    # Both shapes walk a partial expiry index in order and stop at the limit
+    sql = f"""
+        SELECT {columns}
+        FROM vials v
+        JOIN drugs d ON v.drug_id = d.id
+        JOIN locations l ON v.location_id = l.id
+        WHERE v.status = 'AVAILABLE'
+        AND v.expiry_day > ? AND v.expiry_day <= ?
+        AND (v.expiry_day, v.id) > (?, ?)
+        AND (? IS NULL OR v.drug_id = ?)
+    """
+    params = [expiry_after, expiry_up_to, *after, drug_id, drug_id]
+    if location_id is not None:
+        sql += " AND v.location_id = ?"
+        params.append(location_id)
+    sql += " ORDER BY v.expiry_day, v.id LIMIT ?"
+    params.append(limit)
+
+    today = today_day()
+    items = [dict(row) for row in conn.execute(sql, params).fetchall()]
+    if 'days_until_expiry' in fields:
+        for item in items:
+            item['days_until_expiry'] -= today
+    return items
+
 @app.route('/api/dashboard/<int:user_id>', methods=['GET'])
+@cached('users', 'locations', 'vials', 'drugs', 'stock_counts')
 def get_dashboard(user_id):
+    # Original all-in-one response; the dashboard/summary and dashboard/stock
+    # endpoints below serve the same data in pieces
     with get_db() as conn:
-        # Get user info
-        user = conn.execute("""
-            SELECT u.*, l.name as location_name, l.type as location_type
-            FROM users u
-            JOIN locations l ON u.location_id = l.id
-            WHERE u.id = ?
-        """, (user_id,)).fetchone()
-        
+        user = _dashboard_user(conn, user_id)
         if not user:
             return jsonify({"error": "User not found"}), 404
         
-        # Get stock based on user role and location
-        if user['role'] in ['PHARMACIST', 'PHARMACY_TECH']:
-            # Can see all locations
-            stock_query = """
-                SELECT 
-                    v.*, 
-                    d.name as drug_name, 
-                    d.category, 
-                    d.storage_temp,
-                    d.unit_price,
-                    l.name as location_name,
-                    l.type as location_type,
-                    julianday(v.expiry_date) - julianday('now') as days_until_expiry
-                FROM vials v
-                JOIN drugs d ON v.drug_id = d.id
-                JOIN locations l ON v.location_id = l.id
-                WHERE v.status = 'AVAILABLE'
-                ORDER BY v.expiry_date ASC
-            """
-            stock = conn.execute(stock_query).fetchall()
-        else:
-            # Nurses see only their location
-            stock_query = """
-                SELECT 
-                    v.*, 
-                    d.name as drug_name, 
-                    d.category, 
-                    d.storage_temp,
-                    d.unit_price,
-                    l.name as location_name,
-                    l.type as location_type,
-                    julianday(v.expiry_date) - julianday('now') as days_until_expiry
-                FROM vials v
-                JOIN drugs d ON v.drug_id = d.id
-                JOIN locations l ON v.location_id = l.id
-                WHERE v.status = 'AVAILABLE' AND v.location_id = ?
-                ORDER BY v.expiry_date ASC
-            """
-            stock = conn.execute(stock_query, (user['location_id'],)).fetchall()
+        # Nurses see only their location
+        location_id = None if _sees_network(user) else user['location_id']
+        stock = _dashboard_feed(conn, DASHBOARD_DEFAULT_FIELDS, location_id=location_id)
         
-        # Get summary statistics
-        stats = {
-            'total_stock': len(stock),
-            'expiring_soon': sum(1 for s in stock if s['days_until_expiry'] <= 30),
-            'warning_stock': sum(1 for s in stock if 30 < s['days_until_expiry'] <= 90),
-            'healthy_stock': sum(1 for s in stock if s['days_until_expiry'] > 90)
-        }
+        return jsonify({
+            'user': dict(user),
+            'stock': stock,
+            'stats': _dashboard_stats(conn, user)
+        })
+
+@app.route('/api/dashboard/<int:user_id>/summary', methods=['GET'])
+@cached('users', 'locations', 'vials', 'drugs', 'stock_counts')
+def get_dashboard_summary(user_id):
+    with get_db() as conn:
+        user = _dashboard_user(conn, user_id)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
         
-        # Convert to dict
-        stock_list = []
-        for item in stock:
-            stock_dict = dict(item)
-            # Determine status color
-            if stock_dict['days_until_expiry'] <= 30:
-                stock_dict['status_color'] = 'red'
-            elif stock_dict['days_until_expiry'] <= 90:
-                stock_dict['status_color'] = 'amber'
-            else:
-                stock_dict['status_color'] = 'green'
-            stock_list.append(stock_dict)
+        # Per-location totals for the location filter
+        locations = conn.execute("""
+            SELECT 
+                l.id as location_id,
+                l.name as location_name,
+                SUM(sc.available) as available,
+                SUM(sc.expiring_30) as expiring_soon
+            FROM stock_counts sc
+            JOIN locations l ON sc.location_id = l.id
+            WHERE sc.available > 0 AND (? IS NULL OR sc.location_id = ?)
+            GROUP BY l.id, l.name
+            ORDER BY l.name
+        """, (None, None) if _sees_network(user) else (user['location_id'], user['location_id'])).fetchall()
         
         return jsonify({
             'user': dict(user),
-            'stock': stock_list,
-            'stats': stats
+            'stats': _dashboard_stats(conn, user),
+            'locations': [dict(location) for location in locations]
+        })
+
+@app.route('/api/dashboard/<int:user_id>/stock', methods=['GET'])
+@cached('users', 'locations', 'vials', 'drugs', 'stock_counts')
+def get_dashboard_stock(user_id):
+    args = request.args
+    fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()] or list(DASHBOARD_DEFAULT_FIELDS)
+    unknown = [field for field in fields if field not in DASHBOARD_FIELDS]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+    # The cursor needs the sort key
+    projected = fields + [field for field in ('id', 'expiry_day') if field not in fields]
+
+    bucket = args.get('expiry') or None
+    if bucket not in (None, 'critical', 'warning', 'healthy'):
+        return jsonify({"error": "expiry must be critical, warning or healthy"}), 400
+    after = None
+    try:
+        if args.get('cursor'):
+            expiry_day, vial_id = decode_cursor(args['cursor'])
+            after = (int(expiry_day), vial_id)
+    except (ValueError, UnicodeDecodeError, base64.binascii.Error):
+        return jsonify({"error": "Invalid cursor"}), 400
+    limit = min(max(args.get('limit', DASHBOARD_PAGE_SIZE, type=int), 1), DASHBOARD_PAGE_MAX)
+
+    with get_db() as conn:
+        user = _dashboard_user(conn, user_id)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        
+        # Nurses are always limited to their own location
+        location_id = args.get('location_id', type=int) if _sees_network(user) else user['location_id']
+        rows = _dashboard_feed(conn, projected, location_id=location_id, drug_id=args.get('drug_id', type=int),
+                               bucket=bucket, after=after, limit=limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['expiry_day'], rows[-1]['id']) if has_more else None
+    return jsonify({
+        'stock': [{field: row[field] for field in fields} for row in rows],
+        'next_cursor': next_cursor
+    })
+
+
+
+# Live change events for dashboards (/api/events/<user_id>, server-sent
+# events). The commit hook hands every committed batch's changes to the
+# broker thread, which reads the affected rows back and fans compact events
+# out to the open streams. Recent events are kept so a reconnecting client
+# can resume from its Last-Event-ID; anything it cannot resume becomes a
+# resync event, telling it to reload.
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', 1000))
+EVENT_MAX_STREAMS = int(os.environ.get('EVENT_MAX_STREAMS', 100))  # each open stream holds a server thread
+EVENT_STREAM_QUEUE = 500  # events a slow stream may fall behind before it is told to resync
+EVENT_KEEPALIVE = 15  # seconds between comments on an idle stream
+EVENT_RETRY_MS = 5000
+EVENT_QUERY_CHUNK = 500  # stays under SQLite's bound parameter limit
+EVENT_VIAL_FIELDS = DASHBOARD_DEFAULT_FIELDS + ('status',)
+
+class EventBroker:
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._buffer = deque(maxlen=EVENT_BUFFER_SIZE)  # (seq, locations, name, data)
+        self._seq = 0
+        self._streams = {}  # queue -> location_id it is scoped to, None for the whole network
+        self._lock = threading.Lock()
+        self.stats = {'events': 0, 'resyncs': 0, 'replayed': 0, 'lagging': 0, 'rejected': 0}
+
+    def publish(self, changes):
+        # Runs in the write worker: queue the work, build the events elsewhere
+        self._pending.put(('changes', changes))
+
+    def resync(self, reason):
+        self._pending.put(('resync', reason))
+
+    @staticmethod
+    def _visible(event, location_id):
+        locations = event[1]
+        return location_id is None or locations is None or location_id in locations
+
+    def _emit(self, locations, name, data):
+        with self._lock:
+            self._seq += 1
+            event = (self._seq, locations, name, json.dumps(data, default=str))
+            self._buffer.append(event)
+            self.stats['events'] += 1
+            self.stats['resyncs'] += name == 'resync'
+            for stream, location_id in self._streams.items():
+                if not self._visible(event, location_id):
+                    continue
+                try:
+                    stream.put_nowait(event)
+                except queue.Full:
+                    # Too far behind to catch up - start it over instead of blocking everyone
+                    self.stats['lagging'] += 1
+                    while not stream.empty():
+                        try:
+                            stream.get_nowait()
+                        except queue.Empty:
+                            break
+                    stream.put_nowait((self._seq, None, 'resync', json.dumps({'location_id': None, 'reason': 'lagging'})))
+
+    def _vial_rows(self, conn, vial_ids):
+        columns = ', '.join(f"{DASHBOARD_FIELDS[field]} as {field}" for field in EVENT_VIAL_FIELDS)
+        today = today_day()
+        rows = []
+        for i in range(0, len(vial_ids), EVENT_QUERY_CHUNK):
+            chunk = vial_ids[i:i + EVENT_QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows.extend(dict(row) for row in conn.execute(f"""
+                SELECT {columns}
+                FROM vials v
+                JOIN drugs d ON v.drug_id = d.id
+                JOIN locations l ON v.location_id = l.id
+                WHERE v.id IN ({placeholders})
+            """, chunk))
+        for row in rows:
+            row['days_until_expiry'] -= today
+        return rows
+
+    def _events(self, conn, changes):
+        """(locations, name, data) events for one committed batch."""
+        vials, transfers, counts, resync = {}, {}, set(), set()
+        for change in changes:
+            table, row_id, location_id = change['table'], change['row_id'], change['location_id']
+            if table == 'vials':
+                if row_id is None:
+                    resync.add(location_id)
+                else:
+                    vials.setdefault(row_id, set()).add(location_id)
+                counts.add(location_id)
+            elif table == 'transfers' and row_id is not None:
+                transfers.setdefault(row_id, set()).add(location_id)
+            elif table == 'stock_counts':
+                (resync if location_id is None else counts).add(location_id)
+
+        # Changes without rows (bulk recounts, the expiry roll) cannot be sent as deltas
+        if None in resync:
+            return [(None, 'resync', {'location_id': None, 'reason': 'bulk change'})]
+        events = [({location_id}, 'resync', {'location_id': location_id, 'reason': 'bulk change'}) for location_id in resync]
+
+        for row in self._vial_rows(conn, list(vials)):
+            # Both ends of a move hear about it: the old location drops the vial
+            events.append((vials[row['id']] | {row['location_id']}, 'vial', row))
+        for transfer_id in transfers:
+            transfer = conn.execute("""
+                SELECT id, status, from_location_id, to_location_id
+                FROM transfers WHERE id = ?
+            """, (transfer_id,)).fetchone()
+            if transfer:
+                events.append(({transfer['from_location_id'], transfer['to_location_id']}, 'transfer', dict(transfer)))
+        for location_id in counts - {None}:
+            rows = conn.execute("""
+                SELECT drug_id, available, in_transit, expiring_30, expiring_90
+                FROM stock_counts WHERE location_id = ?
+            """, (location_id,)).fetchall()
+            events.append(({location_id}, 'stock_counts', {'location_id': location_id, 'counts': [dict(row) for row in rows]}))
+        return events
+
+    def run(self):
+        while True:
+            kind, payload = self._pending.get()
+            if kind == 'resync':
+                self._emit(None, 'resync', {'location_id': None, 'reason': payload})
+                continue
+            try:
+                conn = db_pool.acquire()
+                try:
+                    events = self._events(conn, payload)
+                finally:
+                    db_pool.release(conn)
+            except (PoolTimeout, sqlite3.Error) as e:
+                # The deltas are lost, so every stream has to reload
+                logging.error(f"Building change events failed: {str(e)}")
+                events = [(None, 'resync', {'location_id': None, 'reason': 'error'})]
+            for event in events:
+                self._emit(*event)
+
+    def subscribe(self, location_id, last_event_id=None):
+        """(queue, replay) for a new stream, or None when there are too many."""
+        with self._lock:
+            if len(self._streams) >= EVENT_MAX_STREAMS:
+                self.stats['rejected'] += 1
+                return None
+            replay = []
+            if last_event_id:
+                boot, _, seq = last_event_id.partition(':')
+                seq = int(seq) if seq.isdigit() else -1
+                oldest = self._buffer[0][0] if self._buffer else self._seq + 1
+                if boot == BOOT_ID and oldest - 1 <= seq <= self._seq:
+                    replay = [event for event in self._buffer if event[0] > seq and self._visible(event, location_id)]
+                    self.stats['replayed'] += len(replay)
+                else:
+                    # Restarted server or too long away: the missed events are gone
+                    replay = [(self._seq, None, 'resync', json.dumps({'location_id': None, 'reason': 'missed'}))]
+            stream = queue.Queue(maxsize=EVENT_STREAM_QUEUE)
+            self._streams[stream] = location_id
+            return stream, replay
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            self._streams.pop(stream, None)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, streams=len(self._streams), buffered=len(self._buffer),
+                        last_event_id=f"{BOOT_ID}:{self._seq}")
+
+event_broker = EventBroker()
+threading.Thread(target=event_broker.run, daemon=True, name='event-broker').start()
+
+@on_commit
+def _publish_change_events(changes):
+    event_broker.publish(changes)
+
+def _sse(event):
+    seq, _, name, data = event
+    return f"id: {BOOT_ID}:{seq}\nevent: {name}\ndata: {data}\n\n"
+
+@app.route('/api/events/<int:user_id>', methods=['GET'])
+def event_stream(user_id):
+    with get_db() as conn:
+        user = _dashboard_user(conn, user_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    # Same scope as the dashboard: nurses only hear about their own location
+    location_id = None if _sees_network(user) else user['location_id']
+    subscription = event_broker.subscribe(location_id, request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    if subscription is None:
+        return jsonify({"error": "Too many live connections, please try again"}), 503
+    stream, replay = subscription
+
+    def generate():
+        try:
+            yield f"retry: {EVENT_RETRY_MS}\n\n"
+            for event in replay:
+                yield _sse(event)
+            while True:
+                try:
+                    event = stream.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    # Also how a closed connection is noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event)
+        finally:
+            event_broker.unsubscribe(stream)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Delta sync (/api/changes?since=seq). Write operations log every row they
+# change (_log_changes, same transaction); the log keeps the latest seq per
+# row, so a client that remembers the last seq it applied can fetch just the
+# rows changed since. Bootstrapping: read the current seq (no since), download
+# the tables, then sync from that seq - rows changed in between come round
+# again, which is harmless since every delta is the row's current state.
+# Writes made by other processes bypass the log.
+CHANGE_LOG_RETENTION_DAYS = int(os.environ.get('CHANGE_LOG_RETENTION_DAYS', 30))
+CHANGE_LOG_PRUNE_INTERVAL = 3600
+CHANGES_PAGE_SIZE = 500
+CHANGES_PAGE_MAX = 5000
+
+# What a delta carries for each logged table. Clinical fields and
+# credentials are left out; a row that no longer exists is a delete.
+CHANGE_LOG_ROWS = {
+    'vials': """
+        SELECT id, asset_id, drug_id, batch_number, expiry_date, expiry_day, location_id, status,
+               discard_reason, created_at, used_at, used_by, version, goods_receipt_number, disposal_register_number
+        FROM vials WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    'transfers': """
+        SELECT t.*, (SELECT json_group_array(ti.vial_id) FROM transfer_items ti WHERE ti.transfer_id = t.id) AS vial_ids
+        FROM transfers t WHERE t.id IN (SELECT value FROM json_each(?))
+    """,
+    'drugs': "SELECT * FROM drugs WHERE id IN (SELECT value FROM json_each(?))",
+    'locations': "SELECT * FROM locations WHERE id IN (SELECT value FROM json_each(?))",
+    'users': """
+        SELECT id, username, role, location_id, can_delegate, is_supervisor, email, mobile_number,
+               is_active, must_change_password, created_at, version
+        FROM users WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    'stock_levels': "SELECT * FROM stock_levels WHERE id IN (SELECT value FROM json_each(?))",
+}
+
+def change_log_bounds(conn):
+    """(pruned_through, head): a client can resume from any seq in between."""
+    row = conn.execute("""
+        SELECT pruned_through, MAX(pruned_through, COALESCE((SELECT MAX(seq) FROM change_log), 0)) AS head
+        FROM change_log_horizon
+    """).fetchone()
+    return row['pruned_through'], row['head']
+
+def prune_change_log(cursor, cutoff):
+    """Drop entries last changed before cutoff and move the horizon past them."""
+    row = cursor.execute(
+        "SELECT MAX(seq) FROM change_log WHERE changed_at < ?", (cutoff,)
+    ).fetchone()
+    if row[0] is None:
+        return 0
+    cursor.execute("DELETE FROM change_log WHERE seq <= ?", (row[0],))
+    pruned = cursor.rowcount
+    cursor.execute("UPDATE change_log_horizon SET pruned_through = MAX(pruned_through, ?)", (row[0],))
+    return pruned
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    since = request.args.get('since')
+    try:
+        limit = min(max(int(request.args.get('limit', CHANGES_PAGE_SIZE)), 1), CHANGES_PAGE_MAX)
+        since = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+
+    with get_db() as conn:
+        pruned_through, head = change_log_bounds(conn)
+        if since is None:
+            return jsonify({"seq": head})
+        # Too far behind, or ahead of this database (restored from a backup)
+        if since < pruned_through or since > head:
+            return jsonify({
+                "error": "Change log no longer covers this point, a full resync is required",
+                "resync_required": True,
+                "seq": head
+            }), 410
+
+        entries = conn.execute("""
+            SELECT seq, table_name, row_id FROM change_log
+            WHERE seq > ? AND seq <= ?
+            ORDER BY seq LIMIT ?
+        """, (since, head, limit)).fetchall()
+
+        ids = {}
+        for entry in entries:
+            ids.setdefault(entry['table_name'], []).append(entry['row_id'])
+        rows = {}
+        for table, row_ids in ids.items():
+            for row in conn.execute(CHANGE_LOG_ROWS[table], (json.dumps(row_ids),)):
+                rows[(table, row['id'])] = dict(row)
+
+    changes = []
+    for entry in entries:
+        row = rows.get((entry['table_name'], entry['row_id']))
+        if row is not None and entry['table_name'] == 'transfers':
+            row['vial_ids'] = json.loads(row['vial_ids'])
+        changes.append({
+            'seq': entry['seq'],
+            'table': entry['table_name'],
+            'id': entry['row_id'],
+            'op': 'delete' if row is None else 'upsert',
+            'row': row
         })
 
+    more = len(entries) == limit
+    return jsonify({
+        'changes': changes,
+        # The seq to ask for next; once caught up it is the head itself
+        'next': entries[-1]['seq'] if more else head,
+        'more': more
+    })
 
 
 # Additional API endpoints for complete functionality
 @app.route('/api/locations/<int:location_id>', methods=['DELETE'])
 def delete_location(location_id):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Check dependencies
-        # 1. Users assigned to this location
-        users = cursor.execute("SELECT COUNT(*) FROM users WHERE location_id = ?", (location_id,)).fetchone()[0]
-        if users > 0:
-            return jsonify({"error": "Cannot delete location with assigned users"}), 400
-            
-        # 2. Stock (vials) at this location
-        stock = cursor.execute("SELECT COUNT(*) FROM vials WHERE location_id = ?", (location_id,)).fetchone()[0]
-        if stock > 0:
-            return jsonify({"error": "Cannot delete location with existing stock"}), 400
+    def delete_location_logic():
+        with get_db() as conn:
+            cursor = conn.cursor()
             
-        # 3. Transfers involving this location
-        transfers = cursor.execute("SELECT COUNT(*) FROM transfers WHERE from_location_id = ? OR to_location_id = ?", (location_id, location_id)).fetchone()[0]
-        if transfers > 0:
-            return jsonify({"error": "Cannot delete location with transfer history"}), 400
+            # Check dependencies
+            # 1. Users assigned to this location
+            users = cursor.execute("SELECT COUNT(*) FROM users WHERE location_id = ?", (location_id,)).fetchone()[0]
+            if users > 0:
+                return {"error": "Cannot delete location with assigned users"}, 400
+                
+            # 2. Stock (vials) at this location
+            stock = cursor.execute("SELECT COUNT(*) FROM vials WHERE location_id = ?", (location_id,)).fetchone()[0]
+            if stock > 0:
+                return {"error": "Cannot delete location with existing stock"}, 400
+                
+            # 3. Transfers involving this location
+            transfers = cursor.execute("SELECT COUNT(*) FROM transfers WHERE from_location_id = ? OR to_location_id = ?", (location_id, location_id)).fetchone()[0]
+            if transfers > 0:
+                return {"error": "Cannot delete location with transfer history"}, 400
 
-        cursor.execute("DELETE FROM locations WHERE id = ?", (location_id,))
-        conn.commit()
-        return jsonify({"success": True})
+            cursor.execute("DELETE FROM locations WHERE id = ?", (location_id,))
+            record_change('locations', row_id=location_id, location_id=location_id)
+            conn.commit()
+            return {"success": True}, 200
+
+    result, status = queue_write(delete_location_logic)
+    return jsonify(result), status
 
 @app.route('/api/locations', methods=['GET', 'POST'])
+@cached('locations')
 def handle_locations():
     if request.method == 'GET':
         with get_db() as conn:
@@ -761,16 +1804,23 @@ def handle_locations():
     
     # POST - Create new location
     data = request.json
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO locations (name, type, parent_hub_id, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (data['name'], data['type'], data.get('parent_hub_id'), datetime.now()))
-        conn.commit()
-        return jsonify({"success": True, "id": cursor.lastrowid})
+
+    def create_location_logic():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO locations (name, type, parent_hub_id, created_at)
+                VALUES (?, ?, ?, ?)
+            """, (data['name'], data['type'], data.get('parent_hub_id'), datetime.now()))
+            record_change('locations', row_id=cursor.lastrowid, location_id=cursor.lastrowid)
+            conn.commit()
+            return {"success": True, "id": cursor.lastrowid}, 200
+
+    result, status = queue_write(create_location_logic)
+    return jsonify(result), status
 
 @app.route('/api/drugs', methods=['GET', 'POST'])
+@cached('drugs')
 def handle_drugs():
     if request.method == 'GET':
         with get_db() as conn:
@@ -779,16 +1829,23 @@ def handle_drugs():
 
     # POST - Create new drug
     data = request.json
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO drugs (name, category, storage_temp, unit_price, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (data['name'], data['category'], data['storage_temp'], data['unit_price'], datetime.now()))
-        conn.commit()
-        return jsonify({"success": True, "id": cursor.lastrowid})
+
+    def create_drug_logic():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO drugs (name, category, storage_temp, unit_price, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (data['name'], data['category'], data['storage_temp'], data['unit_price'], datetime.now()))
+            record_change('drugs', row_id=cursor.lastrowid)
+            conn.commit()
+            return {"success": True, "id": cursor.lastrowid}, 200
+
+    result, status = queue_write(create_drug_logic)
+    return jsonify(result), status
 
 @app.route('/api/stock_levels', methods=['GET', 'PUT'])
+@cached('stock_levels')
 def handle_stock_levels():
     if request.method == 'GET':
         with get_db() as conn:
@@ -821,11 +1878,14 @@ def handle_stock_levels():
                         SET min_stock = ?
                         WHERE location_id = ? AND drug_id = ?
                     """, (min_stock, location_id, drug_id))
+                    level_id = existing['id']
                 else:
                     cursor.execute("""
                         INSERT INTO stock_levels (location_id, drug_id, min_stock)
                         VALUES (?, ?, ?)
                     """, (location_id, drug_id, min_stock))
+                    level_id = cursor.lastrowid
+                record_change('stock_levels', row_id=level_id, location_id=location_id)
             
             conn.commit()
             return {"success": True}, 200
@@ -839,132 +1899,428 @@ def get_location_stock(location_id):
         stock = conn.execute("""
             SELECT 
                 v.*, 
-                d.name as drug_name,
-                julianday(v.expiry_date) - julianday('now') as days_until_expiry
+                d.name as drug_name
             FROM vials v
             JOIN drugs d ON v.drug_id = d.id
             WHERE v.location_id = ? AND v.status = 'AVAILABLE'
-            ORDER BY v.expiry_date ASC
+            ORDER BY v.expiry_day ASC
         """, (location_id,)).fetchall()
-        return jsonify([dict(item) for item in stock])
+        today = today_day()
+        return jsonify([dict(item, days_until_expiry=item['expiry_day'] - today) for item in stock])
+
+# Network status map behind /api/stock/all. Each entry keeps the facts a
+# location's status comes from (earliest expiry, drugs below minimum); the
+# status itself is derived on read so expiry ages without a write.
+STATUS_MAP_MAX_AGE = 300  # seconds before a full reload picks up writes from other instances
+STATUS_REFRESH_RETRY = 1  # seconds before a failed refresh is tried again
+
+NETWORK_STATUS_SQL = """
+    SELECT 
+        l.id as location_id,
+        (SELECT MIN(expiry_day) FROM vials 
+         WHERE location_id = l.id AND status = 'AVAILABLE') as earliest_expiry_day,
+        (SELECT COUNT(*) FROM stock_levels sl
+         LEFT JOIN stock_counts sc ON sc.location_id = sl.location_id AND sc.drug_id = sl.drug_id
+         WHERE sl.location_id = l.id
+         AND sl.min_stock > COALESCE(sc.available, 0)) as low_stock_items
+    FROM locations l
+"""
+
+def location_status(earliest_expiry_day, low_stock_items):
+    status = {'expiry': 'healthy', 'level': 'critical' if low_stock_items else 'healthy'}
+    if earliest_expiry_day is not None:
+        status['expiry'] = expiry_bucket(earliest_expiry_day - today_day())
+    return status
+
+class NetworkStatusMap:
+    """Per-location status, kept current by commit hooks.
+
+    Reads never wait on a refresh: a stale entry is served as-is while the
+    background refresher recomputes it (stale-while-revalidate).
+    """
+
+    def __init__(self):
+        self._entries = None  # location_id -> (earliest_expiry_day, low_stock_items)
+        self._loaded_at = 0
+        self._generation = 0  # bumped whenever _entries is replaced
+        self._changed_at = time.time()
+        self._stale = set()
+        self._full_reload = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.stats = {'reads': 0, 'full_loads': 0, 'refreshed_locations': 0}
+
+    def _query(self, conn, location_ids=None):
+        if location_ids is None:
+            rows = conn.execute(NETWORK_STATUS_SQL).fetchall()
+        else:
+            rows = []
+            for location_id in location_ids:
+                rows.extend(conn.execute(NETWORK_STATUS_SQL + " WHERE l.id = ?", (location_id,)).fetchall())
+        return {row['location_id']: (row['earliest_expiry_day'], row['low_stock_items']) for row in rows}
+
+    def _replace(self, entries):
+        # Caller holds the lock
+        self._entries = entries
+        self._generation += 1
+        self._changed_at = time.time()
+
+    def read(self, conn):
+        """Statuses by location, and the version() they were built from."""
+        with self._lock:
+            self.stats['reads'] += 1
+            entries, version = self._entries, (self._generation, self._changed_at)
+            expired = time.time() - self._loaded_at > STATUS_MAP_MAX_AGE
+
+        if entries is None:
+            entries = self._query(conn)
+            with self._lock:
+                self._replace(entries)
+                version = (self._generation, self._changed_at)
+                self._loaded_at = time.time()
+                self.stats['full_loads'] += 1
+                if self._stale:
+                    self._wake.set()
+        elif expired:
+            self.invalidate(everything=True)
+
+        return {location_id: location_status(*entry) for location_id, entry in entries.items()}, version
+
+    def version(self):
+        """(generation, changed_at) of what read() would serve, without a query.
+
+        Generation 0 means nothing is loaded yet. Like read(), this starts the
+        max-age reload, so polls answered from it still age the map out.
+        """
+        with self._lock:
+            version = (self._generation, self._changed_at)
+            expired = self._entries is not None and time.time() - self._loaded_at > STATUS_MAP_MAX_AGE
+        if expired:
+            self.invalidate(everything=True)
+        return version
+
+    def invalidate(self, location_ids=(), everything=False):
+        with self._lock:
+            self._stale.update(location_ids)
+            self._full_reload = self._full_reload or everything
+        self._wake.set()
+
+    def refresh(self, conn):
+        with self._lock:
+            # Not loaded yet: the first read loads everything
+            if self._entries is None:
+                return
+            stale, full = self._stale, self._full_reload
+            self._stale, self._full_reload = set(), False
+        if not stale and not full:
+            return
+
+        try:
+            fresh = self._query(conn, None if full else stale)
+        except sqlite3.Error:
+            # Still stale: hand the work back for the retry
+            with self._lock:
+                self._stale |= stale
+                self._full_reload = self._full_reload or full
+            raise
+        with self._lock:
+            if full:
+                self._replace(fresh)
+                self._loaded_at = time.time()
+                self.stats['full_loads'] += 1
+            else:
+                # Copy on write so readers never see a half-updated map
+                entries = dict(self._entries)
+                for location_id in stale:
+                    entries.pop(location_id, None)  # deleted locations drop out
+                entries.update(fresh)
+                self._replace(entries)
+                self.stats['refreshed_locations'] += len(stale)
+
+    def run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                conn = db_pool.acquire()
+                try:
+                    self.refresh(conn)
+                finally:
+                    db_pool.release(conn)
+            except (PoolTimeout, sqlite3.Error) as e:
+                logging.error(f"Network status refresh failed: {str(e)}")
+                time.sleep(STATUS_REFRESH_RETRY)
+                self._wake.set()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, stale=len(self._stale), loaded=self._entries is not None)
+
+network_status = NetworkStatusMap()
+threading.Thread(target=network_status.run, daemon=True, name='network-status').start()
+
+STATUS_TABLES = {'vials', 'transfers', 'stock_levels', 'stock_counts', 'locations'}
+
+@on_commit
+def _invalidate_network_status(changes):
+    relevant = [change for change in changes if change['table'] in STATUS_TABLES]
+    # Location add/remove and network-wide changes (no location) reload everything
+    if any(change['table'] == 'locations' or change['location_id'] is None for change in relevant):
+        network_status.invalidate(everything=True)
+    elif relevant:
+        network_status.invalidate({change['location_id'] for change in relevant})
 
 @app.route('/api/stock/all', methods=['GET'])
 def get_all_stock_status():
+    # Statuses age with the date as well as with writes
+    external_writes.check()
+    generation, changed_at = network_status.version()
+    if generation:
+        response = not_modified(make_etag('stock/all', generation, today_day()), changed_at)
+        if response is not None:
+            return response
+
     with get_db() as conn:
-        # Get all locations
-        locations = conn.execute("SELECT id FROM locations").fetchall()
-        status_map = {}
-        
-        for loc in locations:
-            loc_id = loc['id']
-            status_data = {
-                'expiry': 'healthy',
-                'level': 'healthy'
-            }
-            
-            # --- 1. Expiry Status ---
-            # Check for critical items (expired or expiring < 30 days)
-            critical_expiry = conn.execute("""
-                SELECT COUNT(*) as count FROM vials 
-                WHERE location_id = ? AND status = 'AVAILABLE' 
-                AND (julianday(expiry_date) - julianday('now')) < 30
-            """, (loc_id,)).fetchone()['count']
-            
-            if critical_expiry > 0:
-                status_data['expiry'] = 'critical'
-            else:
-                # Check for warning items (expiring < 90 days)
-                warning_expiry = conn.execute("""
-                    SELECT COUNT(*) as count FROM vials 
-                    WHERE location_id = ? AND status = 'AVAILABLE' 
-                    AND (julianday(expiry_date) - julianday('now')) < 90
-                """, (loc_id,)).fetchone()['count']
-                
-                if warning_expiry > 0:
-                    status_data['expiry'] = 'warning'
-            
-            # --- 2. Stock Level Status ---
-            # Check if ANY drug is below minimum stock
-            # We need to check each drug that has a min_stock defined for this location
-            low_stock_items = conn.execute("""
-                SELECT COUNT(*) as count
-                FROM stock_levels sl
-                LEFT JOIN (
-                    SELECT location_id, drug_id, COUNT(*) as current_stock
-                    FROM vials
-                    WHERE status = 'AVAILABLE'
-                    GROUP BY location_id, drug_id
-                ) v ON sl.location_id = v.location_id AND sl.drug_id = v.drug_id
-                WHERE sl.location_id = ? 
-                AND (COALESCE(v.current_stock, 0) < sl.min_stock)
-            """, (loc_id,)).fetchone()['count']
-            
-            if low_stock_items > 0:
-                status_data['level'] = 'critical' # Red if below min levels
-            
-            status_map[loc_id] = status_data
-                
-        return jsonify(status_map)
+        statuses, (generation, changed_at) = network_status.read(conn)
+    return with_validators(jsonify(statuses), make_etag('stock/all', generation, today_day()), changed_at)
+
+# Stock counters (stock_counts, maintained by triggers on vials - see migrations.py)
+STOCK_COUNT_COLUMNS = ('available', 'in_transit', 'expiring_30', 'expiring_90')
+
+EXPIRY_WINDOW = (f"+{EXPIRY_CRITICAL_DAYS} days", f"+{EXPIRY_WARNING_DAYS} days")
+EXPIRY_ROLL_INTERVAL = 60  # seconds between checks for a new (UTC) date
+
+def roll_expiry_window(cursor):
+    """Move the expiry cut-offs to today, re-bucket the vials that crossed one
+    and recount the expiring_* columns where they did.
+
+    Returns False when the window is already current.
+    """
+    old = cursor.execute("SELECT critical_before, warning_before FROM stock_counts_window").fetchone()
+    cursor.execute("""
+        UPDATE stock_counts_window
+        SET critical_before = date('now', ?), warning_before = date('now', ?)
+        WHERE critical_before != date('now', ?) OR warning_before != date('now', ?)
+    """, EXPIRY_WINDOW * 2)
+    if cursor.rowcount == 0:
+        return False
+    new = cursor.execute("SELECT critical_before, warning_before FROM stock_counts_window").fetchone()
+
+    # Only vials between an old and a new cut-off change bucket - normally
+    # a single day's expiries at each threshold
+    crossed = []
+    for before, after in zip(old, new):
+        crossed += sorted((day_number(before), day_number(after)))
+    cursor.execute(f"""
+        UPDATE vials SET expiry_bucket = {migrations.expiry_bucket_sql('expiry_date')}
+        WHERE (expiry_day > ? AND expiry_day <= ?) OR (expiry_day > ? AND expiry_day <= ?)
+    """, crossed)
+    cursor.execute("""
+        UPDATE stock_counts SET
+            expiring_30 = (
+                SELECT COUNT(*) FROM vials v
+                WHERE v.location_id = stock_counts.location_id AND v.drug_id = stock_counts.drug_id
+                AND v.status = 'AVAILABLE' AND v.expiry_date <= (SELECT critical_before FROM stock_counts_window)
+            ),
+            expiring_90 = (
+                SELECT COUNT(*) FROM vials v
+                WHERE v.location_id = stock_counts.location_id AND v.drug_id = stock_counts.drug_id
+                AND v.status = 'AVAILABLE' AND v.expiry_date <= (SELECT warning_before FROM stock_counts_window)
+            )
+        WHERE EXISTS (
+            SELECT 1 FROM vials v
+            WHERE v.location_id = stock_counts.location_id AND v.drug_id = stock_counts.drug_id
+            AND v.status = 'AVAILABLE'
+            AND ((v.expiry_day > ? AND v.expiry_day <= ?) OR (v.expiry_day > ? AND v.expiry_day <= ?))
+        )
+    """, crossed)
+    return True
+
+def check_stock_counts(conn):
+    """Compare stock_counts with a fresh count of the vials table."""
+    actual = {}
+    for row in conn.execute("""
+        SELECT 
+            location_id, drug_id,
+            SUM(status = 'AVAILABLE') as available,
+            SUM(status = 'IN_TRANSIT') as in_transit,
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT critical_before FROM stock_counts_window)) as expiring_30,
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT warning_before FROM stock_counts_window)) as expiring_90
+        FROM vials
+        WHERE status IN ('AVAILABLE', 'IN_TRANSIT')
+        GROUP BY location_id, drug_id
+    """):
+        actual[(row['location_id'], row['drug_id'])] = tuple(row[c] for c in STOCK_COUNT_COLUMNS)
+
+    stored = {}
+    for row in conn.execute("SELECT * FROM stock_counts"):
+        stored[(row['location_id'], row['drug_id'])] = tuple(row[c] for c in STOCK_COUNT_COLUMNS)
+
+    zero = (0,) * len(STOCK_COUNT_COLUMNS)
+    mismatches = []
+    for key in sorted(set(actual) | set(stored)):
+        expected, recorded = actual.get(key, zero), stored.get(key, zero)
+        if expected != recorded:
+            mismatches.append({
+                'location_id': key[0],
+                'drug_id': key[1],
+                'expected': dict(zip(STOCK_COUNT_COLUMNS, expected)),
+                'recorded': dict(zip(STOCK_COUNT_COLUMNS, recorded))
+            })
+    return mismatches
+
+def rebuild_stock_counts(cursor):
+    cursor.execute("DELETE FROM stock_counts")
+    cursor.execute("""
+        INSERT INTO stock_counts (location_id, drug_id, available, in_transit, expiring_30, expiring_90)
+        SELECT 
+            location_id, drug_id,
+            SUM(status = 'AVAILABLE'),
+            SUM(status = 'IN_TRANSIT'),
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT critical_before FROM stock_counts_window)),
+            SUM(status = 'AVAILABLE' AND expiry_date <= (SELECT warning_before FROM stock_counts_window))
+        FROM vials
+        WHERE status IN ('AVAILABLE', 'IN_TRANSIT')
+        GROUP BY location_id, drug_id
+    """)
+
+@app.route('/api/stock_counts/check', methods=['GET', 'POST'])
+def handle_stock_counts_check():
+    # GET reports drift; POST rebuilds the counters from vials first
+    if request.method == 'POST':
+        def rebuild_logic():
+            with get_db() as conn:
+                cursor = conn.cursor()
+                rebuild_stock_counts(cursor)
+                record_change('stock_counts')
+                conn.commit()
+                return {"success": True}, 200
+
+        result, status = queue_write(rebuild_logic)
+        if status != 200:
+            return jsonify(result), status
 
-@app.route('/api/transfers/<int:location_id>', methods=['GET'])
-def get_transfers(location_id):
     with get_db() as conn:
-        transfers = conn.execute("""
+        mismatches = check_stock_counts(conn)
+    if mismatches:
+        logging.warning(f"stock_counts drift detected for {len(mismatches)} location/drug pairs")
+    return jsonify({'consistent': not mismatches, 'mismatches': mismatches})
+
+TRANSFER_STATUSES = ('PENDING', 'IN_TRANSIT', 'COMPLETED', 'CANCELLED')
+TRANSFER_PAGE_SIZE = 50
+TRANSFER_PAGE_MAX = 200
+TRANSFER_ITEMS_CHUNK = 500  # stays under SQLite's bound parameter limit
+# Without any of these the endpoint keeps its original response: every transfer, as a list
+TRANSFER_LISTING_PARAMS = ('status', 'from_date', 'to_date', 'cursor', 'limit', 'summary')
+
+
+def fetch_transfer_items(conn, transfer_ids):
+    """Items for many transfers in one query per chunk, grouped by transfer."""
+    items = {transfer_id: [] for transfer_id in transfer_ids}
+    today = today_day()
+    for i in range(0, len(transfer_ids), TRANSFER_ITEMS_CHUNK):
+        chunk = transfer_ids[i:i + TRANSFER_ITEMS_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f"""
             SELECT 
-                t.*,
-                fl.name as from_location,
-                fl.type as from_location_type,
-                tl.name as to_location,
-                tl.type as to_location_type,
+                ti.transfer_id,
+                v.id, v.asset_id, v.batch_number, v.expiry_date,
+                d.name as drug_name, d.category, d.storage_temp, d.unit_price,
+                v.expiry_day as days_until_expiry,
+                {EXPIRY_COLOR_SQL} as status_color
+            FROM transfer_items ti
+            JOIN vials v ON ti.vial_id = v.id
+            JOIN drugs d ON v.drug_id = d.id
+            WHERE ti.transfer_id IN ({placeholders})
+            ORDER BY ti.id
+        """, chunk).fetchall()
+        for row in rows:
+            item = dict(row)
+            item['days_until_expiry'] -= today
+            items[item.pop('transfer_id')].append(item)
+    return items
+
+@app.route('/api/transfers/<int:location_id>', methods=['GET'])
+def get_transfers(location_id):
+    args = request.args
+    paginated = any(param in args for param in TRANSFER_LISTING_PARAMS)
+
+    statuses = [status.strip().upper() for status in args.get('status', '').split(',') if status.strip()]
+    if any(status not in TRANSFER_STATUSES for status in statuses):
+        return jsonify({"error": f"Unknown status. Use any of {', '.join(TRANSFER_STATUSES)}"}), 400
+    statuses = statuses or list(TRANSFER_STATUSES)
+    statuses += [None] * (len(TRANSFER_STATUSES) - len(statuses))
+
+    try:
+        from_date = args.get('from_date', '')
+        if from_date:
+            datetime.strptime(from_date, '%Y-%m-%d')
+        to_date = args.get('to_date')
+        # Inclusive end date: everything before the following midnight
+        before = (datetime.strptime(to_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') if to_date else '9999-12-31'
+        cursor_key = decode_cursor(args['cursor']) if args.get('cursor') else ('9999-12-31', sys.maxsize)
+    except (ValueError, UnicodeDecodeError, base64.binascii.Error):
+        return jsonify({"error": "Invalid date or cursor"}), 400
+
+    limit = min(max(args.get('limit', TRANSFER_PAGE_SIZE, type=int), 1), TRANSFER_PAGE_MAX) if paginated else -1
+    summary = args.get('summary', '').lower() in ('1', 'true', 'yes')
+
+    # Each arm walks one location index newest first and stops after the page
+    # (plus one row to tell whether another page exists)
+    fetch = limit + 1 if limit > 0 else -1
+    arm_params = [*statuses, from_date, before, *cursor_key, fetch]
+    with get_db() as conn:
+        transfers = conn.execute("""
+            SELECT 
+                t.*,
+                fl.name as from_location,
+                fl.type as from_location_type,
+                tl.name as to_location,
                 tl.type as to_location_type,
                 u.username as created_by_name,
                 u.location_id as created_by_location_id,
-                COUNT(ti.id) as item_count
-            FROM transfers t
+                (SELECT COUNT(*) FROM transfer_items ti WHERE ti.transfer_id = t.id) as item_count
+            FROM (
+                SELECT id FROM (
+                    SELECT id FROM transfers
+                    WHERE from_location_id = ? AND status IN (?, ?, ?, ?)
+                    AND created_at >= ? AND created_at < ? AND (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                )
+                UNION
+                SELECT id FROM (
+                    SELECT id FROM transfers
+                    WHERE to_location_id = ? AND status IN (?, ?, ?, ?)
+                    AND created_at >= ? AND created_at < ? AND (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                )
+            ) page
+            JOIN transfers t ON t.id = page.id
             JOIN locations fl ON t.from_location_id = fl.id
             JOIN locations tl ON t.to_location_id = tl.id
             JOIN users u ON t.created_by = u.id
-            LEFT JOIN transfer_items ti ON t.id = ti.transfer_id
-            WHERE t.from_location_id = ? OR t.to_location_id = ?
-            GROUP BY t.id
-            ORDER BY t.created_at DESC
-        """, (location_id, location_id)).fetchall()
-        
-        # Convert to list of dicts and fetch items for each transfer
-        transfer_list = []
-        for t in transfers:
-            t_dict = dict(t)
-            
-            # Fetch items for this transfer
-            items = conn.execute("""
-                SELECT 
-                    v.id, v.asset_id, v.batch_number, v.expiry_date,
-                    d.name as drug_name, d.category, d.storage_temp, d.unit_price,
-                    julianday(v.expiry_date) - julianday('now') as days_until_expiry
-                FROM transfer_items ti
-                JOIN vials v ON ti.vial_id = v.id
-                JOIN drugs d ON v.drug_id = d.id
-                WHERE ti.transfer_id = ?
-            """, (t['id'],)).fetchall()
-            
-            # Process items to add status_color
-            processed_items = []
-            for item in items:
-                item_dict = dict(item)
-                days = item_dict['days_until_expiry'] or 0
-                if days <= 30:
-                    item_dict['status_color'] = 'red'
-                elif days <= 90:
-                    item_dict['status_color'] = 'amber'
-                else:
-                    item_dict['status_color'] = 'green'
-                processed_items.append(item_dict)
-            
-            t_dict['items'] = processed_items
-            transfer_list.append(t_dict)
-            
+            ORDER BY t.created_at DESC, t.id DESC
+            LIMIT ?
+        """, (location_id, *arm_params, location_id, *arm_params, fetch)).fetchall()
+
+        has_more = limit > 0 and len(transfers) > limit
+        transfer_list = [dict(t) for t in (transfers[:limit] if has_more else transfers)]
+
+        if not summary:
+            items = fetch_transfer_items(conn, [t['id'] for t in transfer_list])
+            for t_dict in transfer_list:
+                t_dict['items'] = items[t_dict['id']]
+
+    if not paginated:
         return jsonify(transfer_list)
 
+    return jsonify({
+        'transfers': transfer_list,
+        'next_cursor': encode_cursor(transfer_list[-1]['created_at'], transfer_list[-1]['id']) if has_more else None
+    })
+
 @app.route('/api/transfer/<int:transfer_id>/<string:action>', methods=['POST'])
 def handle_transfer_action(transfer_id, action):
     data = request.json
@@ -1066,15 +2422,34 @@ def handle_transfer_action(transfer_id, action):
                     SET status = 'AVAILABLE', version = version + 1
                     WHERE id IN (SELECT vial_id FROM transfer_items WHERE transfer_id = ?)
                 """, (transfer_id,))
+            else:
+                return {"error": f"Unknown transfer action: {action}"}, 400
+
+            # Approval and receipt happen at the destination, cancellation at the source
+            audit_location = transfer['from_location_id'] if action == 'cancel' else transfer['to_location_id']
+            log_audit(cursor, user_id, action.upper() + '_TRANSFER', {
+                'transfer_id': transfer_id,
+                'from_location_id': transfer['from_location_id'],
+                'to_location_id': transfer['to_location_id']
+            }, location_id=audit_location)
+            record_transfer_events(cursor, transfer_id, TRANSFER_EVENTS[action], user_id, audit_location)
+            vial_ids = [row[0] for row in cursor.execute(
+                "SELECT vial_id FROM transfer_items WHERE transfer_id = ?", (transfer_id,)
+            )]
+            for location_id in (transfer['from_location_id'], transfer['to_location_id']):
+                record_change('transfers', row_id=transfer_id, location_id=location_id)
+                for vial_id in vial_ids:
+                    record_change('vials', row_id=vial_id, location_id=location_id)
             
             conn.commit()
             return {"success": True}, 200
 
-    result, status = queue_write(update_transfer_logic)
+    result, status = queue_write(update_transfer_logic, priority=PRIORITY_TRANSFER)
     return jsonify(result), status
 
 
 @app.route('/api/users', methods=['GET', 'POST'])
+@cached('users', 'locations')
 def handle_users():
     if request.method == 'GET':
         with get_db() as conn:
@@ -1101,31 +2476,54 @@ def handle_users():
     if not all([username, password, role, location_id]):
         return jsonify({"error": "Missing required fields"}), 400
 
-    with get_db() as conn:
-        # Verify location exists
-        loc = conn.execute("SELECT id FROM locations WHERE id = ?", (location_id,)).fetchone()
-        if not loc:
-             return jsonify({"error": "Invalid location"}), 400
+    # Hash outside the write queue - it is deliberately slow
+    password_hash = generate_password_hash(password)
 
-        try:
-            # New users must change password on first login
-            conn.execute("""
-                INSERT INTO users (username, password_hash, role, location_id, can_delegate, is_supervisor, email, mobile_number, must_change_password, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
-            """, (username, generate_password_hash(password), role, location_id, can_delegate, is_supervisor, email, mobile_number, datetime.now()))
-            conn.commit()
-            return jsonify({"success": True}), 201
-        except sqlite3.IntegrityError:
-            return jsonify({"error": "Username already exists"}), 409
+    def create_user_logic():
+        with get_db() as conn:
+            # Verify location exists
+            loc = conn.execute("SELECT id FROM locations WHERE id = ?", (location_id,)).fetchone()
+            if not loc:
+                 return {"error": "Invalid location"}, 400
+
+            try:
+                # New users must change password on first login
+                cursor = conn.execute("""
+                    INSERT INTO users (username, password_hash, role, location_id, can_delegate, is_supervisor, email, mobile_number, must_change_password, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+                """, (username, password_hash, role, location_id, can_delegate, is_supervisor, email, mobile_number, datetime.now()))
+                # Account admin entries are keyed on the affected account
+                log_audit(cursor, cursor.lastrowid, 'CREATE_USER', {
+                    'username': username,
+                    'role': role
+                }, location_id=location_id)
+                record_change('users', row_id=cursor.lastrowid, location_id=location_id)
+                conn.commit()
+                return {"success": True}, 201
+            except sqlite3.IntegrityError:
+                return {"error": "Username already exists"}, 409
+
+    result, status = queue_write(create_user_logic)
+    return jsonify(result), status
 
 @app.route('/api/users/<int:user_id>', methods=['PUT', 'DELETE'])
 def handle_user_detail(user_id):
     if request.method == 'DELETE':
-        with get_db() as conn:
-            # Soft delete: Set is_active = 0
-            conn.execute("UPDATE users SET is_active = 0 WHERE id = ?", (user_id,))
-            conn.commit()
-            return jsonify({"success": True})
+        def deactivate_user_logic():
+            with get_db() as conn:
+                # Soft delete: Set is_active = 0
+                cursor = conn.execute("UPDATE users SET is_active = 0 WHERE id = ?", (user_id,))
+                if cursor.rowcount:
+                    user = conn.execute("SELECT username, location_id FROM users WHERE id = ?", (user_id,)).fetchone()
+                    log_audit(cursor, user_id, 'DEACTIVATE_USER', {
+                        'username': user['username']
+                    }, location_id=user['location_id'])
+                    record_change('users', row_id=user_id, location_id=user['location_id'])
+                conn.commit()
+                return {"success": True}, 200
+
+        result, status = queue_write(deactivate_user_logic)
+        return jsonify(result), status
 
     # PUT - Update user
     data = request.json
@@ -1142,31 +2540,44 @@ def handle_user_detail(user_id):
     if not location_id:
         return jsonify({"error": "Location is required"}), 400
 
-    with get_db() as conn:
-        # Verify location exists
-        loc = conn.execute("SELECT id FROM locations WHERE id = ?", (location_id,)).fetchone()
-        if not loc:
-             return jsonify({"error": "Invalid location"}), 400
+    password_hash = generate_password_hash(password) if password else None
 
-        try:
-            if password:
-                # If password is reset by supervisor, force change on next login
-                conn.execute("""
-                    UPDATE users 
-                    SET username = ?, role = ?, location_id = ?, email = ?, mobile_number = ?, can_delegate = ?, is_supervisor = ?, password_hash = ?, must_change_password = 1, version = version + 1
-                    WHERE id = ?
-                """, (username, role, location_id, email, mobile_number, can_delegate, is_supervisor, generate_password_hash(password), user_id))
-            else:
-                conn.execute("""
-                    UPDATE users 
-                    SET username = ?, role = ?, location_id = ?, email = ?, mobile_number = ?, can_delegate = ?, is_supervisor = ?, version = version + 1
-                    WHERE id = ?
-                """, (username, role, location_id, email, mobile_number, can_delegate, is_supervisor, user_id))
-            
-            conn.commit()
-            return jsonify({"success": True})
-        except sqlite3.IntegrityError:
-            return jsonify({"error": "Username already exists"}), 409
+    def update_user_logic():
+        with get_db() as conn:
+            # Verify location exists
+            loc = conn.execute("SELECT id FROM locations WHERE id = ?", (location_id,)).fetchone()
+            if not loc:
+                 return {"error": "Invalid location"}, 400
+
+            try:
+                if password_hash:
+                    # If password is reset by supervisor, force change on next login
+                    conn.execute("""
+                        UPDATE users 
+                        SET username = ?, role = ?, location_id = ?, email = ?, mobile_number = ?, can_delegate = ?, is_supervisor = ?, password_hash = ?, must_change_password = 1, version = version + 1
+                        WHERE id = ?
+                    """, (username, role, location_id, email, mobile_number, can_delegate, is_supervisor, password_hash, user_id))
+                else:
+                    conn.execute("""
+                        UPDATE users 
+                        SET username = ?, role = ?, location_id = ?, email = ?, mobile_number = ?, can_delegate = ?, is_supervisor = ?, version = version + 1
+                        WHERE id = ?
+                    """, (username, role, location_id, email, mobile_number, can_delegate, is_supervisor, user_id))
+
+                log_audit(conn.cursor(), user_id, 'UPDATE_USER', {
+                    'username': username,
+                    'role': role,
+                    'password_reset': bool(password_hash)
+                }, location_id=location_id)
+                record_change('users', row_id=user_id, location_id=location_id)
+                
+                conn.commit()
+                return {"success": True}, 200
+            except sqlite3.IntegrityError:
+                return {"error": "Username already exists"}, 409
+
+    result, status = queue_write(update_user_logic)
+    return jsonify(result), status
 
 @app.route('/api/change_password', methods=['POST'])
 def change_password():
@@ -1187,16 +2598,24 @@ def change_password():
         if not check_password_hash(user['password_hash'], old_password):
             return jsonify({"error": "Invalid current password"}), 401
 
-        try:
-            conn.execute("""
-                UPDATE users 
-                SET password_hash = ?, must_change_password = 0, version = version + 1
-                WHERE id = ?
-            """, (generate_password_hash(new_password), user['id']))
-            conn.commit()
-            return jsonify({"success": True})
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+    password_hash = generate_password_hash(new_password)
+
+    def change_password_logic():
+        with get_db() as conn:
+            try:
+                conn.execute("""
+                    UPDATE users 
+                    SET password_hash = ?, must_change_password = 0, version = version + 1
+                    WHERE id = ?
+                """, (password_hash, user['id']))
+                record_change('users', row_id=user['id'], location_id=user['location_id'])
+                conn.commit()
+                return {"success": True}, 200
+            except Exception as e:
+                return {"error": str(e)}, 500
+
+    result, status = queue_write(change_password_logic)
+    return jsonify(result), status
 
 @app.route('/api/forgot_password', methods=['POST'])
 def forgot_password():
@@ -1221,23 +2640,28 @@ def forgot_password():
             # Security: Don't reveal if user exists or has mobile
             return jsonify({"success": True, "message": "If this user exists and has a mobile number, a code has been sent."})
             
-        # Generate 6-digit code
-        import random
-        code = str(random.randint(100000, 999999))
-        expiry = (datetime.now() + timedelta(minutes=15)).strftime('%Y-%m-%d %H:%M:%S')
-        
-        conn.execute("""
-            UPDATE users 
-            SET reset_token = ?, reset_token_expiry = ?, version = version + 1
-            WHERE id = ?
-        """, (code, expiry, user['id']))
-        conn.commit()
-        
-        # Send SMS
-        body = f"Your FUNLHN Password Reset Code is: {code}. Expires in 15 mins."
-        send_sms(user['mobile_number'], body)
-        
-        return jsonify({"success": True, "message": "If this user exists and has a mobile number, a code has been sent."})
+    # Generate 6-digit code
+    import random
+    code = str(random.randint(100000, 999999))
+    expiry = (datetime.now() + timedelta(minutes=15)).strftime('%Y-%m-%d %H:%M:%S')
+    body = f"Your FUNLHN Password Reset Code is: {code}. Expires in 15 mins."
+
+    def store_reset_token_logic():
+        with get_db() as conn:
+            conn.execute("""
+                UPDATE users 
+                SET reset_token = ?, reset_token_expiry = ?, version = version + 1
+                WHERE id = ?
+            """, (code, expiry, user['id']))
+            record_change('users', row_id=user['id'], location_id=user['location_id'])
+            # The SMS goes out with the token or not at all
+            enqueue_notification(conn.cursor(), 'sms', user['mobile_number'], body)
+            conn.commit()
+            return {"success": True}, 200
+
+    queue_write(store_reset_token_logic)
+    
+    return jsonify({"success": True, "message": "If this user exists and has a mobile number, a code has been sent."})
 
 @app.route('/api/reset_password', methods=['POST'])
 def reset_password():
@@ -1261,22 +2685,31 @@ def reset_password():
             
         if datetime.strptime(user['reset_token_expiry'], '%Y-%m-%d %H:%M:%S') < datetime.now():
             return jsonify({"error": "Code expired"}), 400
-            
-        # Update password
-        try:
-            conn.execute("""
-                UPDATE users 
-                SET password_hash = ?, reset_token = NULL, reset_token_expiry = NULL, must_change_password = 0, version = version + 1
-                WHERE id = ?
-            """, (generate_password_hash(new_password), user['id']))
-            conn.commit()
-            return jsonify({"success": True})
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+
+    password_hash = generate_password_hash(new_password)
+
+    def reset_password_logic():
+        with get_db() as conn:
+            # Update password
+            try:
+                conn.execute("""
+                    UPDATE users 
+                    SET password_hash = ?, reset_token = NULL, reset_token_expiry = NULL, must_change_password = 0, version = version + 1
+                    WHERE id = ?
+                """, (password_hash, user['id']))
+                record_change('users', row_id=user['id'], location_id=user['location_id'])
+                conn.commit()
+                return {"success": True}, 200
+            except Exception as e:
+                return {"error": str(e)}, 500
+
+    result, status = queue_write(reset_password_logic)
+    return jsonify(result), status
 
 
 # 9. REPORTS
 @app.route('/api/reports/usage', methods=['GET'])
+@cached('vials', 'drugs', 'locations')
 def usage_report():
     start_date = request.args.get('start_date', (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'))
     end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
@@ -1304,6 +2737,41 @@ def usage_report():
             'data': [dict(row) for row in usage]
         })
 
+@app.route('/api/reports/stock_on_hand', methods=['GET'])
+def stock_on_hand_report():
+    location_id = request.args.get('location_id', type=int)
+    
+    with get_db() as conn:
+        # Counters are maintained on write, so this never touches the vials table
+        report = conn.execute("""
+            SELECT 
+                l.id as location_id,
+                l.name as location_name,
+                d.id as drug_id,
+                d.name as drug_name,
+                sc.available,
+                sc.in_transit,
+                sc.expiring_30,
+                sc.expiring_90,
+                sl.min_stock,
+                sc.available * d.unit_price as stock_value
+            FROM stock_counts sc
+            JOIN locations l ON sc.location_id = l.id
+            JOIN drugs d ON sc.drug_id = d.id
+            LEFT JOIN stock_levels sl ON sl.location_id = sc.location_id AND sl.drug_id = sc.drug_id
+            WHERE (sc.available > 0 OR sc.in_transit > 0)
+            AND (? IS NULL OR sc.location_id = ?)
+            ORDER BY l.name, d.name
+        """, (location_id, location_id)).fetchall()
+        
+        data = []
+        for row in report:
+            row_dict = dict(row)
+            row_dict['below_minimum'] = bool(row['min_stock']) and row['available'] < row['min_stock']
+            data.append(row_dict)
+        
+        return jsonify({'data': data})
+
 @app.route('/api/reports/export_pdf', methods=['POST'])
 def export_pdf():
     data = request.json
@@ -1354,74 +2822,204 @@ def export_pdf():
     return send_from_directory(STATIC_FOLDER, filename, as_attachment=True)
 
 # 10. NOTIFICATION SYSTEM
-def send_sms(to_number, body):
-    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-    from_number = os.environ.get('TWILIO_FROM_NUMBER')
-
-    print(f"DEBUG: Twilio Config - SID: {'Set' if account_sid else 'Missing'}, Token: {'Set' if auth_token else 'Missing'}, From: {from_number}")
-
-    if not all([account_sid, auth_token, from_number]):
-        logging.info(f"--- SMS SIMULATION (Configure TWILIO env vars to send real SMS) ---\nTo: {to_number}\nBody: {body}\n--------------------------------")
-        print("DEBUG: SMS Simulation Mode (Missing Env Vars)")
-        return True
-
-    try:
-        client = Client(account_sid, auth_token)
-        message = client.messages.create(
-            body=body,
-            from_=from_number,
-            to=to_number
-        )
-        logging.info(f"SMS sent successfully to {to_number}: {message.sid}")
-        print(f"DEBUG: SMS Sent Successfully! SID: {message.sid}")
-        return True
-    except Exception as e:
-        logging.error(f"Failed to send SMS: {e}")
-        print(f"DEBUG: SMS FAILED: {str(e)}")
-        return False
-
-def send_email(to_email, subject, body):
-    # Outlook / Office 365 SMTP Settings
-    SMTP_SERVER = "smtp.office365.com"
-    SMTP_PORT = 587
-    
-    # Try to get credentials from environment variables, or use placeholders
-    SENDER_EMAIL = os.environ.get('SMTP_EMAIL', "your_email@funlhn.health")
-    SENDER_PASSWORD = os.environ.get('SMTP_PASSWORD', "")
-    
-    message = MIMEMultipart("alternative")
-    message["Subject"] = subject
-    message["From"] = SENDER_EMAIL
-    message["To"] = to_email
-    
-    message.attach(MIMEText(body, "plain"))
-    
-    try:
-        if not SENDER_PASSWORD:
-            # Fallback to logging if no password configured
-            logging.info(f"--- EMAIL SIMULATION (Configure SMTP_PASSWORD to send real emails) ---\nTo: {to_email}\nSubject: {subject}\nBody:\n{body}\n--------------------------------")
-            return True
-
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.sendmail(SENDER_EMAIL, to_email, message.as_string())
-            
-        logging.info(f"Email sent successfully to {to_email}")
-        return True
-    except Exception as e:
-        logging.error(f"Failed to send email: {e}")
-        return False
+# Transactional outbox: a write that should notify someone inserts into
+# notification_outbox in its own transaction (enqueue_notification) and the
+# request returns. One dispatcher per channel sends what is due from a small
+# pool of sender threads, each keeping its SMTP session or Twilio client
+# open, then records the outcomes in one write. Failures are retried with
+# exponential backoff until NOTIFY_MAX_ATTEMPTS. Delivery is at least once:
+# a crash between sending and recording sends that message again.
+SMTP_SERVER = os.environ.get('SMTP_SERVER', "smtp.office365.com")
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+LOW_STOCK_EMAIL = os.environ.get('LOW_STOCK_EMAIL', "pharmacy.hub@funlhn.health")
+# Local stand-in for both providers: messages are appended here as JSON lines
+NOTIFY_SINK = os.environ.get('NOTIFY_SINK')
+NOTIFY_CONCURRENCY = {
+    'email': int(os.environ.get('NOTIFY_EMAIL_CONCURRENCY', 2)),
+    'sms': int(os.environ.get('NOTIFY_SMS_CONCURRENCY', 4))
+}
+NOTIFY_MAX_ATTEMPTS = 8
+NOTIFY_BACKOFF_BASE = 30  # seconds; doubles with each failed attempt
+NOTIFY_BACKOFF_MAX = 3600
+NOTIFY_BATCH = 50
+NOTIFY_POLL_INTERVAL = 30  # seconds; commits wake the dispatchers sooner
+NOTIFY_ERROR_PAUSE = 5  # seconds a dispatcher waits after an unexpected error
+
+def make_transport(channel):
+    if NOTIFY_SINK:
+        return SinkTransport(channel, NOTIFY_SINK)
+    if channel == 'email':
+        sender = os.environ.get('SMTP_EMAIL', "your_email@funlhn.health")
+        password = os.environ.get('SMTP_PASSWORD', "")
+        if password:
+            return SmtpTransport(SMTP_SERVER, SMTP_PORT, sender, password)
+    else:
+        account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+        auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+        from_number = os.environ.get('TWILIO_FROM_NUMBER')
+        if all([account_sid, auth_token, from_number]):
+            return TwilioTransport(account_sid, auth_token, from_number)
+    # Not configured: log what would have been sent
+    return SinkTransport(channel)
+
+def enqueue_notification(cursor, channel, recipient, body, subject=None):
+    """Queue a message in the current write transaction; it is sent once that commits."""
+    now = datetime.now()
+    cursor.execute("""
+        INSERT INTO notification_outbox (channel, recipient, subject, body, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (channel, recipient, subject, body, now, now))
+    record_change('notification_outbox', row_id=cursor.lastrowid)
+
+class OutboxDispatcher:
+    def __init__(self, channel, concurrency):
+        self.channel = channel
+        self._wake = threading.Event()
+        self._senders = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"notify-{channel}")
+        self._transports = threading.local()
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+
+    def wake(self):
+        self._wake.set()
+
+    def _send(self, row):
+        # Runs in a sender thread; each keeps its own transport (and connection)
+        transport = getattr(self._transports, 'transport', None)
+        if transport is None:
+            transport = self._transports.transport = make_transport(self.channel)
+        try:
+            transport.send(row['recipient'], row['subject'], row['body'])
+            return row, None, False
+        except SendError as e:
+            return row, str(e), e.permanent
+        except Exception as e:
+            return row, str(e), False
 
-def send_low_stock_notification(stock_info):
-    # Log it
-    logging.info(f"LOW STOCK ALERT: {stock_info['drug_name']} at {stock_info['location_name']} - Only {stock_info['available_count']} remaining")
-    
-    receiver_email = "pharmacy.hub@funlhn.health"
+    def _due(self):
+        conn = db_pool.acquire()
+        try:
+            rows = conn.execute("""
+                SELECT id, recipient, subject, body, attempts FROM notification_outbox
+                WHERE channel = ? AND status = 'PENDING' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            """, (self.channel, datetime.now(), NOTIFY_BATCH)).fetchall()
+            next_due = conn.execute("""
+                SELECT MIN(next_attempt_at) FROM notification_outbox
+                WHERE channel = ? AND status = 'PENDING'
+            """, (self.channel,)).fetchone()[0]
+        finally:
+            db_pool.release(conn)
+        return rows, next_due
+
+    def _record(self, outcomes):
+        def record_logic():
+            with get_db() as conn:
+                now = datetime.now()
+                for row, error, permanent in outcomes:
+                    attempts = row['attempts'] + 1
+                    if error is None:
+                        conn.execute("""
+                            UPDATE notification_outbox SET status = 'SENT', attempts = ?, sent_at = ?, last_error = NULL
+                            WHERE id = ?
+                        """, (attempts, now, row['id']))
+                    elif permanent or attempts >= NOTIFY_MAX_ATTEMPTS:
+                        conn.execute("""
+                            UPDATE notification_outbox SET status = 'FAILED', attempts = ?, last_error = ?
+                            WHERE id = ?
+                        """, (attempts, error, row['id']))
+                    else:
+                        retry_at = now + timedelta(seconds=backoff(attempts, NOTIFY_BACKOFF_BASE, NOTIFY_BACKOFF_MAX))
+                        conn.execute("""
+                            UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ?
+                            WHERE id = ?
+                        """, (attempts, retry_at, error, row['id']))
+                conn.commit()
+                return {"success": True}, 200
+
+        # Until this lands the messages would be sent again, so keep trying
+        while True:
+            try:
+                queue_write(record_logic)
+                return
+            except (WriteQueueFull, WriteTimeout) as e:
+                logging.warning(f"Recording {self.channel} outcomes deferred: {str(e)}")
+                time.sleep(1)
+
+    def _dispatch(self):
+        """Send and record one batch of due messages, or wait for the next."""
+        try:
+            rows, next_due = self._due()
+        except (sqlite3.Error, PoolTimeout) as e:
+            logging.error(f"Notification outbox read failed: {str(e)}")
+            rows, next_due = [], None
+        if not rows:
+            wait = NOTIFY_POLL_INTERVAL
+            if next_due is not None:
+                wait = min(wait, max((datetime.fromisoformat(str(next_due)) - datetime.now()).total_seconds(), 0.1))
+            self._wake.wait(wait)
+            return
+
+        outcomes = list(self._senders.map(self._send, rows))
+        for row, error, permanent in outcomes:
+            if error is None:
+                self.stats['sent'] += 1
+            elif permanent or row['attempts'] + 1 >= NOTIFY_MAX_ATTEMPTS:
+                self.stats['failed'] += 1
+                logging.error(f"Giving up on {self.channel} {row['id']} to {row['recipient']}: {error}")
+            else:
+                self.stats['retried'] += 1
+                logging.warning(f"{self.channel} {row['id']} to {row['recipient']} failed, will retry: {error}")
+        self.stats['batches'] += 1
+        self._record(outcomes)
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self._dispatch()
+            except Exception as e:
+                # Outcomes that were not recorded leave their messages PENDING,
+                # so they are sent again (delivery is at least once)
+                logging.error(f"{self.channel} dispatcher error: {str(e)}")
+                self._wake.wait(NOTIFY_ERROR_PAUSE)
+
+    def snapshot(self):
+        return dict(self.stats)
+
+notification_dispatchers = {channel: OutboxDispatcher(channel, limit) for channel, limit in NOTIFY_CONCURRENCY.items()}
+for dispatcher in notification_dispatchers.values():
+    threading.Thread(target=dispatcher.run, daemon=True, name=f"outbox-{dispatcher.channel}").start()
+
+@on_commit
+def _wake_notification_dispatchers(changes):
+    if any(change['table'] == 'notification_outbox' for change in changes):
+        for dispatcher in notification_dispatchers.values():
+            dispatcher.wake()
+
+# Low stock alerts are coalesced per location/drug. The first drop below
+# minimum is emailed straight away; further drops within the repeat window
+# are only emailed when they reach a worse level (half the minimum, then
+# none left), and otherwise wait for the next per-hub digest, which goes to
+# that hub's pharmacists (LOW_STOCK_EMAIL if none of them has an address).
+LOW_STOCK_REPEAT_WINDOW = timedelta(hours=float(os.environ.get('LOW_STOCK_REPEAT_WINDOW_HOURS', 4)))
+LOW_STOCK_DIGEST_INTERVAL = int(os.environ.get('LOW_STOCK_DIGEST_MINUTES', 60)) * 60
+LOW_STOCK_LEVELS = {1: 'LOW STOCK', 2: 'CRITICALLY LOW STOCK', 3: 'OUT OF STOCK'}
+
+low_stock_stats = {'alerts': 0, 'escalations': 0, 'suppressed': 0, 'digests': 0, 'cleared': 0}
+
+def low_stock_level(available, min_stock):
+    if available <= 0:
+        return 3
+    if available * 2 <= min_stock:
+        return 2
+    return 1
+
+def enqueue_low_stock_notification(cursor, stock_info, level=1):
+    logging.info(f"{LOW_STOCK_LEVELS[level]} ALERT: {stock_info['drug_name']} at {stock_info['location_name']} - Only {stock_info['available_count']} remaining")
     
     text = f"""\
-    Low Stock Alert
+    {LOW_STOCK_LEVELS[level].title()} Alert
     
     Drug: {stock_info['drug_name']}
     Location: {stock_info['location_name']}
@@ -1431,9 +3029,97 @@ def send_low_stock_notification(stock_info):
     Please replenish immediately.
     """
     
-    send_email(receiver_email, f"LOW STOCK ALERT: {stock_info['drug_name']}", text)
+    enqueue_notification(cursor, 'email', LOW_STOCK_EMAIL, text, subject=f"{LOW_STOCK_LEVELS[level]} ALERT: {stock_info['drug_name']}")
+
+def note_low_stock(cursor, location_id, drug_id, stock_info):
+    """Alert on a location/drug that is below minimum, unless it was alerted
+    recently at the same or a worse level. Returns True if an email was queued."""
+    level = low_stock_level(stock_info['available_count'], stock_info['min_stock'])
+    now = datetime.now()
+    state = cursor.execute("""
+        SELECT level, alerted_at < ? AS expired FROM low_stock_alerts
+        WHERE location_id = ? AND drug_id = ?
+    """, (now - LOW_STOCK_REPEAT_WINDOW, location_id, drug_id)).fetchone()
+
+    if state is not None and not state['expired'] and level <= state['level']:
+        cursor.execute(
+            "UPDATE low_stock_alerts SET pending = 1 WHERE location_id = ? AND drug_id = ?",
+            (location_id, drug_id)
+        )
+        low_stock_stats['suppressed'] += 1
+        return False
+
+    cursor.execute("""
+        INSERT OR REPLACE INTO low_stock_alerts (location_id, drug_id, level, alerted_at, pending)
+        VALUES (?, ?, ?, ?, 0)
+    """, (location_id, drug_id, level, now))
+    enqueue_low_stock_notification(cursor, stock_info, level)
+    low_stock_stats['escalations' if state is not None and not state['expired'] else 'alerts'] += 1
+    return True
+
+def hub_digest_recipients(cursor, hub_id):
+    rows = cursor.execute("""
+        SELECT DISTINCT email FROM users
+        WHERE location_id = ? AND role = 'PHARMACIST' AND is_active = 1 AND COALESCE(email, '') != ''
+        ORDER BY email
+    """, (hub_id,)).fetchall()
+    return [row['email'] for row in rows] or [LOW_STOCK_EMAIL]
+
+def send_low_stock_digests(cursor):
+    """One pass over the alert state and current counts: forget pairs that
+    are back at minimum and email each hub the drops that were held back."""
+    rows = cursor.execute("""
+        SELECT 
+            a.location_id, a.drug_id, a.pending,
+            COALESCE(sc.available, 0) as available_count,
+            COALESCE(sl.min_stock, 0) as min_stock,
+            l.name as location_name,
+            d.name as drug_name,
+            h.id as hub_id,
+            h.name as hub_name
+        FROM low_stock_alerts a
+        JOIN locations l ON l.id = a.location_id
+        JOIN locations h ON h.id = CASE WHEN l.type = 'HUB' THEN l.id ELSE COALESCE(l.parent_hub_id, l.id) END
+        JOIN drugs d ON d.id = a.drug_id
+        LEFT JOIN stock_counts sc ON sc.location_id = a.location_id AND sc.drug_id = a.drug_id
+        LEFT JOIN stock_levels sl ON sl.location_id = a.location_id AND sl.drug_id = a.drug_id
+        ORDER BY h.name, l.name, d.name
+    """).fetchall()
+
+    recovered, digests = [], {}
+    for row in rows:
+        if row['available_count'] >= row['min_stock']:
+            recovered.append((row['location_id'], row['drug_id']))
+        elif row['pending']:
+            digests.setdefault((row['hub_id'], row['hub_name']), []).append(row)
+
+    cursor.executemany("DELETE FROM low_stock_alerts WHERE location_id = ? AND drug_id = ?", recovered)
+    low_stock_stats['cleared'] += len(recovered)
+
+    now = datetime.now()
+    for (hub_id, hub_name), items in digests.items():
+        lines = "\n".join(
+            f"    {LOW_STOCK_LEVELS[low_stock_level(item['available_count'], item['min_stock'])]:<22}"
+            f"{item['drug_name']} at {item['location_name']}: {item['available_count']} of {item['min_stock']}"
+            for item in items
+        )
+        text = f"""\
+    Low Stock Digest - {hub_name}
+    
+{lines}
+    
+    Each of these was alerted earlier and has dropped again since.
+    """
+        for recipient in hub_digest_recipients(cursor, hub_id):
+            enqueue_notification(cursor, 'email', recipient, text,
+                                 subject=f"LOW STOCK DIGEST: {hub_name} ({len(items)} items)")
+        cursor.executemany(
+            "UPDATE low_stock_alerts SET pending = 0, alerted_at = ? WHERE location_id = ? AND drug_id = ?",
+            [(now, item['location_id'], item['drug_id']) for item in items]
+        )
+        low_stock_stats['digests'] += 1
+    return len(digests)
 
-# 11. SETTINGS
 # 11. SETTINGS
 @app.route('/api/settings', methods=['GET', 'POST'])
 def handle_settings():
@@ -1466,62 +3152,354 @@ def handle_settings():
     if not location_id:
         return jsonify({"error": "Location ID required"}), 400
 
-    with get_db() as conn:
-        cursor = conn.cursor()
-        # Ensure table exists (migration for existing DBs)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                location_id INTEGER,
-                printer_ip TEXT,
-                printer_port TEXT,
-                label_width INTEGER DEFAULT 50,
-                label_height INTEGER DEFAULT 25,
-                margin_top INTEGER DEFAULT 0,
-                margin_right INTEGER DEFAULT 0,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    def save_settings_logic():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Check if row exists for this location
+            existing = cursor.execute("SELECT id FROM settings WHERE location_id = ?", (location_id,)).fetchone()
 
-        # Migration: Add columns if they don't exist (for existing DBs)
-        try:
-            cursor.execute("ALTER TABLE settings ADD COLUMN location_id INTEGER")
-        except sqlite3.OperationalError:
-            pass
+            if existing:
+                cursor.execute("""
+                    UPDATE settings 
+                    SET printer_ip = ?, printer_port = ?, label_width = ?, label_height = ?, margin_top = ?, margin_right = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (printer_ip, printer_port, label_width, label_height, margin_top, margin_right, existing['id']))
+            else:
+                cursor.execute("""
+                    INSERT INTO settings (location_id, printer_ip, printer_port, label_width, label_height, margin_top, margin_right)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (location_id, printer_ip, printer_port, label_width, label_height, margin_top, margin_right))
+            record_change('settings', location_id=location_id)
+        
+            conn.commit()
+            return {"success": True}, 200
+
+    result, status = queue_write(save_settings_logic)
+    return jsonify(result), status
+
+# Label printing. generate_labels only records a print job; a spooler
+# thread starts one worker per printer (ip, port), which keeps its raw
+# socket open between jobs, looks a job's assets up in one query and streams
+# the labels in chunks, recording progress after each. A dropped connection
+# is reopened and the job resumes after the last chunk recorded, so a label
+# may print twice but is never skipped.
+#
+# Labels are printed from a ZPL stored format (^DF) compiled once per
+# location from its settings: the worker downloads the format to the
+# printer's RAM once per connection, and each label then carries only ^XF
+# and its field data. Compiled formats are cached until the location's
+# settings change.
+PRINT_CHUNK = 50  # labels per send and per progress update
+PRINT_TIMEOUT = 10  # seconds for connect and each send
+PRINT_IDLE_TIMEOUT = 30  # close a printer connection unused for this long
+PRINT_MAX_ATTEMPTS = 5
+PRINT_BACKOFF_BASE = 2  # seconds; doubles with each failed attempt
+PRINT_BACKOFF_MAX = 60
+PRINT_JOB_MAX_LABELS = 1000
+
+def label_layout(settings):
+    """Offsets for the label content from a location's printer settings."""
+    # Calculate Offsets (203 DPI = 8 dots/mm)
+    dpi = 8
+    margin_top_mm = settings.get('margin_top', 0) or 0
+    margin_right_mm = settings.get('margin_right', 0) or 0
+    label_width_mm = settings.get('label_width', 50) or 50
+    
+    # Top Offset
+    top_offset_dots = int(margin_top_mm * dpi)
+    
+    # Left Offset calculation
+    content_width_mm = 45
+    
+    # Calculate X position
+    if margin_right_mm > 0:
+        x_pos = int((label_width_mm - margin_right_mm - content_width_mm) * dpi)
+        if x_pos < 0: x_pos = 0
+    else:
+        x_pos = 20 # Default left margin
+    return x_pos, top_offset_dots
+
+LabelFormat = namedtuple('LabelFormat', 'name download')
+
+def compile_label_format(settings):
+    """The ^DF download defining a location's label layout, and its name."""
+    x_pos, top_offset_dots = label_layout(settings)
+    # ^FN1..5: QR data, drug, expiry, asset ID, storage temperature
+    body = (
+        f"^CI28^LH{x_pos},{top_offset_dots}"
+        "^FO0,20^BQN,2,4^FN1^FS"
+        "^FO120,20^A0N,30,30^FN2^FS"
+        "^FO120,55^A0N,25,25^FN3^FS"
+        "^FO120,85^A0N,25,25^FN4^FS"
+        "^FO120,115^A0N,20,20^FN5^FS"
+    )
+    # Named after the layout, so locations sharing one share the stored format
+    name = f"R:VL{hashlib.blake2b(body.encode(), digest_size=3).hexdigest().upper()}.ZPL"
+    return LabelFormat(name, f"^XA^DF{name}^FS{body}^XZ\n".encode('utf-8'))
+
+def render_label(compiled, vial):
+    """One label as a recall of the stored format with its field data."""
+    asset_id = vial['asset_id']
+    return (
+        f"^XA^XF{compiled.name}^FS^CI28"
+        f"^FN1^FDQA,{asset_id}^FS"
+        f"^FN2^FD{vial['drug_name'][:20]}^FS"
+        f"^FN3^FDExp: {vial['expiry_date']}^FS"
+        f"^FN4^FD{asset_id}^FS"
+        f"^FN5^FD{vial['storage_temp']}^FS^XZ\n"
+    )
+
+_label_formats = {}  # location_id -> LabelFormat
+_label_formats_lock = threading.Lock()
+_label_formats_generation = 0  # bumped on invalidation
+
+def label_format(location_id):
+    with _label_formats_lock:
+        compiled = _label_formats.get(location_id)
+        generation = _label_formats_generation
+    if compiled is None:
+        conn = db_pool.acquire()
         try:
-            cursor.execute("ALTER TABLE settings ADD COLUMN label_width INTEGER DEFAULT 50")
-        except sqlite3.OperationalError:
-            pass
+            settings = conn.execute("SELECT * FROM settings WHERE location_id = ? LIMIT 1", (location_id,)).fetchone()
+        finally:
+            db_pool.release(conn)
+        compiled = compile_label_format(dict(settings) if settings else {})
+        with _label_formats_lock:
+            # Settings saved while we were reading may be newer than what we compiled
+            if generation == _label_formats_generation:
+                _label_formats[location_id] = compiled
+    return compiled
+
+def invalidate_label_formats(location_id=None):
+    """Forget compiled formats for one location, or all of them."""
+    global _label_formats_generation
+    with _label_formats_lock:
+        _label_formats_generation += 1
+        if location_id is None:
+            _label_formats.clear()
+        else:
+            # /api/settings passes location_id through as posted, often a string
+            _label_formats.pop(int(location_id), None)
+
+@on_commit
+def _invalidate_label_formats(changes):
+    for change in changes:
+        if change['table'] == 'settings':
+            invalidate_label_formats(change['location_id'])
+
+class PrinterWorker:
+    """Prints the jobs for one printer, oldest first, over one connection."""
+
+    def __init__(self, printer_ip, printer_port):
+        self.address = (printer_ip, printer_port)
+        self._sock = None
+        self._used_at = 0
+        self._formats = set()  # stored formats downloaded over this connection
+        self._wake = threading.Event()
+        self.stats = {'jobs': 0, 'labels': 0, 'failed': 0, 'reconnects': 0, 'connected': False,
+                      'format_downloads': 0, 'bytes': 0}
+
+    def wake(self):
+        self._wake.set()
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            self._formats.clear()
+            self.stats['connected'] = False
+
+    def _peer_closed(self):
+        # A send on a socket the printer has closed still "succeeds" once,
+        # losing that chunk - so look for the close before sending
         try:
-            cursor.execute("ALTER TABLE settings ADD COLUMN label_height INTEGER DEFAULT 25")
-        except sqlite3.OperationalError:
-            pass
+            self._sock.setblocking(False)
+            while True:
+                if not self._sock.recv(4096):  # Status replies are discarded
+                    return True
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            self._sock.settimeout(PRINT_TIMEOUT)
+
+    def _send(self, data, label_format=None):
+        if self._sock is not None and (time.monotonic() - self._used_at > PRINT_IDLE_TIMEOUT or self._peer_closed()):
+            self._close()
+        # A connection the printer dropped only fails when used: reopen it once
+        for attempt in (1, 2):
+            if self._sock is None:
+                self._sock = socket.create_connection(self.address, timeout=PRINT_TIMEOUT)
+                self.stats['reconnects'] += 1
+                self.stats['connected'] = True
+            payload = data
+            if label_format is not None and label_format.name not in self._formats:
+                # Stored formats live in printer RAM: send it ahead of the labels
+                # once per connection, which also covers a printer restart
+                payload = label_format.download + data
+            try:
+                self._sock.sendall(payload)
+                self._used_at = time.monotonic()
+                self.stats['bytes'] += len(payload)
+                if payload is not data:
+                    self._formats.add(label_format.name)
+                    self.stats['format_downloads'] += 1
+                return
+            except OSError:
+                self._close()
+                if attempt == 2:
+                    raise
+
+    def _next_job(self):
+        conn = db_pool.acquire()
         try:
-            cursor.execute("ALTER TABLE settings ADD COLUMN margin_top INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
+            job = conn.execute("""
+                SELECT * FROM print_jobs
+                WHERE printer_ip = ? AND printer_port = ? AND status IN ('QUEUED', 'PRINTING')
+                ORDER BY id LIMIT 1
+            """, self.address).fetchone()
+            if job is None:
+                return None, None
+            # Every asset of the job in one lookup
+            asset_ids = json.loads(job['asset_ids'])
+            vials = {row['asset_id']: row for row in conn.execute("""
+                SELECT v.asset_id, v.expiry_date, d.name as drug_name, d.storage_temp
+                FROM vials v
+                JOIN drugs d ON v.drug_id = d.id
+                WHERE v.asset_id IN (SELECT value FROM json_each(?))
+            """, (job['asset_ids'],))}
+        finally:
+            db_pool.release(conn)
+        labels = [vials[asset_id] for asset_id in asset_ids if asset_id in vials]
+        return job, labels
+
+    def _update(self, job_id, status=None, printed=None, total=None, attempts=None, last_error=None,
+                started_at=None, finished_at=None):
+        # Fields left as None keep their value
+        def update_logic():
+            with get_db() as conn:
+                conn.execute("""
+                    UPDATE print_jobs SET
+                        status = COALESCE(?, status),
+                        printed = COALESCE(?, printed),
+                        total = COALESCE(?, total),
+                        attempts = COALESCE(?, attempts),
+                        last_error = COALESCE(?, last_error),
+                        started_at = COALESCE(?, started_at),
+                        finished_at = COALESCE(?, finished_at)
+                    WHERE id = ?
+                """, (status, printed, total, attempts, last_error, started_at, finished_at, job_id))
+                record_change('print_jobs', row_id=job_id)
+                conn.commit()
+                return {"success": True}, 200
+
+        queue_write(update_logic)
+
+    def _print(self, job, labels):
+        if job['status'] == 'QUEUED':
+            self._update(job['id'], status='PRINTING', started_at=datetime.now())
+        compiled = label_format(job['location_id'])
+        printed = job['printed']
+        while printed < len(labels):
+            chunk = labels[printed:printed + PRINT_CHUNK]
+            self._send(''.join(render_label(compiled, vial) for vial in chunk).encode('utf-8'), compiled)
+            printed += len(chunk)
+            self.stats['labels'] += len(chunk)
+            if printed < len(labels):
+                self._update(job['id'], printed=printed)
+        self._update(job['id'], status='DONE', printed=printed, total=len(labels), finished_at=datetime.now())
+        self.stats['jobs'] += 1
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                job, labels = self._next_job()
+            except Exception as e:
+                logging.error(f"Print spooler read failed: {str(e)}")
+                job = None
+            if job is None:
+                if not self._wake.wait(PRINT_IDLE_TIMEOUT):
+                    self._close()
+                continue
+
+            try:
+                self._print(job, labels)
+            except (WriteQueueFull, WriteTimeout) as e:
+                logging.warning(f"Print job {job['id']} progress not recorded: {str(e)}")
+                time.sleep(1)
+            except Exception as e:
+                # Printer errors, and anything else that stops a job (database
+                # errors, bad label data), count as a failed attempt
+                if isinstance(e, OSError):
+                    self._close()
+                    self._attempt_failed(job, str(e))
+                else:
+                    self._attempt_failed(job, f"{type(e).__name__}: {e}")
+
+    def _attempt_failed(self, job, error):
+        attempts = job['attempts'] + 1
+        logging.error(f"Printer {self.address[0]}:{self.address[1]} error on job {job['id']} (attempt {attempts}): {error}")
         try:
-            cursor.execute("ALTER TABLE settings ADD COLUMN margin_right INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
-        
-        # Check if row exists for this location
-        existing = cursor.execute("SELECT id FROM settings WHERE location_id = ?", (location_id,)).fetchone()
+            if attempts >= PRINT_MAX_ATTEMPTS:
+                self._update(job['id'], status='FAILED', attempts=attempts, last_error=error, finished_at=datetime.now())
+                self.stats['failed'] += 1
+            else:
+                self._update(job['id'], attempts=attempts, last_error=error)
+                self._wake.wait(backoff(attempts, PRINT_BACKOFF_BASE, PRINT_BACKOFF_MAX))
+        except Exception as e:
+            # The job stays active and is picked up again
+            logging.warning(f"Print job {job['id']} failure not recorded: {str(e)}")
+            time.sleep(1)
 
-        if existing:
-            cursor.execute("""
-                UPDATE settings 
-                SET printer_ip = ?, printer_port = ?, label_width = ?, label_height = ?, margin_top = ?, margin_right = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            """, (printer_ip, printer_port, label_width, label_height, margin_top, margin_right, existing['id']))
-        else:
-            cursor.execute("""
-                INSERT INTO settings (location_id, printer_ip, printer_port, label_width, label_height, margin_top, margin_right)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (location_id, printer_ip, printer_port, label_width, label_height, margin_top, margin_right))
-        
-        conn.commit()
-        return jsonify({"success": True})
+class PrintSpooler:
+    """Starts a worker for each printer with active jobs and wakes it on new ones."""
+    POLL_INTERVAL = 30
+
+    def __init__(self):
+        self._workers = {}
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                conn = db_pool.acquire()
+                try:
+                    printers = conn.execute("""
+                        SELECT DISTINCT printer_ip, printer_port FROM print_jobs
+                        WHERE status IN ('QUEUED', 'PRINTING')
+                    """).fetchall()
+                finally:
+                    db_pool.release(conn)
+            except (sqlite3.Error, PoolTimeout) as e:
+                logging.error(f"Print spooler read failed: {str(e)}")
+                printers = []
+            for printer_ip, printer_port in printers:
+                worker = self._workers.get((printer_ip, printer_port))
+                if worker is None:
+                    worker = self._workers[(printer_ip, printer_port)] = PrinterWorker(printer_ip, printer_port)
+                    threading.Thread(target=worker.run, daemon=True, name=f"printer-{printer_ip}:{printer_port}").start()
+                worker.wake()
+            self._wake.wait(self.POLL_INTERVAL)
+
+    def snapshot(self):
+        return {f"{ip}:{port}": dict(worker.stats) for (ip, port), worker in list(self._workers.items())}
+
+print_spooler = PrintSpooler()
+threading.Thread(target=print_spooler.run, daemon=True, name='print-spooler').start()
+
+@on_commit
+def _wake_print_spooler(changes):
+    if any(change['table'] == 'print_jobs' for change in changes):
+        print_spooler.wake()
 
 @app.route('/api/generate_labels', methods=['POST'])
 def generate_labels():
@@ -1531,6 +3509,8 @@ def generate_labels():
     
     if not asset_ids:
         return jsonify({"error": "No assets provided"}), 400
+    if len(asset_ids) > PRINT_JOB_MAX_LABELS:
+        return jsonify({"error": f"At most {PRINT_JOB_MAX_LABELS} labels per print job"}), 400
         
     if not location_id:
         return jsonify({"error": "Location ID required"}), 400
@@ -1539,73 +3519,44 @@ def generate_labels():
         # Get printer settings for this location
         settings = conn.execute("SELECT * FROM settings WHERE location_id = ? LIMIT 1", (location_id,)).fetchone()
         
-        if not settings:
-             return jsonify({"error": "Printer not configured for this location"}), 400
+    if not settings:
+         return jsonify({"error": "Printer not configured for this location"}), 400
 
-        # Convert to dict to use .get() safely
-        settings_dict = dict(settings)
-        
-        if not settings_dict.get('printer_ip'):
-            return jsonify({"error": "Printer IP not configured"}), 400
-            
-        printer_ip = settings_dict['printer_ip']
-        printer_port = int(settings_dict['printer_port'] or 9100)
-        
-        # Calculate Offsets (203 DPI = 8 dots/mm)
-        dpi = 8
-        margin_top_mm = settings_dict.get('margin_top', 0) or 0
-        margin_right_mm = settings_dict.get('margin_right', 0) or 0
-        label_width_mm = settings_dict.get('label_width', 50) or 50
-        
-        # Top Offset
-        top_offset_dots = int(margin_top_mm * dpi)
-        
-        # Left Offset calculation
-        content_width_mm = 45
-        
-        # Calculate X position
-        if margin_right_mm > 0:
-            x_pos = int((label_width_mm - margin_right_mm - content_width_mm) * dpi)
-            if x_pos < 0: x_pos = 0
-        else:
-            x_pos = 20 # Default left margin
-            
-        try:
-            # Connect to printer
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5) # 5 second timeout
-                s.connect((printer_ip, printer_port))
-                
-                for asset_id in asset_ids:
-                    # Get drug info for this asset
-                    vial = conn.execute("""
-                        SELECT v.*, d.name as drug_name, d.storage_temp 
-                        FROM vials v
-                        JOIN drugs d ON v.drug_id = d.id
-                        WHERE v.asset_id = ?
-                    """, (asset_id,)).fetchone()
-                    
-                    if vial:
-                        # Generate ZPL
-                        # Using calculated offsets and ^CI28 for UTF-8 support
-                        zpl = f"""
-                        ^XA
-                        ^CI28
-                        ^LH{x_pos},{top_offset_dots}
-                        ^FO0,20^BQN,2,4^FDQA,{asset_id}^FS
-                        ^FO120,20^A0N,30,30^FD{vial['drug_name'][:20]}^FS
-                        ^FO120,55^A0N,25,25^FDExp: {vial['expiry_date']}^FS
-                        ^FO120,85^A0N,25,25^FD{asset_id}^FS
-                        ^FO120,115^A0N,20,20^FD{vial['storage_temp']}^FS
-                        ^XZ
-                        """
-                        s.sendall(zpl.encode('utf-8'))
-                        
-            return jsonify({"success": True, "message": f"Sent {len(asset_ids)} labels to printer"})
-            
-        except Exception as e:
-            logging.error(f"Printer error: {str(e)}")
-            return jsonify({"error": f"Printer connection failed: {str(e)}"}), 500
+    if not settings['printer_ip']:
+        return jsonify({"error": "Printer IP not configured"}), 400
+
+    try:
+        printer_port = int(settings['printer_port'] or 9100)
+    except ValueError:
+        return jsonify({"error": "Printer port is not a number"}), 400
+
+    def create_print_job_logic():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO print_jobs (location_id, printer_ip, printer_port, asset_ids, total, created_by, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (location_id, settings['printer_ip'], printer_port, json.dumps(asset_ids), len(asset_ids),
+                  data.get('user_id'), datetime.now()))
+            record_change('print_jobs', row_id=cursor.lastrowid, location_id=location_id)
+            conn.commit()
+            return {"success": True, "job_id": cursor.lastrowid,
+                    "message": f"Queued {len(asset_ids)} labels for printing"}, 202
+
+    result, status = queue_write(create_print_job_logic)
+    return jsonify(result), status
+
+@app.route('/api/print_jobs/<int:job_id>', methods=['GET'])
+def get_print_job(job_id):
+    with get_db() as conn:
+        job = conn.execute("""
+            SELECT id, location_id, printer_ip, printer_port, status, total, printed, attempts, last_error,
+                   created_at, started_at, finished_at
+            FROM print_jobs WHERE id = ?
+        """, (job_id,)).fetchone()
+    if not job:
+        return jsonify({"error": "Print job not found"}), 404
+    return jsonify(dict(job))
 
 # 12. HEARTBEAT & MONITORING
 last_heartbeat = time.time()
@@ -1618,12 +3569,144 @@ def monitor():
             logging.warning("Heartbeat timeout - shutting down")
             os._exit(0)
 
+# WAL checkpointing runs here rather than on the writer's commit path
+WAL_CHECKPOINT_INTERVAL = int(os.environ.get('WAL_CHECKPOINT_INTERVAL', 60))
+WAL_TRUNCATE_BYTES = int(os.environ.get('WAL_TRUNCATE_BYTES', 64 * 1024 * 1024))
+
+checkpoint_stats = {
+    'runs': 0,
+    'truncates': 0,
+    'busy': 0,
+    'last_run': None,
+    'last_wal_frames': 0,
+    'last_checkpointed': 0
+}
+
+def checkpointer():
+    conn = _connect()
+    # Give up quickly rather than stall the writer behind a long-lived reader
+    conn.execute("PRAGMA busy_timeout = 1000")
+    while True:
+        time.sleep(WAL_CHECKPOINT_INTERVAL)
+        wal_file = DB_FILE + '-wal'
+        if not os.path.exists(wal_file):
+            continue
+        mode = 'TRUNCATE' if os.path.getsize(wal_file) > WAL_TRUNCATE_BYTES else 'PASSIVE'
+        try:
+            busy, wal_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"WAL checkpoint failed: {str(e)}")
+            continue
+        checkpoint_stats['runs'] += 1
+        checkpoint_stats['truncates'] += 1 if mode == 'TRUNCATE' and not busy else 0
+        checkpoint_stats['busy'] += busy
+        checkpoint_stats['last_run'] = datetime.now().isoformat()
+        checkpoint_stats['last_wal_frames'] = wal_frames
+        checkpoint_stats['last_checkpointed'] = checkpointed
+
+def change_log_pruner():
+    # Retention for /api/changes: clients idle for longer have to resync
+    while True:
+        time.sleep(CHANGE_LOG_PRUNE_INTERVAL)
+
+        def prune_logic():
+            with get_db() as conn:
+                pruned = prune_change_log(conn.cursor(), datetime.now() - timedelta(days=CHANGE_LOG_RETENTION_DAYS))
+                if pruned:
+                    logging.info(f"Pruned {pruned} change log entries")
+                conn.commit()
+                return {"success": True}, 200
+
+        try:
+            queue_write(prune_logic)
+        except (WriteQueueFull, WriteTimeout) as e:
+            logging.warning(f"Change log pruning deferred: {str(e)}")
+        except Exception as e:
+            logging.error(f"Change log pruning failed: {str(e)}")
+
+def low_stock_digester():
+    while True:
+        time.sleep(LOW_STOCK_DIGEST_INTERVAL)
+
+        def digest_logic():
+            with get_db() as conn:
+                sent = send_low_stock_digests(conn.cursor())
+                if sent:
+                    logging.info(f"Queued {sent} low stock digests")
+                conn.commit()
+                return {"success": True}, 200
+
+        try:
+            queue_write(digest_logic)
+        except (WriteQueueFull, WriteTimeout) as e:
+            logging.warning(f"Low stock digest deferred: {str(e)}")
+        except Exception as e:
+            # Pending alerts stay pending, so the next pass digests them
+            logging.error(f"Low stock digest failed: {str(e)}")
+
+def expiry_window_roller():
+    # Move the expiry cut-offs (buckets and stock_counts) forward when the (UTC) date changes
+    while True:
+        time.sleep(EXPIRY_ROLL_INTERVAL)
+        try:
+            roll_expiry_window_if_due()
+        except (WriteQueueFull, WriteTimeout) as e:
+            logging.warning(f"Expiry window roll deferred: {str(e)}")
+        except Exception as e:
+            # Retried on the next tick; the thread must outlive a bad pass
+            logging.error(f"Expiry window roll failed: {str(e)}")
+
+def roll_expiry_window_if_due():
+    conn = db_pool.acquire()
+    try:
+        current = conn.execute(
+            "SELECT critical_before = date('now', ?) AND warning_before = date('now', ?) FROM stock_counts_window",
+            EXPIRY_WINDOW
+        ).fetchone()[0]
+    finally:
+        db_pool.release(conn)
+    if current:
+        return
+
+    def roll_logic():
+        with get_db() as conn:
+            if roll_expiry_window(conn.cursor()):
+                record_change('vials')
+                record_change('stock_counts')
+                logging.info("Rolled expiry window")
+            conn.commit()
+            return {"success": True}, 200
+
+    queue_write(roll_logic)
+
 @app.route('/api/heartbeat', methods=['POST'])
 def heartbeat():
     global last_heartbeat
     last_heartbeat = time.time()
     return jsonify({"status": "alive", "timestamp": last_heartbeat})
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        'db_pool': db_pool.snapshot(),
+        'write_queue': write_queue_snapshot(),
+        'asset_ids': asset_allocator.snapshot(),
+        'network_status': network_status.snapshot(),
+        'response_cache': response_cache.snapshot(),
+        'external_writes': external_writes.snapshot(),
+        'events': event_broker.snapshot(),
+        'prefix_index': vial_prefix.snapshot(),
+        'notifications': {channel: d.snapshot() for channel, d in notification_dispatchers.items()},
+        'low_stock_alerts': low_stock_stats,
+        'printers': print_spooler.snapshot(),
+        'storage': {
+            'profile': STORAGE['name'],
+            'journal_mode': STORAGE['journal_mode'],
+            'synchronous': STORAGE['synchronous'],
+            'checkpoints': checkpoint_stats
+        }
+    })
+
 # 13. SERVE REACT APP
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -1638,7 +3721,14 @@ def perform_backup():
     if os.path.exists(DB_FILE):
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_path = os.path.join(BACKUP_DIR, f'backup_{timestamp}.dat')
-        shutil.copy2(DB_FILE, backup_path)
+        # Use the online backup API so committed pages still in the WAL are included
+        src = sqlite3.connect(DB_FILE)
+        dst = sqlite3.connect(backup_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
         
         # Keep only last 7 backups
         backups = sorted(glob.glob(os.path.join(BACKUP_DIR, 'backup_*.dat')))
@@ -1647,46 +3737,207 @@ def perform_backup():
                 os.remove(old_backup)
 
 # 12. STOCK JOURNEY & SEARCH
+# Queries of at least SEARCH_MIN_TRIGRAM characters go through the vial_search
+# trigram index (migrations.py) and come back best match first. Listings paged
+# with a cursor go soonest expiry first instead: bm25 rank shifts as other
+# vials are indexed, so a cursor on it would skip or repeat rows. Shorter
+# queries can't use the index and fall back to LIKE, newest first, as does a
+# database without FTS5. A status on its own lists the newest vials in that status.
+SEARCH_MIN_TRIGRAM = 3
+SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_MAX = 200
+SEARCH_STATUSES = ('AVAILABLE', 'USED_CLINICAL', 'DISCARDED', 'IN_TRANSIT')
+# Without either of these the endpoint keeps its original response: the first page, as a list
+SEARCH_LISTING_PARAMS = ('cursor', 'limit')
+_vial_search_ready = None
+
+def vial_search_ready(conn):
+    global _vial_search_ready
+    if _vial_search_ready is None:
+        _vial_search_ready = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vial_search'"
+        ).fetchone() is not None
+    return _vial_search_ready
+
+def fts_phrase(text):
+    # One quoted phrase: with the trigram tokenizer that is a substring match
+    return '"' + text.replace('"', '""') + '"'
+
+# Typeahead and barcode lookups answer from memory (prefix_index.py). The
+# index is loaded at startup and kept current from committed writes; after
+# an external write the next lookup reloads it.
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_LIMIT_MAX = 50
+vial_prefix = PrefixIndex()
+
+def load_prefix_index():
+    def fetch():
+        with get_db() as conn:
+            vials = conn.execute("SELECT id, asset_id, batch_number, drug_id, status, location_id FROM vials").fetchall()
+            drugs = conn.execute("SELECT id, name FROM drugs").fetchall()
+        return vials, drugs
+
+    start = time.perf_counter()
+    vial_prefix.load(fetch)
+    logging.info(f"Prefix index loaded in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+@on_commit
+def _update_prefix_index(changes):
+    if not vial_prefix.loaded:
+        return
+    # Rowless vials changes (the expiry roll) never touch indexed fields
+    vial_ids = sorted({c['row_id'] for c in changes if c['table'] == 'vials' and c['row_id'] is not None})
+    drug_ids = sorted({c['row_id'] for c in changes if c['table'] == 'drugs' and c['row_id'] is not None})
+    # Runs in the worker thread, straight after the commit
+    conn = _local.conn
+    found = set()
+    for start in range(0, len(vial_ids), EVENT_QUERY_CHUNK):
+        chunk = vial_ids[start:start + EVENT_QUERY_CHUNK]
+        for row in conn.execute(
+            "SELECT id, asset_id, batch_number, drug_id, status, location_id FROM vials WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(chunk),)
+        ):
+            vial_prefix.put_vial(*row)
+            found.add(row['id'])
+    for vial_id in set(vial_ids) - found:
+        vial_prefix.remove_vial(vial_id)
+    if drug_ids:
+        for row in conn.execute("SELECT id, name FROM drugs WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(drug_ids),)):
+            vial_prefix.put_drug(*row)
+
+@app.route('/api/typeahead', methods=['GET'])
+def typeahead():
+    # ?q=<prefix>[&location_id=][&status=][&limit=]
+    status = request.args.get('status', '').upper() or None
+    if status is not None and status not in SEARCH_STATUSES:
+        return jsonify({"error": f"Unknown status. Use one of {', '.join(SEARCH_STATUSES)}"}), 400
+    limit = min(max(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), 1), TYPEAHEAD_LIMIT_MAX)
+
+    external_writes.check()
+    if not vial_prefix.loaded:
+        load_prefix_index()
+    return jsonify(vial_prefix.lookup(
+        request.args.get('q', ''), limit,
+        location_id=request.args.get('location_id', type=int),
+        status=status
+    ))
+
 @app.route('/api/stock_search', methods=['GET'])
 def stock_search():
-    query = request.args.get('query', '').strip()
-    status = request.args.get('status', 'ALL')
+    args = request.args
+    query = args.get('query', '').strip()
+    status = args.get('status', 'ALL').upper()
+    paginated = any(param in args for param in SEARCH_LISTING_PARAMS)
     
     if not query and status == 'ALL':
-        return jsonify([])
+        return jsonify({'results': [], 'next_cursor': None} if paginated else [])
+    if status != 'ALL' and status not in SEARCH_STATUSES:
+        return jsonify({"error": f"Unknown status. Use ALL or one of {', '.join(SEARCH_STATUSES)}"}), 400
+
+    limit = min(max(args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_MAX)
+    fetch = limit + 1
 
     with get_db() as conn:
-        sql = """
-            SELECT 
-                v.*, 
-                d.name as drug_name, 
-                d.category,
-                l.name as location_name,
-                l.type as location_type
-            FROM vials v
-            JOIN drugs d ON v.drug_id = d.id
-            JOIN locations l ON v.location_id = l.id
-            WHERE 1=1
-        """
-        params = []
-        
-        if query:
-            sql += """ AND (
-                v.asset_id LIKE ? OR 
-                v.batch_number LIKE ? OR 
-                d.name LIKE ?
-            )"""
+        indexed = len(query) >= SEARCH_MIN_TRIGRAM and vial_search_ready(conn)
+        try:
+            if indexed:
+                cursor_key = decode_cursor(args['cursor']) if args.get('cursor') else (-sys.maxsize, 0)
+                cursor_key = (int(cursor_key[0]), cursor_key[1])
+            else:
+                cursor_key = decode_cursor(args['cursor']) if args.get('cursor') else ('9999-12-31', sys.maxsize)
+        except (ValueError, UnicodeDecodeError, base64.binascii.Error):
+            return jsonify({"error": "Invalid cursor"}), 400
+
+        if indexed and not paginated:
+            # Without a status filter only the best `fetch` matches are joined
+            results = conn.execute("""
+                SELECT 
+                    v.*, 
+                    d.name as drug_name, 
+                    d.category,
+                    l.name as location_name,
+                    l.type as location_type
+                FROM (
+                    SELECT rowid AS vial_id, rank FROM vial_search WHERE vial_search MATCH ?
+                    ORDER BY rank LIMIT ?
+                ) hits
+                JOIN vials v ON v.id = hits.vial_id
+                JOIN drugs d ON v.drug_id = d.id
+                JOIN locations l ON v.location_id = l.id
+                WHERE (? = 'ALL' OR v.status = ?)
+                ORDER BY hits.rank
+                LIMIT ?
+            """, (fts_phrase(query), fetch if status == 'ALL' else -1, status, status, fetch)).fetchall()
+        elif indexed:
+            results = conn.execute("""
+                SELECT 
+                    v.*, 
+                    d.name as drug_name, 
+                    d.category,
+                    l.name as location_name,
+                    l.type as location_type,
+                    COALESCE(v.expiry_day, 0) as search_key
+                FROM (
+                    SELECT rowid AS vial_id FROM vial_search WHERE vial_search MATCH ?
+                ) hits
+                JOIN vials v ON v.id = hits.vial_id
+                JOIN drugs d ON v.drug_id = d.id
+                JOIN locations l ON v.location_id = l.id
+                WHERE (? = 'ALL' OR v.status = ?) AND (COALESCE(v.expiry_day, 0), v.id) > (?, ?)
+                ORDER BY COALESCE(v.expiry_day, 0), v.id
+                LIMIT ?
+            """, (fts_phrase(query), status, status, *cursor_key, fetch)).fetchall()
+        elif query:
             search_term = f"%{query}%"
-            params.extend([search_term, search_term, search_term])
-            
-        if status != 'ALL':
-            sql += " AND v.status = ?"
-            params.append(status)
-            
-        sql += " ORDER BY v.created_at DESC LIMIT 50"
-        
-        results = conn.execute(sql, params).fetchall()
-        return jsonify([dict(r) for r in results])
+            results = conn.execute("""
+                SELECT 
+                    v.*, 
+                    d.name as drug_name, 
+                    d.category,
+                    l.name as location_name,
+                    l.type as location_type
+                FROM vials v
+                JOIN drugs d ON v.drug_id = d.id
+                JOIN locations l ON v.location_id = l.id
+                WHERE (
+                    v.asset_id LIKE ? OR 
+                    v.batch_number LIKE ? OR 
+                    d.name LIKE ? OR
+                    v.goods_receipt_number LIKE ? OR
+                    v.disposal_register_number LIKE ?
+                )
+                AND (? = 'ALL' OR v.status = ?) AND (v.created_at, v.id) < (?, ?)
+                ORDER BY v.created_at DESC, v.id DESC
+                LIMIT ?
+            """, (*[search_term] * 5, status, status, *cursor_key, fetch)).fetchall()
+        else:
+            results = conn.execute("""
+                SELECT 
+                    v.*, 
+                    d.name as drug_name, 
+                    d.category,
+                    l.name as location_name,
+                    l.type as location_type
+                FROM vials v
+                JOIN drugs d ON v.drug_id = d.id
+                JOIN locations l ON v.location_id = l.id
+                WHERE v.status = ? AND (v.created_at, v.id) < (?, ?)
+                ORDER BY v.created_at DESC, v.id DESC
+                LIMIT ?
+            """, (status, *cursor_key, fetch)).fetchall()
+
+    has_more = len(results) > limit
+    results = [dict(r) for r in results[:limit]]
+    next_cursor = None
+    if has_more and paginated:
+        last = results[-1]
+        next_cursor = encode_cursor(last['search_key'] if indexed else last['created_at'], last['id'])
+    for result in results:
+        result.pop('search_key', None)
+
+    if not paginated:
+        return jsonify(results)
+    return jsonify({'results': results, 'next_cursor': next_cursor})
 
 @app.route('/api/stock_journey/<asset_id>', methods=['GET'])
 def stock_journey(asset_id):
@@ -1699,130 +3950,108 @@ def stock_journey(asset_id):
                 d.category,
                 d.storage_temp,
                 l.name as location_name,
-                l.type as location_type,
-                u.username as created_by_username
+                l.type as location_type
             FROM vials v
             JOIN drugs d ON v.drug_id = d.id
             JOIN locations l ON v.location_id = l.id
-            LEFT JOIN users u ON u.id = (
-                SELECT user_id FROM audit_log 
-                WHERE action = 'RECEIVE_STOCK' 
-                AND details LIKE ? 
-                LIMIT 1
-            )
             WHERE v.asset_id = ?
-        """, (f"%{asset_id}%", asset_id)).fetchone()
+        """, (asset_id,)).fetchone()
         
         if not vial:
             return jsonify({"error": "Asset not found"}), 404
             
-        timeline = []
-        
-        # 2. Add Creation/Receipt Event
-        timeline.append({
-            'type': 'CREATED',
-            'timestamp': vial['created_at'],
-            'title': 'Stock Received',
-            'location': vial['location_name'],
-            'user': vial['created_by_username'] or 'System',
-            'details': {
-                'Batch': vial['batch_number'],
-                'Expiry': vial['expiry_date'],
-                'Goods Receipt': vial['goods_receipt_number']
-            }
-        })
-        
-        # 3. Add Transfers
-        transfers = conn.execute("""
+        # 2. Read the vial's history, newest first, as one (vial_id, seq) range scan
+        events = conn.execute("""
             SELECT 
-                t.*,
-                fl.name as from_name,
-                tl.name as to_name,
+                e.event_type,
+                e.timestamp,
+                e.details,
+                l.name as location_name,
                 u.username as user_name,
-                cu.username as completed_by_name
-            FROM transfer_items ti
-            JOIN transfers t ON ti.transfer_id = t.id
-            JOIN locations fl ON t.from_location_id = fl.id
-            JOIN locations tl ON t.to_location_id = tl.id
-            JOIN users u ON t.created_by = u.id
-            LEFT JOIN users cu ON t.completed_by = cu.id
-            JOIN vials v ON ti.vial_id = v.id
-            WHERE v.asset_id = ?
-            ORDER BY t.created_at
-        """, (asset_id,)).fetchall()
+                t.status as transfer_status,
+                fl.name as from_name,
+                tl.name as to_name
+            FROM vial_events e
+            LEFT JOIN locations l ON e.location_id = l.id
+            LEFT JOIN users u ON e.user_id = u.id
+            LEFT JOIN transfers t ON e.transfer_id = t.id
+            LEFT JOIN locations fl ON t.from_location_id = fl.id
+            LEFT JOIN locations tl ON t.to_location_id = tl.id
+            WHERE e.vial_id = ?
+            ORDER BY e.seq DESC
+        """, (vial['id'],)).fetchall()
         
-        for t in transfers:
-            timeline.append({
-                'type': 'TRANSFER_STARTED',
-                'timestamp': t['created_at'],
-                'title': 'Transfer Initiated',
-                'location': t['from_name'],
-                'user': t['user_name'],
-                'details': {
-                    'Destination': t['to_name'],
-                    'Status': t['status']
-                }
-            })
+        timeline = []
+        created_by = None
+        for e in events:
+            extra = json.loads(e['details']) if e['details'] else {}
+            entry = {
+                'type': e['event_type'],
+                'timestamp': e['timestamp'],
+                'location': e['location_name'],
+                'user': e['user_name']
+            }
             
-            if t['completed_at']:
-                timeline.append({
-                    'type': 'TRANSFER_COMPLETED',
-                    'timestamp': t['completed_at'],
-                    'title': 'Transfer Completed',
-                    'location': t['to_name'],
-                    'user': t['completed_by_name'] or 'System',
-                    'details': {
-                        'Source': t['from_name']
-                    }
+            if e['event_type'] == 'CREATED':
+                created_by = e['user_name']
+                entry.update(title='Stock Received', user=e['user_name'] or 'System', details={
+                    'Batch': vial['batch_number'],
+                    'Expiry': vial['expiry_date'],
+                    'Goods Receipt': vial['goods_receipt_number']
                 })
-
-        # 4. Add Usage/Disposal
-        if vial['status'] == 'USED_CLINICAL':
-            user = conn.execute("SELECT username FROM users WHERE id = ?", (vial['used_by'],)).fetchone()
-            timeline.append({
-                'type': 'USED',
-                'timestamp': vial['used_at'],
-                'title': 'Clinical Use',
-                'location': vial['location_name'], # Current location
-                'user': user['username'] if user else 'Unknown',
-                'details': {
-                    'Patient MRN': vial['patient_mrn'],
-                    'Notes': vial['clinical_notes']
-                }
-            })
-        elif vial['status'] == 'DISCARDED':
-            user = conn.execute("SELECT username FROM users WHERE id = ?", (vial['used_by'],)).fetchone()
-            timeline.append({
-                'type': 'DISCARDED',
-                'timestamp': vial['used_at'],
-                'title': 'Stock Discarded',
-                'location': vial['location_name'],
-                'user': user['username'] if user else 'Unknown',
-                'details': {
-                    'Reason': vial['discard_reason'],
-                    'Register #': vial['disposal_register_number']
-                }
-            })
-            
-        # Sort by timestamp
-        timeline.sort(key=lambda x: x['timestamp'], reverse=True)
+            elif e['event_type'] == 'TRANSFER_STARTED':
+                entry.update(title='Transfer Initiated', details={
+                    'Destination': e['to_name'],
+                    'Status': e['transfer_status']
+                })
+            elif e['event_type'] == 'TRANSFER_APPROVED':
+                entry.update(title='Transfer Approved', details={'Source': e['from_name']})
+            elif e['event_type'] == 'TRANSFER_COMPLETED':
+                entry.update(title='Transfer Completed', user=e['user_name'] or 'System', details={
+                    'Source': e['from_name']
+                })
+            elif e['event_type'] == 'TRANSFER_CANCELLED':
+                entry.update(title='Transfer Cancelled', details={'Destination': e['to_name']})
+            elif e['event_type'] == 'USED':
+                entry.update(title='Clinical Use', user=e['user_name'] or 'Unknown', details={
+                    'Patient MRN': extra.get('patient_mrn'),
+                    'Notes': extra.get('clinical_notes')
+                })
+            elif e['event_type'] == 'DISCARDED':
+                entry.update(title='Stock Discarded', user=e['user_name'] or 'Unknown', details={
+                    'Reason': extra.get('discard_reason'),
+                    'Register #': extra.get('disposal_register_number')
+                })
+            timeline.append(entry)
+        
+        vial_data = dict(vial)
+        vial_data['created_by_username'] = created_by
         
         return jsonify({
-            'vial': dict(vial),
+            'vial': vial_data,
             'timeline': timeline
         })
 
 if __name__ == '__main__':
 
     
+    # Switch the database file to the configured journal mode
+    apply_storage_profile()
+
     # Initialize database
     init_db()
+    load_prefix_index()
     
     # Perform backup
     perform_backup()
     
     # Start monitoring thread
     threading.Thread(target=monitor, daemon=True).start()
+    threading.Thread(target=expiry_window_roller, daemon=True, name='expiry-window').start()
+    threading.Thread(target=change_log_pruner, daemon=True, name='change-log-pruner').start()
+    threading.Thread(target=low_stock_digester, daemon=True, name='low-stock-digester').start()
+    if STORAGE['journal_mode'] == 'WAL':
+        threading.Thread(target=checkpointer, daemon=True).start()
     
     # Find available port
     port = 5000
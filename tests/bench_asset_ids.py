@@ -0,0 +1,91 @@
+"""Asset ID allocator throughput.
+
+Simulates bulk receipts the way receive_stock_logic writes them - allocate,
+then executemany into vials, one transaction per receipt - with different
+block sizes. The "per-id" row allocates one ID per call with a block size of
+1, i.e. one sequence round-trip per vial - the baseline.
+
+    python tests/bench_asset_ids.py [receipts] [vials_per_receipt]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations
+from asset_ids import AssetIdAllocator, asset_prefix
+
+BLOCK_SIZES = ['per-id', 1, 10, 50, 500]
+
+
+def run(block_size, receipts, per_receipt, path):
+    conn = migrations.connect(path)
+    migrations.migrate(conn)
+    conn.execute("INSERT INTO locations (id, name, type) VALUES (1, 'Hub', 'HUB')")
+    conn.execute("INSERT INTO drugs (id, name, category, storage_temp, unit_price) VALUES (1, 'Tenecteplase', 'Test', '2-8', 100)")
+    conn.commit()
+
+    per_id = block_size == 'per-id'
+    allocator = AssetIdAllocator(block_size=1 if per_id else block_size)
+    prefix = asset_prefix('Tenecteplase', 1)
+    now = datetime.now()
+    alloc_s = 0.0
+    start = time.perf_counter()
+    for _ in range(receipts):
+        conn.execute("BEGIN IMMEDIATE")
+        t = time.perf_counter()
+        if per_id:
+            ids = [allocator.allocate(conn, prefix, 1)[0] for _ in range(per_receipt)]
+        else:
+            ids = allocator.allocate(conn, prefix, per_receipt)
+        alloc_s += time.perf_counter() - t
+        conn.executemany("""
+            INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status, created_at)
+            VALUES (?, 1, 'B1', '2030-01-01', 1, 'AVAILABLE', ?)
+        """, [(asset_id, now) for asset_id in ids])
+        conn.commit()
+    total_s = time.perf_counter() - start
+
+    # A rolled-back reservation must not leak duplicates once reset
+    conn.execute("BEGIN IMMEDIATE")
+    allocator.allocate(conn, prefix, per_receipt)
+    conn.rollback()
+    allocator.reset()
+    conn.execute("BEGIN IMMEDIATE")
+    ids = allocator.allocate(conn, prefix, per_receipt)
+    conn.executemany(
+        "INSERT INTO vials (asset_id, drug_id, batch_number, expiry_date, location_id, status) VALUES (?, 1, 'B1', '2030-01-01', 1, 'AVAILABLE')",
+        [(asset_id,) for asset_id in ids]
+    )
+    conn.commit()
+
+    issued = receipts * per_receipt + per_receipt
+    rows, unique = conn.execute("SELECT COUNT(*), COUNT(DISTINCT asset_id) FROM vials").fetchone()
+    longest = conn.execute("SELECT MAX(LENGTH(asset_id)) FROM vials").fetchone()[0]
+    conn.close()
+    assert rows == unique == issued, f"expected {issued} unique asset IDs, got {rows} rows / {unique} unique"
+    return {
+        'alloc_per_s': issued / alloc_s if alloc_s else float('inf'),
+        'vials_per_s': receipts * per_receipt / total_s,
+        'blocks': allocator.stats['blocks_reserved'],
+        'longest': longest,
+    }
+
+
+def main(receipts=200, per_receipt=50):
+    print(f"{receipts} receipts x {per_receipt} vials")
+    print(f"{'block':>6} {'alloc ids/s':>12} {'vials/s':>10} {'blocks':>7} {'max len':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for block_size in BLOCK_SIZES:
+            result = run(block_size, receipts, per_receipt, os.path.join(tmp, f'bench_{block_size}.dat'))
+            print(f"{block_size!s:>6} {result['alloc_per_s']:>12,.0f} {result['vials_per_s']:>10,.0f} "
+                  f"{result['blocks']:>7} {result['longest']:>8}")
+    print("PASS: all asset IDs unique")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,113 @@
+"""Shared fixtures.
+
+server.py starts its background threads on import and keeps its database,
+backups and log under DATA_DIR, so DATA_DIR is pointed at a scratch
+directory before the first import. Notifications go to a sink file there.
+"""
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATA_DIR = tempfile.mkdtemp(prefix='medicine-tracker-tests-')
+NOTIFY_SINK = os.path.join(DATA_DIR, 'notifications.jsonl')
+os.environ['DATA_DIR'] = DATA_DIR
+os.environ['NOTIFY_SINK'] = NOTIFY_SINK
+
+
+@pytest.fixture(scope='session')
+def server():
+    import server
+    server.init_db()
+    server.load_prefix_index()
+    return server
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def hold_writer(server):
+    """Keep the write worker busy inside the block.
+
+    Writes submitted meanwhile wait in the queue and are claimed together,
+    as one batch, once the block exits.
+    """
+    @contextlib.contextmanager
+    def hold():
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(10)
+
+        holder = threading.Thread(target=server.queue_write, args=(block,),
+                                  kwargs={'priority': server.PRIORITY_CLINICAL})
+        holder.start()
+        assert started.wait(5), "write worker did not pick up the holding write"
+        try:
+            yield
+        finally:
+            release.set()
+            holder.join(10)
+    return hold
+
+
+@pytest.fixture
+def submit(server):
+    """submit(pool, func, **kwargs): queue_write from a pool thread, returning
+    its future once the write is waiting in the queue."""
+    def submit(pool, func, **kwargs):
+        depth = server.write_queue.qsize()
+        future = pool.submit(server.queue_write, func, **kwargs)
+        wait_for(lambda: server.write_queue.qsize() > depth or future.done())
+        return future
+    return submit
+
+
+@pytest.fixture
+def db_readers(server, monkeypatch):
+    """(pooled, unpooled): names of the threads that read through db_pool, and
+    of those that opened a connection of their own through get_db()."""
+    pooled, unpooled = set(), set()
+    acquire, get_db = server.db_pool.acquire, server.get_db
+
+    def recording_acquire():
+        pooled.add(threading.current_thread().name)
+        return acquire()
+
+    def recording_get_db():
+        if getattr(server._local, 'session', None) is None and not server.has_app_context():
+            unpooled.add(threading.current_thread().name)
+        return get_db()
+
+    monkeypatch.setattr(server.db_pool, 'acquire', recording_acquire)
+    monkeypatch.setattr(server, 'get_db', recording_get_db)
+    return pooled, unpooled
+
+
+def receive_vials(client, quantity, batch_number, location_id=1, drug_id=1, expiry_date='2030-01-01'):
+    """Receive stock through the API as the seeded admin; returns the asset IDs."""
+    response = client.post('/api/receive_stock', json={
+        'drug_id': drug_id, 'batch_number': batch_number, 'expiry_date': expiry_date,
+        'quantity': quantity, 'location_id': location_id, 'user_id': 1
+    })
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['asset_ids']
@@ -0,0 +1,104 @@
+"""Periodic maintenance threads keep running after a failed pass."""
+import contextlib
+import threading
+
+from conftest import wait_for
+
+
+def fail_once_in(server, monkeypatch, thread_name):
+    """Make the named thread's next pool acquire and next write each raise once.
+
+    Returns the failures as they are injected."""
+    failures = []
+    acquire, queue_write = server.db_pool.acquire, server.queue_write
+
+    def failing_acquire():
+        if threading.current_thread().name == thread_name and 'pool' not in failures:
+            failures.append('pool')
+            raise server.PoolTimeout("pool exhausted")
+        return acquire()
+
+    def failing_queue_write(func, *args, **kwargs):
+        if threading.current_thread().name == thread_name and 'write' not in failures:
+            failures.append('write')
+            raise server.sqlite3.OperationalError("database is locked")
+        return queue_write(func, *args, **kwargs)
+
+    monkeypatch.setattr(server.db_pool, 'acquire', failing_acquire)
+    monkeypatch.setattr(server, 'queue_write', failing_queue_write)
+    return failures
+
+
+def start(target, name):
+    threading.Thread(target=target, daemon=True, name=name).start()
+
+
+def window_is_current(server):
+    with contextlib.closing(server._connect()) as conn:
+        return conn.execute(
+            "SELECT critical_before = date('now', ?) AND warning_before = date('now', ?) FROM stock_counts_window",
+            server.EXPIRY_WINDOW
+        ).fetchone()[0]
+
+
+def test_expiry_window_roller_survives_failures(server, monkeypatch):
+    def age_window():
+        with server.get_db() as conn:
+            conn.execute("UPDATE stock_counts_window SET critical_before = date('now', '-1 day')")
+    server.queue_write(age_window)
+
+    monkeypatch.setattr(server, 'EXPIRY_ROLL_INTERVAL', 0.01)
+    failures = fail_once_in(server, monkeypatch, 'test-expiry-window')
+    start(server.expiry_window_roller, 'test-expiry-window')
+
+    wait_for(lambda: window_is_current(server))
+    assert failures == ['pool', 'write']
+
+
+def test_change_log_pruner_survives_failures(server, client, monkeypatch):
+    assert client.post('/api/locations', json={'name': 'Pruned ward', 'type': 'WARD', 'parent_hub_id': 1}).status_code == 200
+    with contextlib.closing(server._connect()) as conn:
+        head = server.change_log_bounds(conn)[1]
+
+    def pruned_through():
+        with contextlib.closing(server._connect()) as conn:
+            return server.change_log_bounds(conn)[0]
+
+    # Everything up to now is past retention
+    monkeypatch.setattr(server, 'CHANGE_LOG_RETENTION_DAYS', -1)
+    monkeypatch.setattr(server, 'CHANGE_LOG_PRUNE_INTERVAL', 0.01)
+    failures = fail_once_in(server, monkeypatch, 'test-change-log-pruner')
+    start(server.change_log_pruner, 'test-change-log-pruner')
+
+    wait_for(lambda: pruned_through() >= head)
+    assert failures == ['write']
+
+
+def test_low_stock_digester_survives_failures(server, monkeypatch):
+    def hold_back_drop():
+        # A drop held back for the digest, at a location well below its minimum
+        with server.get_db() as conn:
+            conn.execute("UPDATE stock_levels SET min_stock = 1000 WHERE location_id = 5 AND drug_id = 1")
+            conn.execute("""
+                INSERT OR REPLACE INTO low_stock_alerts (location_id, drug_id, level, alerted_at, pending)
+                VALUES (5, 1, 3, ?, 1)
+            """, (server.datetime.now(),))
+    server.queue_write(hold_back_drop)
+
+    def pending():
+        with contextlib.closing(server._connect()) as conn:
+            return conn.execute("SELECT pending FROM low_stock_alerts WHERE location_id = 5 AND drug_id = 1").fetchone()[0]
+
+    digests = server.low_stock_stats['digests']
+    monkeypatch.setattr(server, 'LOW_STOCK_DIGEST_INTERVAL', 0.01)
+    failures = fail_once_in(server, monkeypatch, 'test-low-stock-digester')
+    start(server.low_stock_digester, 'test-low-stock-digester')
+    try:
+        wait_for(lambda: pending() == 0)
+        assert failures == ['write']
+        assert server.low_stock_stats['digests'] > digests
+    finally:
+        def restore():
+            with server.get_db() as conn:
+                conn.execute("UPDATE stock_levels SET min_stock = 2 WHERE location_id = 5 AND drug_id = 1")
+        server.queue_write(restore)
@@ -0,0 +1,66 @@
+"""Delta sync (/api/changes)."""
+from datetime import datetime, timedelta
+
+
+def head(client):
+    return client.get('/api/changes').get_json()['seq']
+
+
+def add_location(client, name):
+    response = client.post('/api/locations', json={'name': name, 'type': 'REMOTE', 'parent_hub_id': 1})
+    assert response.status_code == 200
+    return response.get_json()['id']
+
+
+def test_pages_follow_the_cursor(client):
+    since = head(client)
+    added = [add_location(client, f"Sync page {n}") for n in range(3)]
+
+    first = client.get(f'/api/changes?since={since}&limit=2').get_json()
+    assert [(change['table'], change['id'], change['op']) for change in first['changes']] == \
+        [('locations', added[0], 'upsert'), ('locations', added[1], 'upsert')]
+    assert first['changes'][0]['row']['name'] == 'Sync page 0'
+    assert first['more'] and first['next'] == first['changes'][-1]['seq']
+
+    second = client.get(f"/api/changes?since={first['next']}&limit=2").get_json()
+    assert [change['id'] for change in second['changes']] == [added[2]]
+    assert not second['more'] and second['next'] == head(client)
+
+    caught_up = client.get(f"/api/changes?since={second['next']}").get_json()
+    assert caught_up == {'changes': [], 'next': second['next'], 'more': False}
+
+
+def test_log_keeps_only_the_latest_change_per_row(client):
+    since = head(client)
+    first = add_location(client, "Sync compact 1")
+    second = add_location(client, "Sync compact 2")
+    assert client.delete(f'/api/locations/{first}').status_code == 200
+
+    # The delete replaced the insert's entry and moved it behind the later row
+    changes = client.get(f'/api/changes?since={since}').get_json()['changes']
+    assert [(change['id'], change['op']) for change in changes] == [(second, 'upsert'), (first, 'delete')]
+    assert changes[1]['row'] is None
+    assert changes[0]['seq'] < changes[1]['seq']
+
+
+def test_client_behind_the_horizon_must_resync(server, client):
+    since = head(client)
+    add_location(client, "Sync pruned")
+
+    def prune():
+        with server.get_db() as conn:
+            return server.prune_change_log(conn.cursor(), datetime.now() + timedelta(seconds=1))
+    assert server.queue_write(prune) >= 1
+    current = head(client)
+
+    behind = client.get(f'/api/changes?since={since}')
+    assert behind.status_code == 410
+    assert behind.get_json()['resync_required'] and behind.get_json()['seq'] == current
+
+    # Ahead of this database, e.g. after a restore from backup
+    assert client.get(f'/api/changes?since={current + 100}').status_code == 410
+
+    # Resuming from the horizon itself is fine
+    assert client.get(f'/api/changes?since={current}').get_json()['changes'] == []
+    add_location(client, "Sync after prune")
+    assert [change['row']['name'] for change in client.get(f'/api/changes?since={current}').get_json()['changes']] == ["Sync after prune"]
@@ -0,0 +1,11 @@
+"""Dashboard endpoints."""
+import pytest
+
+SECRET_COLUMNS = ('password_hash', 'reset_token', 'reset_token_expiry')
+
+
+@pytest.mark.parametrize('path', ['/api/dashboard/1', '/api/dashboard/1/summary'])
+def test_user_is_sent_without_credentials(client, path):
+    user = client.get(path).get_json()['user']
+    assert user['id'] == 1 and user['location_name']
+    assert not set(SECRET_COLUMNS) & set(user)
@@ -0,0 +1,102 @@
+"""Live change events (/api/events/<user_id>)."""
+import contextlib
+import threading
+
+import pytest
+
+from conftest import wait_for
+
+ADMIN_ID = 1  # seeded pharmacist: sees the whole network
+
+
+def touch_vial(server):
+    """Commit a change to one available vial; returns its id."""
+    def op():
+        with server.get_db() as conn:
+            vial = conn.execute("SELECT id, location_id FROM vials WHERE status = 'AVAILABLE' ORDER BY id LIMIT 1").fetchone()
+            conn.execute("UPDATE vials SET version = version + 1 WHERE id = ?", (vial['id'],))
+        server.record_change('vials', vial['id'], vial['location_id'])
+        return vial['id']
+    return server.queue_write(op)
+
+
+def parse(chunk):
+    fields = dict(line.split(': ', 1) for line in chunk.decode().splitlines() if ': ' in line and not line.startswith(':'))
+    return fields.get('id'), fields.get('event'), fields.get('data')
+
+
+@contextlib.contextmanager
+def open_stream(client, **headers):
+    response = client.get(f'/api/events/{ADMIN_ID}', headers=headers, buffered=False)
+    try:
+        yield response, iter(response.response)
+    finally:
+        response.close()
+
+
+def read_until(chunks, name, contains=''):
+    # Other tests' writes may be interleaved; keep-alives come every 15s
+    for _ in range(50):
+        event_id, event, data = parse(next(chunks))
+        if event == name and contains in (data or ''):
+            return event_id, data
+    raise AssertionError(f"no {name} event")
+
+
+def test_stream_delivers_committed_changes(server, client):
+    with open_stream(client) as (response, chunks):
+        assert response.mimetype == 'text/event-stream'
+        assert parse(next(chunks)) == (None, None, None)  # retry: hint
+        vial_id = touch_vial(server)
+        event_id, data = read_until(chunks, 'vial', f'"id": {vial_id},')
+        assert event_id.startswith(server.BOOT_ID + ':')
+    assert server.event_broker.snapshot()['streams'] == 0
+
+
+def test_last_event_id_replays_missed_events(server, client):
+    last_event_id = server.event_broker.snapshot()['last_event_id']
+    vial_id = touch_vial(server)
+    wait_for(lambda: server.event_broker.snapshot()['last_event_id'] != last_event_id)
+
+    replayed = server.event_broker.stats['replayed']
+    with open_stream(client, **{'Last-Event-ID': last_event_id}) as (_, chunks):
+        next(chunks)
+        read_until(chunks, 'vial', f'"id": {vial_id},')
+    assert server.event_broker.stats['replayed'] > replayed
+
+    # Events from before a restart are gone: the client must reload
+    with open_stream(client, **{'Last-Event-ID': 'another-boot:1'}) as (_, chunks):
+        next(chunks)
+        assert '"reason": "missed"' in read_until(chunks, 'resync')[1]
+
+
+def test_stream_count_is_capped(server, client, monkeypatch):
+    monkeypatch.setattr(server, 'EVENT_MAX_STREAMS', 1)
+    with open_stream(client) as (_, chunks):
+        next(chunks)
+        rejected = client.get(f'/api/events/{ADMIN_ID}')
+        assert rejected.status_code == 503
+    assert server.event_broker.stats['rejected'] >= 1
+
+
+@pytest.mark.parametrize('error', ['pool', 'sqlite'])
+def test_broker_survives_read_failures(server, client, monkeypatch, error):
+    failures = []
+    acquire = server.db_pool.acquire
+
+    def failing_acquire():
+        if not failures and threading.current_thread().name == 'event-broker':
+            failures.append(error)
+            if error == 'pool':
+                raise server.PoolTimeout("pool exhausted")
+            raise server.sqlite3.OperationalError("database is locked")
+        return acquire()
+
+    with open_stream(client) as (_, chunks):
+        next(chunks)
+        monkeypatch.setattr(server.db_pool, 'acquire', failing_acquire)
+        touch_vial(server)
+        assert '"reason": "error"' in read_until(chunks, 'resync')[1]
+        # The broker thread is still running
+        vial_id = touch_vial(server)
+        read_until(chunks, 'vial', f'"id": {vial_id},')
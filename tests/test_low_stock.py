@@ -0,0 +1,75 @@
+"""Low stock alerts: repeat drops are coalesced into one digest per hub."""
+import json
+
+from conftest import NOTIFY_SINK, wait_for
+
+DRUG = 'Low Stock Test Drug'
+PA_HUB, WH_HUB = 1, 2
+# (location, hub): two Port Augusta sites and one under Whyalla
+LOCATIONS = [(3, PA_HUB), (6, PA_HUB), (4, WH_HUB)]
+
+
+def sent_emails():
+    try:
+        with open(NOTIFY_SINK, encoding='utf-8') as f:
+            return [record for record in map(json.loads, f)
+                    if record['channel'] == 'email' and DRUG in record['body']]
+    except FileNotFoundError:
+        return []
+
+
+def test_repeat_drops_are_held_for_one_digest_per_hub(server):
+    def setup():
+        with server.get_db() as conn:
+            drug_id = conn.execute(
+                "INSERT INTO drugs (name, category, storage_temp, unit_price) VALUES (?, 'Test', '2-8', 1)", (DRUG,)
+            ).lastrowid
+            # No vials: every location is out of stock against a minimum of 5
+            conn.executemany("INSERT INTO stock_levels (location_id, drug_id, min_stock) VALUES (?, ?, 5)",
+                             [(location_id, drug_id) for location_id, _ in LOCATIONS])
+            conn.execute("""
+                INSERT INTO users (username, password_hash, role, location_id, email)
+                VALUES ('whyalla.pharmacist', 'x', 'PHARMACIST', ?, 'whyalla.pharmacy@example.org')
+            """, (WH_HUB,))
+        return drug_id
+    drug_id = server.queue_write(setup)
+
+    def drops():
+        with server.get_db() as conn:
+            cursor = conn.cursor()
+            alerted = []
+            for location_id, _ in LOCATIONS:
+                name = cursor.execute("SELECT name FROM locations WHERE id = ?", (location_id,)).fetchone()[0]
+                stock_info = {'drug_name': DRUG, 'location_name': name, 'available_count': 0, 'min_stock': 5}
+                # Several drops inside the repeat window: only the first is emailed
+                alerted.append([server.note_low_stock(cursor, location_id, drug_id, stock_info) for _ in range(3)])
+        return alerted
+
+    suppressed = server.low_stock_stats['suppressed']
+    assert server.queue_write(drops) == [[True, False, False]] * len(LOCATIONS)
+    assert server.low_stock_stats['suppressed'] == suppressed + 2 * len(LOCATIONS)
+
+    def digest():
+        with server.get_db() as conn:
+            return server.send_low_stock_digests(conn.cursor())
+    assert server.queue_write(digest) >= 2
+
+    def pending():
+        with server.get_db() as conn:
+            return [row[0] for row in conn.execute("SELECT pending FROM low_stock_alerts WHERE drug_id = ?", (drug_id,))]
+    # Held back drops go out once; the next digest starts from nothing
+    assert server.queue_write(pending) == [0] * len(LOCATIONS)
+    wait_for(lambda: len(sent_emails()) == len(LOCATIONS) + 2, timeout=10)
+
+    alerts = [email for email in sent_emails() if 'DIGEST' not in email['subject']]
+    assert {email['to'] for email in alerts} == {server.LOW_STOCK_EMAIL}
+    digests = {email['subject'].split(' (')[0]: email for email in sent_emails() if 'DIGEST' in email['subject']}
+    assert sorted(digests) == ['LOW STOCK DIGEST: Port Augusta Hospital Pharmacy',
+                               'LOW STOCK DIGEST: Whyalla Hospital Pharmacy']
+
+    port_augusta = digests['LOW STOCK DIGEST: Port Augusta Hospital Pharmacy']
+    assert port_augusta['to'] == 'admin@funlhn.health'
+    assert 'Port Augusta ED' in port_augusta['body'] and 'Roxby Downs' in port_augusta['body']
+    whyalla = digests['LOW STOCK DIGEST: Whyalla Hospital Pharmacy']
+    assert whyalla['to'] == 'whyalla.pharmacy@example.org'
+    assert 'Whyalla HDU' in whyalla['body'] and 'Port Augusta' not in whyalla['body']
@@ -0,0 +1,201 @@
+"""Migrating a database created before schema versioning.
+
+The legacy database has user_version 0 and the tables as the unversioned
+init_db() first created them, before any of the later ALTER TABLEs.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+import check_schema
+import migrate_users_active
+import migrations
+
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL CHECK(role IN ('PHARMACIST', 'PHARMACY_TECH', 'NURSE')),
+    location_id INTEGER NOT NULL,
+    can_delegate BOOLEAN DEFAULT 0,
+    email TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER DEFAULT 1
+);
+CREATE TABLE locations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL CHECK(type IN ('HUB', 'WARD', 'REMOTE')),
+    parent_hub_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER DEFAULT 1
+);
+CREATE TABLE drugs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    category TEXT,
+    storage_temp TEXT,
+    unit_price REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER DEFAULT 1
+);
+CREATE TABLE stock_levels (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    location_id INTEGER NOT NULL,
+    drug_id INTEGER NOT NULL,
+    min_stock INTEGER DEFAULT 0,
+    version INTEGER DEFAULT 1,
+    UNIQUE(location_id, drug_id)
+);
+CREATE TABLE vials (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    asset_id TEXT UNIQUE NOT NULL,
+    drug_id INTEGER NOT NULL,
+    batch_number TEXT NOT NULL,
+    expiry_date DATE NOT NULL,
+    location_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'AVAILABLE'
+        CHECK(status IN ('AVAILABLE', 'USED_CLINICAL', 'DISCARDED', 'IN_TRANSIT')),
+    discard_reason TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    used_at TIMESTAMP,
+    used_by INTEGER,
+    version INTEGER DEFAULT 1
+);
+CREATE TABLE transfers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_location_id INTEGER NOT NULL,
+    to_location_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'PENDING'
+        CHECK(status IN ('PENDING', 'IN_TRANSIT', 'COMPLETED', 'CANCELLED')),
+    created_by INTEGER NOT NULL,
+    approved_by INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    approved_at TIMESTAMP,
+    completed_at TIMESTAMP,
+    version INTEGER DEFAULT 1
+);
+CREATE TABLE transfer_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transfer_id INTEGER NOT NULL,
+    vial_id INTEGER NOT NULL
+);
+CREATE TABLE audit_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    details TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE settings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    printer_ip TEXT,
+    printer_port TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def build_legacy_db(path):
+    now = datetime.now()
+    soon = (now + timedelta(days=20)).strftime('%Y-%m-%d')
+    later = (now + timedelta(days=400)).strftime('%Y-%m-%d')
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executescript("""
+        INSERT INTO locations (id, name, type) VALUES (1, 'Hub', 'HUB');
+        INSERT INTO locations (id, name, type, parent_hub_id) VALUES (2, 'Ward', 'WARD', 1);
+        INSERT INTO drugs (id, name, category, storage_temp, unit_price) VALUES (1, 'Tenecteplase', 'Thrombolytic', '<25', 2500);
+        INSERT INTO users (id, username, password_hash, role, location_id) VALUES (1, 'admin', 'x', 'PHARMACIST', 1);
+        INSERT INTO settings (printer_ip, printer_port) VALUES ('10.0.0.5', '9100');
+    """)
+    received = now - timedelta(days=10)
+    conn.executemany("""
+        INSERT INTO vials (id, asset_id, drug_id, batch_number, expiry_date, location_id, status, created_at, used_at, used_by)
+        VALUES (?, ?, 1, 'B1', ?, ?, ?, ?, ?, ?)
+    """, [
+        (1, 'TEN-1', soon, 1, 'AVAILABLE', received, None, None),
+        (2, 'TEN-2', later, 2, 'AVAILABLE', received, None, None),
+        (3, 'TEN-3', later, 1, 'USED_CLINICAL', received, now - timedelta(days=1), 1),
+    ])
+    conn.execute("""
+        INSERT INTO transfers (id, from_location_id, to_location_id, status, created_by, approved_by,
+                               created_at, approved_at, completed_at)
+        VALUES (1, 1, 2, 'COMPLETED', 1, 1, ?, ?, ?)
+    """, (now - timedelta(days=5), now - timedelta(days=4), now - timedelta(days=3)))
+    conn.execute("INSERT INTO transfer_items (transfer_id, vial_id) VALUES (1, 2)")
+    # Details as the unversioned server wrote them
+    conn.executemany("INSERT INTO audit_log (id, user_id, action, details, timestamp) VALUES (?, 1, ?, ?, ?)", [
+        (1, 'RECEIVE_STOCK', '{"asset_ids": ["TEN-1", "TEN-2", "TEN-3"], "quantity": 3}', received),
+        (2, 'USE_STOCK', '{"asset_id": "TEN-3"}', now - timedelta(days=1)),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_database_migrates_and_backfills(tmp_path):
+    path = str(tmp_path / 'legacy.dat')
+    build_legacy_db(path)
+    conn = migrations.connect(path)
+
+    status = migrations.schema_status(conn)
+    assert status['version'] == 0
+    assert [number for number, _ in status['pending']] == [number for number, _, _ in migrations.MIGRATIONS]
+
+    assert migrations.migrate(conn) == [number for number, _, _ in migrations.MIGRATIONS]
+    assert migrations.get_version(conn) == migrations.LATEST_VERSION == 12
+    assert 'must_change_password' in migrations.schema_status(conn)['tables']['users']
+    assert 'margin_top' in migrations.schema_status(conn)['tables']['settings']
+
+    # Multi-asset entries get one reference per asset, single-asset ones their columns
+    assert [tuple(row) for row in conn.execute(
+        "SELECT asset_id, vial_id FROM audit_log_assets WHERE audit_id = 1 ORDER BY asset_id"
+    )] == [('TEN-1', 1), ('TEN-2', 2), ('TEN-3', 3)]
+    assert tuple(conn.execute("SELECT asset_id, vial_id, location_id FROM audit_log WHERE id = 2").fetchone()) == ('TEN-3', 3, 1)
+
+    # Histories rebuilt in time order; a transferred vial was received where it left from
+    def history(vial_id):
+        return [tuple(row) for row in conn.execute(
+            "SELECT event_type, location_id, user_id FROM vial_events WHERE vial_id = ? ORDER BY seq", (vial_id,)
+        )]
+    assert history(1) == [('CREATED', 1, 1)]
+    assert history(2) == [('CREATED', 1, 1), ('TRANSFER_STARTED', 1, 1),
+                          ('TRANSFER_APPROVED', 2, 1), ('TRANSFER_COMPLETED', 2, None)]
+    assert history(3) == [('CREATED', 1, 1), ('USED', 1, 1)]
+
+    # Counts come from the vials, and the triggers keep them current from here on
+    def counts():
+        return {(row['location_id'], row['drug_id']): (row['available'], row['in_transit'], row['expiring_30'])
+                for row in conn.execute("SELECT * FROM stock_counts")}
+    assert counts() == {(1, 1): (1, 0, 1), (2, 1): (1, 0, 0)}
+    conn.execute("UPDATE vials SET status = 'IN_TRANSIT' WHERE id = 1")
+    assert counts()[(1, 1)] == (0, 1, 0)
+    conn.rollback()
+    conn.close()
+
+
+def test_migrating_twice_changes_nothing(tmp_path, monkeypatch, capsys):
+    # Through the maintenance scripts, which work on sys_data.dat in the current directory
+    build_legacy_db(str(tmp_path / 'sys_data.dat'))
+    monkeypatch.chdir(tmp_path)
+
+    migrate_users_active.migrate()
+    assert f"applied {[number for number, _, _ in migrations.MIGRATIONS]}" in capsys.readouterr().out
+
+    conn = migrations.connect('sys_data.dat')
+    schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    events = conn.execute("SELECT * FROM vial_events ORDER BY vial_id, seq").fetchall()
+    conn.close()
+
+    migrate_users_active.migrate()
+    assert f"Schema already at version {migrations.LATEST_VERSION}" in capsys.readouterr().out
+    conn = migrations.connect('sys_data.dat')
+    assert migrations.migrate(conn) == []
+    assert conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    assert conn.execute("SELECT * FROM vial_events ORDER BY vial_id, seq").fetchall() == events
+    conn.close()
+
+    check_schema.check_schema()
+    out = capsys.readouterr().out
+    assert f"Schema version: {migrations.LATEST_VERSION} (latest: {migrations.LATEST_VERSION})" in out
+    assert "Pending migration" not in out
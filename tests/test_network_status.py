@@ -0,0 +1,38 @@
+"""The /api/stock/all status map and its background refresher."""
+import threading
+
+from conftest import wait_for
+
+
+def test_refresher_survives_pool_timeout_and_query_errors(server, client, monkeypatch):
+    assert client.get('/api/stock/all').status_code == 200  # loads the map
+    monkeypatch.setattr(server, 'STATUS_REFRESH_RETRY', 0.05)
+    failures = []
+    acquire, query = server.db_pool.acquire, server.network_status._query
+
+    def failing_acquire():
+        if threading.current_thread().name == 'network-status' and not failures:
+            failures.append('pool')
+            raise server.PoolTimeout("pool exhausted")
+        return acquire()
+
+    def failing_query(conn, location_ids=None):
+        if failures == ['pool']:
+            failures.append('query')
+            raise server.sqlite3.OperationalError("database is locked")
+        return query(conn, location_ids)
+
+    monkeypatch.setattr(server.db_pool, 'acquire', failing_acquire)
+    monkeypatch.setattr(server.network_status, '_query', failing_query)
+    def refreshes():
+        # Earlier writes may have left a full reload pending, which covers location 1 too
+        snapshot = server.network_status.snapshot()
+        return snapshot['full_loads'] + snapshot['refreshed_locations']
+
+    refreshed = refreshes()
+    server.network_status.invalidate({1})
+
+    # Location 1 stayed stale through both failures and the thread kept retrying
+    wait_for(lambda: refreshes() > refreshed)
+    assert failures == ['pool', 'query']
+    assert server.network_status.snapshot()['stale'] == 0
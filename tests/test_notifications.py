@@ -0,0 +1,136 @@
+"""The notification outbox, with every message going to the NOTIFY_SINK file."""
+import contextlib
+import json
+import sqlite3
+import time
+import uuid
+
+import pytest
+
+import notifications
+from conftest import NOTIFY_SINK, wait_for
+
+
+def sent_bodies():
+    try:
+        with open(NOTIFY_SINK, encoding='utf-8') as f:
+            return [json.loads(line)['body'] for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def enqueue(server, body, fail=False):
+    def op():
+        with server.get_db() as conn:
+            server.enqueue_notification(conn.cursor(), 'email', 'ward@example.org', body, subject='Test')
+        if fail:
+            raise ValueError("write failed after queueing the message")
+        return body
+    return server.queue_write(op)
+
+
+def outbox_row(server, body):
+    with contextlib.closing(server._connect()) as conn:
+        return conn.execute("SELECT * FROM notification_outbox WHERE body = ?", (body,)).fetchone()
+
+
+def settled(server, body):
+    wait_for(lambda: outbox_row(server, body)['status'] != 'PENDING', timeout=10)
+    return outbox_row(server, body)
+
+
+@pytest.fixture
+def fail_sends(monkeypatch):
+    """fail_sends(body, errors): the sink raises each of errors in turn for body."""
+    send = notifications.SinkTransport.send
+    failures = {}
+    attempts = []
+
+    def failing_send(self, recipient, subject, body):
+        attempts.append((body, time.monotonic()))
+        if failures.get(body):
+            raise failures[body].pop(0)
+        return send(self, recipient, subject, body)
+
+    monkeypatch.setattr(notifications.SinkTransport, 'send', failing_send)
+
+    def fail(body, errors):
+        failures[body] = list(errors)
+    return fail, attempts
+
+
+def test_message_is_sent_once_its_write_commits(server):
+    body = f"committed {uuid.uuid4()}"
+    enqueue(server, body)
+    row = settled(server, body)
+    assert (row['status'], row['attempts'], row['channel']) == ('SENT', 1, 'email')
+    assert sent_bodies().count(body) == 1
+
+
+def test_dispatcher_reads_through_the_pool(server, db_readers):
+    pooled, unpooled = db_readers
+    body = f"pooled {uuid.uuid4()}"
+    enqueue(server, body)
+    assert settled(server, body)['status'] == 'SENT'
+    assert 'outbox-email' in pooled and 'outbox-email' not in unpooled
+
+
+def test_rolled_back_write_sends_nothing(server):
+    body = f"rolled back {uuid.uuid4()}"
+    with pytest.raises(ValueError):
+        enqueue(server, body, fail=True)
+    assert outbox_row(server, body) is None
+
+    # A later message goes out, the rolled-back one never does
+    later = f"after rollback {uuid.uuid4()}"
+    enqueue(server, later)
+    settled(server, later)
+    assert body not in sent_bodies()
+
+
+def test_failed_send_is_retried_after_backoff(server, monkeypatch, fail_sends):
+    monkeypatch.setattr(server, 'NOTIFY_BACKOFF_BASE', 0.4)
+    fail, attempts = fail_sends
+    body = f"retried {uuid.uuid4()}"
+    fail(body, [notifications.SendError("connection reset")])
+
+    enqueue(server, body)
+    row = settled(server, body)
+    assert (row['status'], row['attempts'], row['last_error']) == ('SENT', 2, None)
+    times = [at for sent_body, at in attempts if sent_body == body]
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.2  # backoff of base * 2**0, jittered down to half at most
+
+
+def test_permanent_failure_is_not_retried(server, fail_sends):
+    fail, attempts = fail_sends
+    body = f"rejected {uuid.uuid4()}"
+    fail(body, [notifications.SendError("recipient refused", permanent=True)])
+
+    enqueue(server, body)
+    row = settled(server, body)
+    assert (row['status'], row['attempts'], row['last_error']) == ('FAILED', 1, 'recipient refused')
+    assert [sent_body for sent_body, _ in attempts].count(body) == 1
+    assert body not in sent_bodies()
+
+
+def test_dispatcher_survives_a_failed_outcome_write(server, monkeypatch):
+    monkeypatch.setattr(server, 'NOTIFY_ERROR_PAUSE', 0.05)
+    queue_write = server.queue_write
+    failures = []
+
+    def failing_queue_write(func, *args, **kwargs):
+        if func.__name__ == 'record_logic' and not failures:
+            failures.append(func)
+            raise sqlite3.OperationalError("disk I/O error")
+        return queue_write(func, *args, **kwargs)
+
+    monkeypatch.setattr(server, 'queue_write', failing_queue_write)
+    body = f"recorded late {uuid.uuid4()}"
+    enqueue(server, body)
+
+    # The unrecorded send stays PENDING, goes out again and is then recorded
+    row = settled(server, body)
+    assert failures
+    assert row['status'] == 'SENT'
+    assert sent_bodies().count(body) == 2
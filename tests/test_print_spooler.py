@@ -0,0 +1,151 @@
+"""The label print spooler, against a fake network printer."""
+import re
+import socket
+import threading
+
+import pytest
+
+from conftest import receive_vials, wait_for
+
+
+class FakePrinter:
+    """Accepts raw ZPL on a local port and keeps everything it receives."""
+
+    def __init__(self):
+        self._listener = socket.socket()
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(5)
+        self.port = self._listener.getsockname()[1]
+        self.data = b''
+        self._lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                with self._lock:
+                    self.data += data
+
+    def labels(self):
+        """Asset IDs of the labels received, in order."""
+        with self._lock:
+            return [asset_id.decode() for asset_id in re.findall(rb'\^FN4\^FD(.*?)\^FS', self.data)]
+
+    def close(self):
+        self._listener.close()
+
+
+@pytest.fixture
+def printer():
+    printer = FakePrinter()
+    yield printer
+    printer.close()
+
+
+def queue_job(server, port, asset_ids, status='QUEUED', printed=0):
+    def op():
+        with server.get_db() as conn:
+            cursor = conn.execute("""
+                INSERT INTO print_jobs (location_id, printer_ip, printer_port, asset_ids, status, total, printed, created_at)
+                VALUES (1, '127.0.0.1', ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, (port, server.json.dumps(asset_ids), status, len(asset_ids), printed))
+        server.record_change('print_jobs', row_id=cursor.lastrowid, location_id=1)
+        return cursor.lastrowid
+    return server.queue_write(op)
+
+
+def finished_job(client, job_id):
+    def finished():
+        return client.get(f'/api/print_jobs/{job_id}').get_json()['status'] in ('DONE', 'FAILED')
+    wait_for(finished, timeout=10)
+    return client.get(f'/api/print_jobs/{job_id}').get_json()
+
+
+def test_job_prints_in_chunks(server, client, printer, monkeypatch):
+    monkeypatch.setattr(server, 'PRINT_CHUNK', 5)
+    sends = []
+    send = server.PrinterWorker._send
+
+    def recording_send(self, data, label_format=None):
+        if self.address[1] == printer.port:
+            sends.append(data.count(b'^XF'))
+        return send(self, data, label_format)
+
+    monkeypatch.setattr(server.PrinterWorker, '_send', recording_send)
+    assets = receive_vials(client, 12, 'SPOOL-CHUNK')
+    client.post('/api/settings', json={'location_id': 1, 'printer_ip': '127.0.0.1', 'printer_port': str(printer.port)})
+
+    response = client.post('/api/generate_labels', json={'asset_ids': assets, 'location_id': 1, 'user_id': 1})
+    assert response.status_code == 202
+    job = finished_job(client, response.get_json()['job_id'])
+
+    assert (job['status'], job['printed'], job['total'], job['attempts']) == ('DONE', 12, 12, 0)
+    assert sends == [5, 5, 2]
+    wait_for(lambda: len(printer.labels()) == 12)
+    assert printer.labels() == assets
+
+
+def test_interrupted_job_resumes_after_printed_labels(server, client, printer):
+    assets = receive_vials(client, 10, 'SPOOL-RESUME')
+    # As left by a restart after the first 7 labels went out
+    job = finished_job(client, queue_job(server, printer.port, assets, status='PRINTING', printed=7))
+
+    assert (job['status'], job['printed']) == ('DONE', 10)
+    wait_for(lambda: len(printer.labels()) == 3)
+    assert printer.labels() == assets[7:]
+
+
+def test_unreachable_printer_is_retried_then_failed(server, client, monkeypatch):
+    monkeypatch.setattr(server, 'PRINT_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(server, 'PRINT_BACKOFF_BASE', 0.01)
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]  # nothing listens here once closed
+    assets = receive_vials(client, 2, 'SPOOL-OFFLINE')
+
+    job = finished_job(client, queue_job(server, port, assets))
+    assert (job['status'], job['printed'], job['attempts']) == ('FAILED', 0, 3)
+    assert job['last_error']
+
+
+def test_unexpected_error_counts_as_an_attempt(server, client, printer, monkeypatch):
+    monkeypatch.setattr(server, 'PRINT_BACKOFF_BASE', 0.01)
+    render = server.render_label
+    failures = []
+
+    def failing_render(compiled, vial):
+        if not failures:
+            failures.append(vial['asset_id'])
+            raise KeyError('drug_name')
+        return render(compiled, vial)
+
+    monkeypatch.setattr(server, 'render_label', failing_render)
+    assets = receive_vials(client, 3, 'SPOOL-ERROR')
+
+    # The worker thread survives, records the failure and prints on the retry
+    job = finished_job(client, queue_job(server, printer.port, assets))
+    assert (job['status'], job['printed'], job['attempts']) == ('DONE', 3, 1)
+    assert job['last_error'] == "KeyError: 'drug_name'"
+    wait_for(lambda: len(printer.labels()) == 3)
+
+
+def test_spooler_reads_through_the_pool(server, client, printer, db_readers):
+    pooled, unpooled = db_readers
+    server.invalidate_label_formats()  # so the worker reads the label settings too
+    assets = receive_vials(client, 2, 'SPOOL-POOL')
+
+    assert finished_job(client, queue_job(server, printer.port, assets))['status'] == 'DONE'
+    threads = {'print-spooler', f'printer-127.0.0.1:{printer.port}'}
+    assert threads <= pooled
+    assert not threads & unpooled
@@ -0,0 +1,178 @@
+import ast
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations
+
+SERVER_FILE = os.path.join(ROOT, 'server.py')
+
+# Tables that grow without bound - a full scan of any of these is a regression
+HOT_TABLES = {'vials', 'transfers', 'transfer_items', 'audit_log', 'vial_events'}
+
+# Statements that are still allowed to scan a hot table, keyed by a fragment
+# of their SQL. Every entry needs a reason.
+KNOWN_SCANS = {
+    "v.asset_id LIKE ? OR": "stock_search falls back to substring LIKE for queries too short for the trigram index",
+    "WHERE status IN ('AVAILABLE', 'IN_TRANSIT') GROUP BY location_id, drug_id":
+        "stock_counts integrity check and rebuild recount every vial on purpose",
+    "SELECT id, asset_id, batch_number, drug_id, status, location_id FROM vials":
+        "the typeahead prefix index loads every vial at startup and after external writes",
+}
+
+LOCATIONS = 12
+DRUGS = 20
+VIALS = 50000
+TRANSFERS = 5000
+AUDIT_ROWS = 50000
+
+
+def build_synthetic_db(path):
+    conn = migrations.connect(path)
+    migrations.migrate(conn)
+    rnd = random.Random(42)
+    now = datetime.now()
+
+    conn.executemany(
+        "INSERT INTO locations (id, name, type, parent_hub_id) VALUES (?, ?, ?, ?)",
+        [(i, f"Location {i}", 'HUB' if i <= 2 else 'WARD', None if i <= 2 else 1 + i % 2) for i in range(1, LOCATIONS + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO drugs (id, name, category, storage_temp, unit_price) VALUES (?, ?, 'Test', '2-8', 100)",
+        [(i, f"Drug {i}") for i in range(1, DRUGS + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO users (id, username, password_hash, role, location_id) VALUES (?, ?, 'x', 'NURSE', ?)",
+        [(i, f"user{i}", 1 + i % LOCATIONS) for i in range(1, 101)]
+    )
+    conn.executemany(
+        "INSERT INTO stock_levels (location_id, drug_id, min_stock) VALUES (?, ?, 2)",
+        [(l, d) for l in range(1, LOCATIONS + 1) for d in range(1, DRUGS + 1)]
+    )
+
+    statuses = ['AVAILABLE'] * 2 + ['USED_CLINICAL'] * 6 + ['DISCARDED', 'IN_TRANSIT']
+    vials = []
+    for i in range(1, VIALS + 1):
+        status = rnd.choice(statuses)
+        created = now - timedelta(days=rnd.randint(0, 1500))
+        used_at = created + timedelta(days=rnd.randint(1, 100)) if status in ('USED_CLINICAL', 'DISCARDED') else None
+        vials.append((
+            i, f"AST-{i}", 1 + i % DRUGS, f"B{i % 300}",
+            (created + timedelta(days=rnd.randint(30, 700))).strftime('%Y-%m-%d'),
+            1 + i % LOCATIONS, status, created, used_at, 1 + i % 100 if used_at else None
+        ))
+    conn.executemany("""
+        INSERT INTO vials (id, asset_id, drug_id, batch_number, expiry_date, location_id, status, created_at, used_at, used_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, vials)
+
+    conn.executemany("""
+        INSERT INTO transfers (id, from_location_id, to_location_id, status, created_by, created_at)
+        VALUES (?, ?, ?, 'COMPLETED', ?, ?)
+    """, [(i, 1 + i % LOCATIONS, 1 + (i + 3) % LOCATIONS, 1 + i % 100, now - timedelta(hours=i)) for i in range(1, TRANSFERS + 1)])
+    conn.executemany(
+        "INSERT INTO transfer_items (transfer_id, vial_id) VALUES (?, ?)",
+        [(1 + i % TRANSFERS, 1 + (i * 7) % VIALS) for i in range(TRANSFERS * 3)]
+    )
+    conn.executemany(
+        "INSERT INTO audit_log (user_id, action, details, timestamp, asset_id, vial_id, location_id) VALUES (?, 'RECEIVE_STOCK', ?, ?, ?, ?, ?)",
+        [(1 + i % 100, f'{{"asset_id": "AST-{1 + i % VIALS}"}}', now, f"AST-{1 + i % VIALS}", 1 + i % VIALS, 1 + i % LOCATIONS) for i in range(AUDIT_ROWS)]
+    )
+    conn.commit()
+    return conn
+
+
+def server_statements():
+    """Every literal SQL statement in server.py that reads or writes rows.
+
+    f-string statements are planned with each {...} replaced by a single ?,
+    which covers the generated IN (?, ?, ...) lists.
+    """
+    tree = ast.parse(open(SERVER_FILE, encoding='utf-8').read())
+    fragments = set()
+    candidates = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.JoinedStr):
+            fragments.update(id(part) for part in node.values)
+            text = ''.join(part.value if isinstance(part, ast.Constant) else '?' for part in node.values)
+            candidates.append((node.lineno, text))
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in fragments:
+            candidates.append((node.lineno, node.value))
+
+    statements = []
+    for lineno, text in candidates:
+        sql = ' '.join(text.split())
+        if re.match(r'(SELECT|UPDATE|DELETE|INSERT|WITH)\b', sql, re.IGNORECASE) and ' ' in sql:
+            statements.append((lineno, sql))
+    return statements
+
+
+def _aliases(sql):
+    aliases = {}
+    for table, alias in re.findall(r'(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.upper() not in ('WHERE', 'JOIN', 'LEFT', 'INNER', 'ON', 'GROUP', 'ORDER', 'LIMIT', 'SET'):
+            aliases[alias] = table
+    return aliases
+
+
+def partial_indexes(conn):
+    return {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '%WHERE%'"
+    )}
+
+
+def full_scans(conn, sql, partial):
+    """Hot tables the plan reads end to end.
+
+    A scan through a partial index only visits the rows the index admits
+    (e.g. AVAILABLE vials), so it is not counted.
+    """
+    params = [None] * sql.count('?')
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    aliases = _aliases(sql)
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = re.match(r'SCAN (?:TABLE )?(\w+)(?:.*USING (?:COVERING )?INDEX (\w+))?', detail)
+        if match and match.group(2) not in partial:
+            table = aliases.get(match.group(1), match.group(1))
+            if table in HOT_TABLES:
+                scans.append(detail)
+    return scans
+
+
+def check_plans():
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_synthetic_db(os.path.join(tmp, 'plans.dat'))
+        partial = partial_indexes(conn)
+        failures = []
+        for lineno, sql in server_statements():
+            try:
+                scans = full_scans(conn, sql, partial)
+            except sqlite3.Error as e:
+                failures.append(f"server.py:{lineno} does not prepare ({e}): {sql[:120]}")
+                continue
+            if scans and not any(fragment in sql for fragment in KNOWN_SCANS):
+                failures.append(f"server.py:{lineno} {scans}: {sql[:160]}")
+        conn.close()
+        return failures
+
+
+def test_hot_queries_use_indexes():
+    failures = check_plans()
+    assert not failures, "\n".join(failures)
+
+
+if __name__ == "__main__":
+    failures = check_plans()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("PASS: no hot query scans" if not failures else f"{len(failures)} query plan regressions")
@@ -0,0 +1,111 @@
+"""Cached read endpoints: entries are dropped by commits to the tables they
+declare, and a response built while such a commit landed is never stored."""
+import pytest
+
+from response_cache import ResponseCache
+
+# (path, declared table, change, undo) - each change is visible in the response
+CASES = [
+    ('/api/locations', 'locations',
+     "UPDATE locations SET name = name || ' (renamed)' WHERE id = 3",
+     "UPDATE locations SET name = replace(name, ' (renamed)', '') WHERE id = 3"),
+    ('/api/drugs', 'drugs',
+     "UPDATE drugs SET category = category || ' (renamed)' WHERE id = 3",
+     "UPDATE drugs SET category = replace(category, ' (renamed)', '') WHERE id = 3"),
+    ('/api/stock_levels', 'stock_levels',
+     "UPDATE stock_levels SET min_stock = min_stock + 1 WHERE id = 1",
+     "UPDATE stock_levels SET min_stock = min_stock - 1 WHERE id = 1"),
+    ('/api/users', 'users',
+     "UPDATE users SET mobile_number = '0400 000 000' WHERE id = 1",
+     "UPDATE users SET mobile_number = NULL WHERE id = 1"),
+    ('/api/users', 'locations',
+     "UPDATE locations SET name = name || ' (renamed)' WHERE id = 1",
+     "UPDATE locations SET name = replace(name, ' (renamed)', '') WHERE id = 1"),
+    ('/api/dashboard/1/stock', 'vials',
+     "UPDATE vials SET batch_number = batch_number || '-R' WHERE status = 'AVAILABLE'",
+     "UPDATE vials SET batch_number = substr(batch_number, 1, length(batch_number) - 2) WHERE status = 'AVAILABLE'"),
+    ('/api/dashboard/1/stock', 'drugs',
+     "UPDATE drugs SET name = name || ' (renamed)'",
+     "UPDATE drugs SET name = replace(name, ' (renamed)', '')"),
+    ('/api/dashboard/1/stock', 'locations',
+     "UPDATE locations SET name = name || ' (renamed)'",
+     "UPDATE locations SET name = replace(name, ' (renamed)', '')"),
+    ('/api/dashboard/1/summary', 'stock_counts',
+     "UPDATE stock_counts SET available = available + 1 WHERE location_id = 1",
+     "UPDATE stock_counts SET available = available - 1 WHERE location_id = 1"),
+    ('/api/dashboard/1/summary', 'users',
+     "UPDATE users SET role = 'NURSE' WHERE id = 1",
+     "UPDATE users SET role = 'PHARMACIST' WHERE id = 1"),
+]
+
+
+def commit(server, table, sql):
+    def op():
+        with server.get_db() as conn:
+            conn.execute(sql)
+        server.record_change(table)
+    server.queue_write(op)
+
+
+@pytest.mark.parametrize('path, table, change, undo', CASES, ids=[f"{case[0]}:{case[1]}" for case in CASES])
+def test_commit_to_declared_table_invalidates(server, client, path, table, change, undo):
+    before = client.get(path).get_data()
+    hits = server.response_cache.stats['hits']
+    assert client.get(path).get_data() == before
+    assert server.response_cache.stats['hits'] == hits + 1
+
+    commit(server, table, change)
+    try:
+        after = client.get(path).get_data()
+        assert after != before
+        # Same as a response built with nothing cached at all
+        server.response_cache.invalidate_all()
+        assert client.get(path).get_data() == after
+    finally:
+        commit(server, table, undo)
+
+
+def test_response_built_across_a_commit_is_not_stored():
+    cache = ResponseCache()
+    versions = cache.versions(('vials', 'drugs'))
+    cache.invalidate({'drugs'})
+    assert not cache.put('key', ('vials', 'drugs'), versions, 'stale', 5)
+    assert cache.get('key') is None
+    assert cache.stats['stale_stores'] == 1
+
+    # Other tables' entries survive
+    cache.put('locations', ('locations',), cache.versions(('locations',)), 'fresh', 5)
+    cache.invalidate({'vials'})
+    assert cache.get('locations') == 'fresh'
+
+
+def test_etag_revalidation(server, client, monkeypatch):
+    first = client.get('/api/drugs')
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag.startswith('W/')
+
+    unchanged = client.get('/api/drugs', headers={'If-None-Match': etag})
+    assert unchanged.status_code == 304
+    assert unchanged.get_data() == b''
+    assert unchanged.headers['ETag'] == etag
+
+    # A write to a declared table changes the ETag
+    commit(server, 'drugs', "UPDATE drugs SET version = version + 1 WHERE id = 1")
+    changed = client.get('/api/drugs', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    etag = changed.headers['ETag']
+    assert client.get('/api/drugs', headers={'If-None-Match': etag}).status_code == 304
+
+    # ...and so does the date, for endpoints whose defaults follow the calendar
+    today = server.datetime
+
+    class Tomorrow(today):
+        @classmethod
+        def now(cls, tz=None):
+            return today.now(tz) + server.timedelta(days=1)
+
+    monkeypatch.setattr(server, 'datetime', Tomorrow)
+    next_day = client.get('/api/drugs', headers={'If-None-Match': etag})
+    assert next_day.status_code == 200
+    assert next_day.headers['ETag'] != etag
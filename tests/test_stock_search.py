@@ -0,0 +1,46 @@
+"""/api/stock_search pagination over the trigram index."""
+import contextlib
+
+from conftest import receive_vials
+
+
+def search_page(client, query, limit, cursor=None):
+    params = {'query': query, 'limit': limit}
+    if cursor:
+        params['cursor'] = cursor
+    response = client.get('/api/stock_search', query_string=params)
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    return [row['asset_id'] for row in body['results']], body['next_cursor']
+
+
+def test_cursor_is_stable_across_writes(server, client):
+    with contextlib.closing(server._connect()) as conn:
+        assert server.vial_search_ready(conn)
+    later = receive_vials(client, 3, 'FTSPAGE-B', expiry_date='2031-01-01')
+    sooner = receive_vials(client, 3, 'FTSPAGE-A', expiry_date='2030-06-01')
+
+    listed, cursor = search_page(client, 'FTSPAGE', 2)
+    # Vials indexed mid-listing must not make later pages skip or repeat rows
+    late = receive_vials(client, 3, 'FTSPAGE-C', expiry_date='2031-06-01')
+    while cursor:
+        page, cursor = search_page(client, 'FTSPAGE', 2, cursor)
+        listed.extend(page)
+
+    # Soonest expiry first, then in id order
+    assert listed == sooner + later + late
+
+
+def test_search_box_results_are_best_match_first(server, client):
+    receive_vials(client, 2, 'FTSRANK-1')
+    receive_vials(client, 2, 'FTSRANK-FTSRANK-2')
+    with contextlib.closing(server._connect()) as conn:
+        expected = [row[0] for row in conn.execute("""
+            SELECT v.asset_id FROM vial_search JOIN vials v ON v.id = vial_search.rowid
+            WHERE vial_search MATCH ? ORDER BY rank
+        """, (server.fts_phrase('FTSRANK'),))]
+
+    response = client.get('/api/stock_search', query_string={'query': 'FTSRANK'})
+    assert [row['asset_id'] for row in response.get_json()] == expected
+    # The repeated term ranks its vials first
+    assert response.get_json()[0]['batch_number'] == 'FTSRANK-FTSRANK-2'
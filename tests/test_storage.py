@@ -0,0 +1,55 @@
+"""Per-connection storage settings follow the journal mode the file is in."""
+import contextlib
+import sqlite3
+
+import pytest
+
+FULL, NORMAL = 2, 1
+
+
+def make_db(path, journal_mode):
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.execute("CREATE TABLE t (x)")
+
+
+@pytest.mark.parametrize('journal_mode, synchronous', [('DELETE', FULL), ('WAL', NORMAL)])
+def test_wal_profile_synchronous_follows_file(server, tmp_path, monkeypatch, journal_mode, synchronous):
+    path = str(tmp_path / 'sys_data.dat')
+    make_db(path, journal_mode)
+    monkeypatch.setattr(server, 'DB_FILE', path)
+    monkeypatch.setattr(server, 'STORAGE', dict(server.STORAGE_PROFILES['wal'], name='wal'))
+
+    # A file whose WAL conversion was deferred stays in DELETE mode, where NORMAL is not durable
+    with contextlib.closing(server._connect()) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0].upper() == journal_mode
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == synchronous
+
+
+@pytest.mark.parametrize('existing', [False, True])
+def test_conversion_refreshes_open_connections(server, tmp_path, monkeypatch, existing):
+    path = str(tmp_path / 'sys_data.dat')
+    if existing:
+        make_db(path, 'DELETE')
+    else:
+        # Created empty by a thread that connected before the conversion
+        sqlite3.connect(path).close()
+    backups = []
+    monkeypatch.setattr(server, 'DB_FILE', path)
+    monkeypatch.setattr(server, 'STORAGE', dict(server.STORAGE_PROFILES['wal'], name='wal'))
+    monkeypatch.setattr(server, 'perform_backup', lambda: backups.append(path))
+    monkeypatch.setattr(server, '_storage_generation', server._storage_generation)
+    generation = server._storage_generation
+    pooled = server.db_pool.acquire()
+    server.db_pool.release(pooled)
+
+    server.apply_storage_profile()
+
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0].upper() == 'WAL'
+    # Only a file with data in it is checked and backed up first
+    assert backups == ([path] if existing else [])
+    # The writer and the pool reconnect instead of keeping PRAGMAs chosen for DELETE
+    assert server._storage_generation == generation + 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        pooled.execute("SELECT 1")
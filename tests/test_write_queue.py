@@ -0,0 +1,132 @@
+"""The write queue.
+
+Group commit: every write queued behind a busy worker runs in one
+transaction, each operation under its own savepoint. Priority lanes decide
+the order writes are claimed in, which ones are shed when the queue fills
+up, and deadlines drop writes whose caller has given up.
+"""
+import contextlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+def insert_drug(server, name, fail=False):
+    def op():
+        with server.get_db() as conn:
+            conn.execute("INSERT INTO drugs (name, category, storage_temp, unit_price) VALUES (?, 'Test', '2-8', 1)", (name,))
+        if fail:
+            raise ValueError(f"{name} failed")
+        # Committed batches so far: the same for every operation in one batch
+        return server.write_stats['batches']
+    return op
+
+
+def drug_names(server, prefix):
+    with contextlib.closing(server._connect()) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM drugs WHERE name LIKE ?", (prefix + '%',))}
+
+
+def test_failing_operation_leaves_batch_mates_committed(server, hold_writer, submit):
+    with ThreadPoolExecutor(3) as pool:
+        with hold_writer():
+            first = submit(pool, insert_drug(server, 'GC1 first'))
+            failing = submit(pool, insert_drug(server, 'GC1 failing', fail=True))
+            last = submit(pool, insert_drug(server, 'GC1 last'))
+
+        assert first.result() == last.result()
+        with pytest.raises(ValueError):
+            failing.result()
+    assert drug_names(server, 'GC1 ') == {'GC1 first', 'GC1 last'}
+
+
+def test_rollback_resets_asset_allocator(server):
+    prefix = 'GCA-1'
+
+    def allocate(fail):
+        def op():
+            with server.get_db() as conn:
+                ids = server.asset_allocator.allocate(conn.cursor(), prefix, 2)
+            if fail:
+                raise ValueError("receipt failed")
+            return ids
+        return op
+
+    resets = server.asset_allocator.stats['resets']
+    with pytest.raises(ValueError):
+        server.queue_write(allocate(fail=True))
+    assert server.asset_allocator.stats['resets'] == resets + 1
+
+    # The rolled-back reservation is forgotten, so the sequence picks up where
+    # the database says it is rather than where the failed block left off
+    assert server.queue_write(allocate(fail=False)) == [f'{prefix}-1', f'{prefix}-2']
+    assert server.queue_write(allocate(fail=False)) == [f'{prefix}-3', f'{prefix}-4']
+
+
+def test_failed_batch_fails_every_request(server, hold_writer, submit):
+    def break_transaction():
+        # Ends the batch transaction under the worker, so the batch cannot commit
+        with server.get_db() as conn:
+            conn.execute("ROLLBACK")
+
+    failed_batches = server.write_stats['failed_batches']
+    with ThreadPoolExecutor(3) as pool:
+        with hold_writer():
+            before = submit(pool, insert_drug(server, 'GC3 before'))
+            breaking = submit(pool, break_transaction)
+            after = submit(pool, insert_drug(server, 'GC3 after'))
+
+        for future in (before, breaking, after):
+            with pytest.raises(sqlite3.Error):
+                future.result()
+    assert server.write_stats['failed_batches'] == failed_batches + 1
+    assert drug_names(server, 'GC3 ') == set()
+
+
+def test_clinical_writes_overtake_waiting_admin_writes(server, hold_writer, submit):
+    order = []
+
+    def record(name):
+        return lambda: order.append(name)
+
+    with ThreadPoolExecutor(3) as pool:
+        with hold_writer():
+            futures = [
+                submit(pool, record('admin 1'), priority=server.PRIORITY_ADMIN),
+                submit(pool, record('admin 2'), priority=server.PRIORITY_ADMIN),
+                submit(pool, record('clinical'), priority=server.PRIORITY_CLINICAL),
+            ]
+        for future in futures:
+            future.result()
+    assert order == ['clinical', 'admin 1', 'admin 2']
+
+
+def test_expired_write_times_out_and_never_runs(server, hold_writer):
+    ran = []
+    with hold_writer():
+        with pytest.raises(server.WriteTimeout):
+            server.queue_write(lambda: ran.append(True), timeout=0.2)
+    server.queue_write(lambda: None)  # the worker has been past the expired write
+    assert ran == []
+
+
+def test_worker_drops_writes_past_their_deadline(server):
+    ran = []
+    req = server._WriteRequest(lambda: ran.append(True), (), server.PRIORITY_ADMIN, -1)
+    assert server._claim([req]) == []
+    assert isinstance(req.result.get_nowait(), server.WriteTimeout)
+    assert ran == []
+
+
+def test_full_queue_sheds_admin_writes_first(server, hold_writer, submit, monkeypatch):
+    # Admin writes are shed at half the depth, clinical ones only when full
+    monkeypatch.setattr(server, 'WRITE_QUEUE_MAX_DEPTH', 4)
+    with ThreadPoolExecutor(3) as pool:
+        with hold_writer():
+            queued = [submit(pool, lambda: 'queued') for _ in range(2)]
+            with pytest.raises(server.WriteQueueFull):
+                server.queue_write(lambda: 'shed', priority=server.PRIORITY_ADMIN)
+            clinical = submit(pool, lambda: 'clinical', priority=server.PRIORITY_CLINICAL)
+        assert [future.result() for future in queued] == ['queued', 'queued']
+        assert clinical.result() == 'clinical'